@@ -3,17 +3,19 @@ from pathlib import Path
 import json
 import bcrypt
 import reporting
+from repository import get_repository
 from datetime import datetime
 import traceback
-import expiry_bot as bot
 from report_pdf import gerar_relatorio_pdf
 import pandas as pd
 from db_supabase import (
-    get_conn, init_db, list_users, create_user,
+    connection, get_conn, init_db, list_users, create_user,
     update_user_role, update_user_status, update_user_password
 )
 from auth import login_box
 import painel_expiry_bot as painel
+import outbox_alertas
+import config_lojas
 
 st.set_page_config(
     page_title="Controle LRC - Painel Web da Loja",
@@ -81,31 +83,25 @@ db_path.parent.mkdir(parents=True, exist_ok=True)
 if not db_path.exists():
     st.warning(f"⚠️ Banco de dados não encontrado em {db_path}. Será criado automaticamente.")
 
-conn = get_conn(cfg["database_path"])
-init_db(conn)
-
-def enviar_alertas_automaticos():
+def enviar_alertas_automaticos(conn):
     """
     Envia automaticamente e-mails de alerta para todas as lojas
     quando houver produtos com vencimento em 30, 15 ou 7 dias.
     Cada loja só recebe 1 e-mail por dia.
     """
     try:
-        lojas = conn.execute("SELECT id, name FROM stores").fetchall()
+        lojas = get_repository(conn).list_stores()
         if not lojas:
             return
 
         hoje = datetime.now().strftime("%Y-%m-%d")
 
-        for loja_id, loja_nome in lojas:
-            CFG_STORE_PATH = Path(__file__).resolve().parents[1] / f"config_loja_{loja_id}.json"
+        # Histograma de validade de todas as lojas em uma única consulta
+        hist = reporting.expiry_buckets(conn, limits=(7, 15, 30))
 
-            # Carrega configuração da loja (ou usa cfg global)
-            if CFG_STORE_PATH.exists():
-                cfg_loja = json.loads(CFG_STORE_PATH.read_text(encoding="utf-8"))
-            else:
-                cfg_loja = cfg.copy()
-                CFG_STORE_PATH.write_text(json.dumps(cfg_loja, indent=2, ensure_ascii=False), encoding="utf-8")
+        for loja_id, loja_nome in lojas:
+            # Configuração da loja (store_settings em cache; herda o cfg global)
+            cfg_loja = config_lojas.config_loja(conn, cfg, loja_id)
 
             alert_cfg = cfg_loja.get("alert_email", {})
             if not alert_cfg.get("enabled", False):
@@ -117,45 +113,37 @@ def enviar_alertas_automaticos():
                 print(f"⏳ Alerta já enviado hoje para {loja_nome}, pulando...")
                 continue
 
-            # Cria snapshot do estoque
-            df_loja = reporting.build_snapshots(conn)
-            if df_loja is None or df_loja.empty or "store_id" not in df_loja.columns:
-                continue
-
-            df_loja = df_loja[df_loja["store_id"] == loja_id]
-            if df_loja.empty:
-                continue
+            faixas = reporting.bucket_totals(hist, store_id=loja_id)
+            near_7 = faixas.get("ate_7", {}).get("qty", 0)
+            near_15 = faixas.get("ate_15", {}).get("qty", 0)
+            near_30 = faixas.get("ate_30", {}).get("qty", 0)
+            total_a_vencer = near_7 + near_15 + near_30
 
             houve_envio = False
 
-            # Combina todos os prazos de validade em um único dataframe
-            near_30 = reporting.near_expiry(df_loja, 30)
-            near_15 = reporting.near_expiry(df_loja, 15)
-            near_7 = reporting.near_expiry(df_loja, 7)
-
-            # Junta todos os itens únicos
-            near_total = pd.concat([near_30, near_15, near_7]).drop_duplicates(subset=["ean", "lot"], keep="first")
-
-            if near_total is not None and not near_total.empty:
+            if total_a_vencer > 0:
                 try:
+                    # Só as lojas que vão receber relatório buscam as linhas do estoque
+                    df_loja = reporting.build_snapshots(conn, store_id=loja_id)
+
                     # 1️⃣ Gera PDF consolidado
                     pdf_path = gerar_relatorio_pdf(
                         cfg_loja,
                         df=df_loja,
-                        total_estoque=int(df_loja["qty"].sum()),
-                        total_a_vencer=int(near_total["qty"].sum()),
-                        total_vencido=int(reporting.expired(df_loja)["qty"].sum()),
+                        total_estoque=sum(f["qty"] for f in faixas.values()),
+                        total_a_vencer=total_a_vencer,
+                        total_vencido=faixas.get("vencido", {}).get("qty", 0),
                         total_vendido=0,
                         store_id=loja_id,
                     )
 
                     # 2️⃣ Monta mensagem única
                     resumo = []
-                    if not near_7.empty:
+                    if near_7:
                         resumo.append("⚠️ Produtos com menos de 7 dias de validade.")
-                    if not near_15.empty:
+                    if near_15:
                         resumo.append("🟠 Produtos com validade entre 8 e 15 dias.")
-                    if not near_30.empty:
+                    if near_30:
                         resumo.append("🟡 Produtos com validade entre 16 e 30 dias.")
                     resumo_txt = "\n".join(resumo)
 
@@ -168,16 +156,12 @@ def enviar_alertas_automaticos():
                         f"Atenciosamente,\nSistema Controle LRC"
                     )
 
-                    # 3️⃣ Envia e-mail consolidado com o anexo
-                    ok, info = bot.enviar_email_alerta(cfg_loja, subject, body, anexos=[pdf_path])
+                    # 3️⃣ Enfileira o e-mail consolidado; o worker da fila faz o envio e as novas tentativas
+                    alert_id = outbox_alertas.enfileirar_alerta(conn, loja_id, subject, body, anexos=[pdf_path])
 
-                    if ok:
-                        houve_envio = True
-                        cfg_loja["last_alert_sent"] = hoje
-                        CFG_STORE_PATH.write_text(json.dumps(cfg_loja, indent=2, ensure_ascii=False), encoding="utf-8")
-                        print(f"[{datetime.now():%Y-%m-%d %H:%M}] ✅ E-mail consolidado enviado para {loja_nome}")
-                    else:
-                        print(f"[{datetime.now():%Y-%m-%d %H:%M}] ❌ Falha ao enviar consolidado para {loja_nome}: {info}")
+                    houve_envio = True
+                    config_lojas.registrar_alerta_enviado(conn, loja_id, hoje)
+                    print(f"[{datetime.now():%Y-%m-%d %H:%M}] 📥 Alerta #{alert_id} de {loja_nome} enfileirado")
 
                 except Exception as e:
                     print(f"Erro ao gerar ou enviar PDF consolidado para {loja_nome}: {e}")
@@ -189,222 +173,184 @@ def enviar_alertas_automaticos():
 
 st.set_page_config(page_title="Controle LRC - Acesso", layout="wide")
 
-# ===============================
-# BOOTSTRAP DO ADMIN (primeiro acesso)
-# ===============================
-users_df = list_users(conn)
-try:
-    users_df = list_users(conn)
-except Exception as e:
-    st.error(f"Erro ao carregar usuários: {e}")
-    st.stop()
-
-if users_df is None:
-    st.error("❌ Falha ao carregar tabela de usuários. O banco pode estar corrompido.")
-    st.stop()
 
-if users_df.empty:
-    st.warning("Nenhum usuário cadastrado. Crie o primeiro ADMIN.")
-    with st.form("bootstrap_admin"):
-        name = st.text_input("Nome completo")
-        email = st.text_input("E-mail")
-        username = st.text_input("Usuário (login)", value="admin")
-        pwd = st.text_input("Senha", type="password")
-        pwd2 = st.text_input("Confirmar senha", type="password")
-        ok = st.form_submit_button("Criar ADMIN")
-
-    if ok:
-        if not (name and email and username and pwd and pwd2):
-            st.error("Preencha todos os campos.")
-        elif pwd != pwd2:
-            st.error("As senhas não conferem.")
-        else:
-            try:
-                pwd_hash = bcrypt.hashpw(pwd.encode("utf-8"), bcrypt.gensalt()).decode("utf-8")
-                create_user(
-                    conn,
-                    username=username,
-                    name=name,
-                    email=email,
-                    pwd_hash=pwd_hash,
-                    role="admin",
-                    is_active=1,
-                )
-                st.success("✅ ADMIN criado! Recarregue a página para fazer login.")
-            except Exception as e:
-                st.error(f"Erro ao criar ADMIN: {e}")
-    st.stop()
+def main(conn):
+    """Renderiza o app inteiro com a conexão emprestada do pool para este rerun."""
+    # ===============================
+    # BOOTSTRAP DO ADMIN (primeiro acesso)
+    # ===============================
+    users_df = list_users(conn)
+    try:
+        users_df = list_users(conn)
+    except Exception as e:
+        st.error(f"Erro ao carregar usuários: {e}")
+        st.stop()
 
-# ===============================
-# SESSÃO DE LOGIN
-# ===============================
-if "user" not in st.session_state:
-    user = login_box(conn)
-    if not user:
+    if users_df is None:
+        st.error("❌ Falha ao carregar tabela de usuários. O banco pode estar corrompido.")
         st.stop()
-    st.session_state["user"] = user
-    st.rerun()
 
-user = st.session_state["user"]
+    if users_df.empty:
+        st.warning("Nenhum usuário cadastrado. Crie o primeiro ADMIN.")
+        with st.form("bootstrap_admin"):
+            name = st.text_input("Nome completo")
+            email = st.text_input("E-mail")
+            username = st.text_input("Usuário (login)", value="admin")
+            pwd = st.text_input("Senha", type="password")
+            pwd2 = st.text_input("Confirmar senha", type="password")
+            ok = st.form_submit_button("Criar ADMIN")
+
+        if ok:
+            if not (name and email and username and pwd and pwd2):
+                st.error("Preencha todos os campos.")
+            elif pwd != pwd2:
+                st.error("As senhas não conferem.")
+            else:
+                try:
+                    pwd_hash = bcrypt.hashpw(pwd.encode("utf-8"), bcrypt.gensalt()).decode("utf-8")
+                    create_user(
+                        conn,
+                        username=username,
+                        name=name,
+                        email=email,
+                        pwd_hash=pwd_hash,
+                        role="admin",
+                        is_active=1,
+                    )
+                    st.success("✅ ADMIN criado! Recarregue a página para fazer login.")
+                except Exception as e:
+                    st.error(f"Erro ao criar ADMIN: {e}")
+        st.stop()
 
-# ===============================
-# CABEÇALHO SUPERIOR
-# ===============================
-col1, col2 = st.columns([4, 1])
-with col1:
-    store = conn.execute("SELECT name FROM stores WHERE id=?", (user.get("store_id"),)).fetchone()
-    store_name = store[0] if store else "Sem loja vinculada"
-    st.success(f"Bem-vindo, {user['name']} ({user['role']}) — 🏬 {store_name}")
-with col2:
-    if st.button("🚪 Sair"):
-        del st.session_state["user"]
+    # ===============================
+    # SESSÃO DE LOGIN
+    # ===============================
+    if "user" not in st.session_state:
+        user = login_box(conn)
+        if not user:
+            st.stop()
+        st.session_state["user"] = user
         st.rerun()
 
-# 🔔 ALERTA IMEDIATO APÓS LOGIN: itens a vencer na loja do usuário
-try:
-    df_login = reporting.build_snapshots(conn)
-
-    if df_login is not None and not df_login.empty:
-        if "store_id" in df_login.columns:
-            df_login["store_id"] = df_login["store_id"].astype(str)
-            df_login = df_login[df_login["store_id"] == str(user.get("store_id"))]
+    user = st.session_state["user"]
+
+    # ===============================
+    # CABEÇALHO SUPERIOR
+    # ===============================
+    col1, col2 = st.columns([4, 1])
+    with col1:
+        store_name = get_repository(conn).store_name(user.get("store_id")) or "Sem loja vinculada"
+        st.success(f"Bem-vindo, {user['name']} ({user['role']}) — 🏬 {store_name}")
+    with col2:
+        if st.button("🚪 Sair"):
+            del st.session_state["user"]
+            st.rerun()
+
+    # 🔔 ALERTA IMEDIATO APÓS LOGIN: itens a vencer na loja do usuário
+    try:
+        # histograma da loja do usuário: uma consulta agrupada, sem trazer as linhas
+        dias_alerta = int(cfg.get("near_expiry_days", 15))
+        hist_login = reporting.expiry_buckets(conn, store_id=user.get("store_id"), limits=(dias_alerta,))
+
+        if not hist_login.empty:
+            faixa = reporting.bucket_totals(hist_login).get(f"ate_{dias_alerta}", {})
+
+            # Evita repetir o alerta enquanto o usuário navega
+            alert_key = f"near_alert_shown_{user.get('store_id')}"
+            if faixa.get("qty", 0) > 0 and not st.session_state.get(alert_key, False):
+                total = faixa["qty"]
+
+                # monta lista de até 3 produtos para exibir no alerta
+                inicio, fim = reporting.near_expiry_window(dias_alerta)
+                near_login = reporting.build_snapshots(
+                    conn, store_id=user.get("store_id"), expiry_from=inicio, expiry_to=fim
+                )
+                produtos_preview = near_login["product_name"].dropna().unique().tolist()[:3]
+                resumo = ", ".join(produtos_preview) + ("..." if len(produtos_preview) >= 3 else "")
 
-        near_login = reporting.near_expiry(df_login, cfg.get("near_expiry_days", 15))
+                st.toast(
+                    f"⚠️ {total} item(ns) com validade a vencer em até {dias_alerta} dia(s). "
+                    f"Ex: {resumo or 'ver detalhes em 📋 Controle Operacional → A Vencer.'}",
+                    icon="⚠️"
+                )
+                st.session_state[alert_key] = True
+        else:
+            st.sidebar.info("📦 Nenhum item de estoque encontrado ainda.")
 
-        # Evita repetir o alerta enquanto o usuário navega
-        alert_key = f"near_alert_shown_{user.get('store_id')}"
-        if not near_login.empty and not st.session_state.get(alert_key, False):
-            total = int(near_login["qty"].sum()) if "qty" in near_login.columns else len(near_login)
+    except Exception as e:
+        # Não quebra a página se algo falhar no alerta
+        st.sidebar.warning(f"Alerta de validade indisponível: {e}")
+
+    # ===============================
+    # ABAS PRINCIPAIS
+    # ===============================
+    abas = st.tabs([
+        "📊 Painel Principal",
+        "📤 Envio Manual de Alertas (ADMIN)",
+        "👥 Gestão de Usuários (ADMIN)"
+    ])
+
+    # ===============================
+    # PAINEL PRINCIPAL
+    # ===============================
+    with abas[0]:
+        painel.main(conn, cfg, user)
+
+    # ===============================
+    # ENVIO MANUAL DE ALERTAS (ADMIN)
+    # ===============================
+    # ===============================
+    # GESTÃO DE USUÁRIOS (ADMIN)
+    # ===============================
+    with abas[1]:
+        if user.get("role", "").lower() != "admin":
+            st.warning("🔒 Apenas administradores podem enviar alertas manualmente.")
+        else:
+            st.subheader("📤 Envio Manual de Alertas (ADMIN)")
 
-            # monta lista de até 3 produtos para exibir no alerta
-            produtos_preview = (
-                near_login["product_name"].dropna().unique().tolist()[:3]
-                if "product_name" in near_login.columns else []
-            )
-            resumo = ", ".join(produtos_preview) + ("..." if len(produtos_preview) >= 3 else "")
+            lojas = get_repository(conn).list_stores()
+            loja_opcoes = {f"{s[1]} (ID {s[0]})": s[0] for s in lojas}
 
-            st.toast(
-                f"⚠️ {total} item(ns) com validade a vencer em até {cfg.get('near_expiry_days', 15)} dia(s). "
-                f"Ex: {resumo or 'ver detalhes em 📋 Controle Operacional → A Vencer.'}",
-                icon="⚠️"
+            loja_sel = st.selectbox(
+                "Selecione a loja para enviar o alerta",
+                options=list(loja_opcoes.keys()),
+                key="alerta_loja_select"
             )
-            st.session_state[alert_key] = True
-    else:
-        st.sidebar.info("📦 Nenhum item de estoque encontrado ainda.")
-
-except Exception as e:
-    # Não quebra a página se algo falhar no alerta
-    st.sidebar.warning(f"Alerta de validade indisponível: {e}")
-
-# ===============================
-# ABAS PRINCIPAIS
-# ===============================
-abas = st.tabs([
-    "📊 Painel Principal",
-    "📤 Envio Manual de Alertas (ADMIN)",
-    "👥 Gestão de Usuários (ADMIN)"
-])
-
-# ===============================
-# PAINEL PRINCIPAL
-# ===============================
-with abas[0]:
-    painel.main(conn, cfg, user)
 
-# ===============================
-# ENVIO MANUAL DE ALERTAS (ADMIN)
-# ===============================
-# ===============================
-# GESTÃO DE USUÁRIOS (ADMIN)
-# ===============================
-with abas[1]:
-    if user.get("role", "").lower() != "admin":
-        st.warning("🔒 Apenas administradores podem enviar alertas manualmente.")
-    else:
-        st.subheader("📤 Envio Manual de Alertas (ADMIN)")
-
-        lojas = conn.execute("SELECT id, name FROM stores").fetchall()
-        loja_opcoes = {f"{s[1]} (ID {s[0]})": s[0] for s in lojas}
-
-        loja_sel = st.selectbox(
-            "Selecione a loja para enviar o alerta",
-            options=list(loja_opcoes.keys()),
-            key="alerta_loja_select"
-        )
-
-        if st.button("📤 Enviar alerta agora", key="btn_enviar_alerta_manual"):
-            store_id_alerta = loja_opcoes[loja_sel]
-            df_alerta = reporting.build_snapshots(conn)
-            df_alerta = df_alerta[df_alerta["store_id"] == store_id_alerta]
-            near_alerta = reporting.near_expiry(df_alerta, cfg["near_expiry_days"])
-
-            if near_alerta.empty:
-                st.info(f"Nenhum produto próximo da validade para a loja {loja_sel}.")
-            else:
-                near_body = reporting.to_console(
-                    near_alerta, f"Itens a vencer em {cfg['near_expiry_days']} dias"
+            if st.button("📤 Enviar alerta agora", key="btn_enviar_alerta_manual"):
+                store_id_alerta = loja_opcoes[loja_sel]
+                inicio, fim = reporting.near_expiry_window(cfg["near_expiry_days"])
+                df_alerta = reporting.build_snapshots(
+                    conn, store_id=store_id_alerta, expiry_from=inicio, expiry_to=fim
                 )
-                ok, info = bot.enviar_email_alerta(
-                    cfg, f"⚠️ Alerta: produtos a vencer — {loja_sel}", near_body
-                )
-                if ok:
-                    st.success(info)
-                else:
-                    st.error(f"❌ {info}")
-
-    st.subheader("👥 Lista de Usuários")
-    try:
-        df = list_users(conn)
-        if df is None or df.empty:
-            st.warning("Nenhum usuário cadastrado ainda.")
-        else:
-            stores_df = conn.execute("SELECT id, name FROM stores").fetchall()
-            store_map = {s[0]: s[1] for s in stores_df}
-            if "store_id" in df.columns:
-                df["Loja"] = df["store_id"].map(store_map).fillna("Sem loja vinculada")
-            else:
-                df["Loja"] = "Não vinculada"
-
-            st.dataframe(
-                df[["id", "username", "name", "email", "role", "is_active", "Loja", "created_at"]],
-                width="stretch"
-            )
-    except Exception as e:
-        st.error(f"Erro ao carregar usuários: {e}")
+                near_alerta = reporting.near_expiry(df_alerta, cfg["near_expiry_days"])
 
+                if near_alerta.empty:
+                    st.info(f"Nenhum produto próximo da validade para a loja {loja_sel}.")
+                else:
+                    near_body = reporting.to_console(
+                        near_alerta, f"Itens a vencer em {cfg['near_expiry_days']} dias"
+                    )
+                    if not config_lojas.config_loja(conn, cfg, store_id_alerta).get("alert_email", {}).get("enabled", False):
+                        st.warning(f"Envio de e-mails desativado para a loja {loja_sel}.")
+                    else:
+                        alert_id = outbox_alertas.enfileirar_alerta(
+                            conn, store_id_alerta, f"⚠️ Alerta: produtos a vencer — {loja_sel}", near_body
+                        )
+                        st.success(f"📥 Alerta #{alert_id} na fila de envio; o e-mail sai em segundo plano.")
 
-# ===============================
-# GESTÃO DE USUÁRIOS
-# ===============================
-# ===============================
-# GESTÃO DE USUÁRIOS (ADMIN)
-# ===============================
-with abas[2]:
-    st.write("🧩 Debug: Entrou na aba Gestão de Usuários", user)
-    try:
-        df = list_users(conn)
-        st.write("✅ DEBUG: usuários carregados:", len(df))
-    except Exception as e:
-        st.error(f"💥 Erro no list_users: {e}")
-        st.exception(e)
-        st.stop()
+            with st.expander("📬 Fila de envio de alertas"):
+                st.dataframe(get_repository(conn).alert_outbox(limit=20), use_container_width=True)
 
-    role = str(user.get("role", "")).strip().lower()
-    if role != "admin":
-        st.warning("🔒 Acesso restrito ao administrador.")
-    else:
+        st.subheader("👥 Lista de Usuários")
         try:
-            st.subheader("👥 Lista de Usuários")
-
             df = list_users(conn)
             if df is None or df.empty:
                 st.warning("Nenhum usuário cadastrado ainda.")
             else:
-                stores_df = conn.execute("SELECT id, name FROM stores").fetchall()
+                stores_df = get_repository(conn).list_stores()
                 store_map = {s[0]: s[1] for s in stores_df}
-
                 if "store_id" in df.columns:
-
                     df["Loja"] = df["store_id"].map(store_map).fillna("Sem loja vinculada")
                 else:
                     df["Loja"] = "Não vinculada"
@@ -413,101 +359,159 @@ with abas[2]:
                     df[["id", "username", "name", "email", "role", "is_active", "Loja", "created_at"]],
                     width="stretch"
                 )
+        except Exception as e:
+            st.error(f"Erro ao carregar usuários: {e}")
+
+
+    # ===============================
+    # GESTÃO DE USUÁRIOS
+    # ===============================
+    # ===============================
+    # GESTÃO DE USUÁRIOS (ADMIN)
+    # ===============================
+    with abas[2]:
+        st.write("🧩 Debug: Entrou na aba Gestão de Usuários", user)
+        try:
+            df = list_users(conn)
+            st.write("✅ DEBUG: usuários carregados:", len(df))
+        except Exception as e:
+            st.error(f"💥 Erro no list_users: {e}")
+            st.exception(e)
+            st.stop()
 
-            st.divider()
-            st.subheader("➕ Criar novo usuário")
-            with st.form("form_new_user"):
-                name = st.text_input("Nome completo")
-                email = st.text_input("E-mail")
-                username = st.text_input("Usuário (login)")
-                role = st.selectbox("Perfil", ["operador", "admin"])
+        role = str(user.get("role", "")).strip().lower()
+        if role != "admin":
+            st.warning("🔒 Acesso restrito ao administrador.")
+        else:
+            try:
+                st.subheader("👥 Lista de Usuários")
 
-                stores = conn.execute("SELECT id, name FROM stores").fetchall()
-                store_names = [s[1] for s in stores]
+                df = list_users(conn)
+                if df is None or df.empty:
+                    st.warning("Nenhum usuário cadastrado ainda.")
+                else:
+                    stores_df = get_repository(conn).list_stores()
+                    store_map = {s[0]: s[1] for s in stores_df}
 
-                col1, col2 = st.columns(2)
-                with col1:
-                    opcoes_lojas = store_names + ["➕ Criar nova loja"] if store_names else ["➕ Criar nova loja"]
-                    store_option = st.selectbox("Loja", opcoes_lojas, key="select_loja")
+                    if "store_id" in df.columns:
 
-                    if store_option == "➕ Criar nova loja":
-                        nova_loja = st.text_input("Digite o nome da nova loja:", key="nova_loja_input")
-                        store_sel = nova_loja.strip() if nova_loja.strip() else None
+                        df["Loja"] = df["store_id"].map(store_map).fillna("Sem loja vinculada")
                     else:
-                        store_sel = store_option if store_option else None
+                        df["Loja"] = "Não vinculada"
 
-                pwd = st.text_input("Senha", type="password")
-                pwd2 = st.text_input("Confirmar senha", type="password")
-                ok_new = st.form_submit_button("Criar usuário")
+                    st.dataframe(
+                        df[["id", "username", "name", "email", "role", "is_active", "Loja", "created_at"]],
+                        width="stretch"
+                    )
 
-            if ok_new:
-                if not (name and email and username and pwd and pwd2 and store_sel):
-                    st.error("Preencha todos os campos obrigatórios, incluindo a loja.")
-                elif pwd != pwd2:
-                    st.error("As senhas não conferem.")
-                else:
-                    try:
-                        pwd_hash = bcrypt.hashpw(pwd.encode("utf-8"), bcrypt.gensalt()).decode("utf-8")
-                        loja_existente = conn.execute("SELECT id FROM stores WHERE name=?", (store_sel,)).fetchone()
-                        if not loja_existente:
-                            conn.execute("INSERT INTO stores (name) VALUES (?)", (store_sel,))
-                            conn.commit()
-
-                        store_id = conn.execute("SELECT id FROM stores WHERE name=?", (store_sel,)).fetchone()[0]
-                        create_user(
-                            conn,
-                            username=username,
-                            name=name,
-                            email=email,
-                            pwd_hash=pwd_hash,
-                            role=role,
-                            is_active=1,
-                            store_id=store_id
-                        )
-                        st.success(f"Usuário '{username}' criado e vinculado à loja '{store_sel}'.")
-                        st.rerun()
-                    except Exception as e:
-                        st.error(f"Erro ao criar usuário: {e}")
-
-            st.divider()
-            st.subheader("✏️ Alterar perfil / Ativar ou Desativar usuário")
-            col1, col2, col3 = st.columns(3)
-            with col1:
-                u_sel = st.text_input("Usuário (login) para alterar")
-            with col2:
-                novo_role = st.selectbox("Novo perfil", ["operador", "admin"])
-            with col3:
-                ativo = st.checkbox("Ativo", value=True)
-
-            colA, colB = st.columns(2)
-            if colA.button("Salvar alterações"):
-                try:
-                    update_user_role(conn, u_sel, novo_role)
-                    update_user_status(conn, u_sel, 1 if ativo else 0)
-                    st.success("Alterações salvas com sucesso.")
-                except Exception as e:
-                    st.error(f"Erro: {e}")
-
-            st.divider()
-            st.subheader("🔒 Redefinir senha de usuário")
-            with st.form("form_reset_pwd"):
-                u_pwd = st.text_input("Usuário (login)")
-                npwd = st.text_input("Nova senha", type="password")
-                npwd2 = st.text_input("Confirmar nova senha", type="password")
-                ok_pwd = st.form_submit_button("Atualizar senha")
-
-            if ok_pwd:
-                if not (u_pwd and npwd and npwd2):
-                    st.error("Preencha todos os campos.")
-                elif npwd != npwd2:
-                    st.error("As senhas não conferem.")
-                else:
+                st.divider()
+                st.subheader("➕ Criar novo usuário")
+                with st.form("form_new_user"):
+                    name = st.text_input("Nome completo")
+                    email = st.text_input("E-mail")
+                    username = st.text_input("Usuário (login)")
+                    role = st.selectbox("Perfil", ["operador", "admin"])
+
+                    stores = get_repository(conn).list_stores()
+                    store_names = [s[1] for s in stores]
+
+                    col1, col2 = st.columns(2)
+                    with col1:
+                        opcoes_lojas = store_names + ["➕ Criar nova loja"] if store_names else ["➕ Criar nova loja"]
+                        store_option = st.selectbox("Loja", opcoes_lojas, key="select_loja")
+
+                        if store_option == "➕ Criar nova loja":
+                            nova_loja = st.text_input("Digite o nome da nova loja:", key="nova_loja_input")
+                            store_sel = nova_loja.strip() if nova_loja.strip() else None
+                        else:
+                            store_sel = store_option if store_option else None
+
+                    pwd = st.text_input("Senha", type="password")
+                    pwd2 = st.text_input("Confirmar senha", type="password")
+                    ok_new = st.form_submit_button("Criar usuário")
+
+                if ok_new:
+                    if not (name and email and username and pwd and pwd2 and store_sel):
+                        st.error("Preencha todos os campos obrigatórios, incluindo a loja.")
+                    elif pwd != pwd2:
+                        st.error("As senhas não conferem.")
+                    else:
+                        try:
+                            pwd_hash = bcrypt.hashpw(pwd.encode("utf-8"), bcrypt.gensalt()).decode("utf-8")
+                            repo = get_repository(conn)
+                            store_id = repo.get_or_create_store(store_sel)
+                            repo.commit()
+                            create_user(
+                                conn,
+                                username=username,
+                                name=name,
+                                email=email,
+                                pwd_hash=pwd_hash,
+                                role=role,
+                                is_active=1,
+                                store_id=store_id
+                            )
+                            st.success(f"Usuário '{username}' criado e vinculado à loja '{store_sel}'.")
+                            st.rerun()
+                        except Exception as e:
+                            st.error(f"Erro ao criar usuário: {e}")
+
+                st.divider()
+                st.subheader("✏️ Alterar perfil / Ativar ou Desativar usuário")
+                col1, col2, col3 = st.columns(3)
+                with col1:
+                    u_sel = st.text_input("Usuário (login) para alterar")
+                with col2:
+                    novo_role = st.selectbox("Novo perfil", ["operador", "admin"])
+                with col3:
+                    ativo = st.checkbox("Ativo", value=True)
+
+                colA, colB = st.columns(2)
+                if colA.button("Salvar alterações"):
                     try:
-                        h = bcrypt.hashpw(npwd.encode("utf-8"), bcrypt.gensalt()).decode("utf-8")
-                        update_user_password(conn, u_pwd, h)
-                        st.success("Senha atualizada com sucesso.")
+                        update_user_role(conn, u_sel, novo_role)
+                        update_user_status(conn, u_sel, 1 if ativo else 0)
+                        st.success("Alterações salvas com sucesso.")
                     except Exception as e:
                         st.error(f"Erro: {e}")
-        except Exception as e:
-            st.error(f"Erro ao renderizar Gestão de Usuários: {e}")
-            st.exception(e)
+
+                st.divider()
+                st.subheader("🔒 Redefinir senha de usuário")
+                with st.form("form_reset_pwd"):
+                    u_pwd = st.text_input("Usuário (login)")
+                    npwd = st.text_input("Nova senha", type="password")
+                    npwd2 = st.text_input("Confirmar nova senha", type="password")
+                    ok_pwd = st.form_submit_button("Atualizar senha")
+
+                if ok_pwd:
+                    if not (u_pwd and npwd and npwd2):
+                        st.error("Preencha todos os campos.")
+                    elif npwd != npwd2:
+                        st.error("As senhas não conferem.")
+                    else:
+                        try:
+                            h = bcrypt.hashpw(npwd.encode("utf-8"), bcrypt.gensalt()).decode("utf-8")
+                            update_user_password(conn, u_pwd, h)
+                            st.success("Senha atualizada com sucesso.")
+                        except Exception as e:
+                            st.error(f"Erro: {e}")
+            except Exception as e:
+                st.error(f"Erro ao renderizar Gestão de Usuários: {e}")
+                st.exception(e)
+
+
+# ===============================
+# EXECUÇÃO: uma conexão do pool por rerun
+# ===============================
+with connection() as conn:
+    init_db(conn)  # a DDL só roda na primeira execução do processo
+    try:
+        # config_loja_{id}.json -> store_settings (só na primeira execução do processo)
+        n = config_lojas.migrar_configs_json(conn)
+        if n:
+            print(f"🗂️ Configuração de {n} loja(s) migrada(s) dos JSON para store_settings.")
+    except Exception as e:
+        print("⚠️ Erro ao migrar configurações das lojas:", e)
+    # Worker da fila de alertas: uma thread por processo, com conexão própria
+    outbox_alertas.iniciar_worker(get_conn, lambda c, store_id: config_lojas.config_loja(c, cfg, store_id))
+    main(conn)
@@ -0,0 +1,945 @@
+# benchmarks.py
+"""
+Benchmarks reproduzíveis dos caminhos pesados do Expiry Bot.
+
+Uso:
+    python src/benchmarks.py importacao --linhas 100000
+    python src/benchmarks.py memoria --linhas 100000 400000
+    python src/benchmarks.py nfe --itens 5000
+    python src/benchmarks.py nfe-aplicar --itens 300
+    python src/benchmarks.py movimentos --linhas 5000
+    python src/benchmarks.py concorrencia --threads 16 --estoque 500 [--postgres]
+    python src/benchmarks.py kpis --linhas 1000000 --lojas 50
+    python src/benchmarks.py rollup --linhas 2000000 --lojas 5 --eans 50
+    python src/benchmarks.py explain [--postgres]
+    python src/benchmarks.py alertas --lojas 50 --itens 2000
+    python src/benchmarks.py relatorios --lojas 50 --itens 20
+    python src/benchmarks.py relatorio-completo --lotes 100000
+    python src/benchmarks.py email --mensagens 50
+"""
+import argparse
+import multiprocessing
+import random
+import re
+import resource
+import tempfile
+import threading
+import time
+import xml.etree.ElementTree as ET
+from datetime import date, timedelta
+from pathlib import Path
+
+import pandas as pd
+
+from db import get_conn, init_db
+import expiry_bot as bot
+import nfe_import
+import reporting
+from repository import get_repository
+
+
+def _gerar_planilha(caminho, linhas, seed=42):
+    """Gera um CSV sintético de inventário com ~10 linhas por produto."""
+    rnd = random.Random(seed)
+    hoje = date.today()
+    n_produtos = max(1, linhas // 10)
+    df = pd.DataFrame({
+        "ean": [f"789{rnd.randrange(n_produtos):010d}" for _ in range(linhas)],
+        "nome_produto": [f"Produto {i % n_produtos}" for i in range(linhas)],
+        "lote": [f"L{rnd.randrange(20):03d}" for _ in range(linhas)],
+        "validade": [(hoje + timedelta(days=rnd.randrange(-10, 180))).isoformat() for _ in range(linhas)],
+        "quantidade": [rnd.randrange(0, 50) for _ in range(linhas)],
+        "local": [f"Gondola {rnd.randrange(5)}" for _ in range(linhas)],
+    })
+    df.to_csv(caminho, index=False)
+    return caminho
+
+
+def _estado(conn):
+    """Resumo comparável do banco após a importação."""
+    cur = conn.cursor()
+    return tuple(
+        cur.execute(q).fetchall()
+        for q in (
+            "SELECT ean, product_name FROM products ORDER BY ean",
+            "SELECT ean, lot, expiry_date FROM lots ORDER BY ean, lot",
+            "SELECT ean, lot, qty, location, store_id FROM stock ORDER BY ean, lot, location",
+            "SELECT COUNT(*), SUM(qty) FROM movements",
+        )
+    )
+
+
+def bench_importacao(linhas):
+    with tempfile.TemporaryDirectory() as tmp:
+        csv_path = _gerar_planilha(str(Path(tmp) / "inventario.csv"), linhas)
+        estados = {}
+        for modo, bulk in (("por linha", False), ("em lote", True)):
+            conn = get_conn(str(Path(tmp) / f"bench_{int(bulk)}.db"))
+            init_db(conn)
+            conn.execute("INSERT INTO stores(name) VALUES('Bench')")
+            conn.commit()
+            t0 = time.perf_counter()
+            bot.importar_planilha(conn, csv_path, store_id=1, bulk=bulk)
+            dt = time.perf_counter() - t0
+            estados[modo] = _estado(conn)
+            conn.close()
+            print(f"importar_planilha ({modo:9}): {linhas} linhas em {dt:6.2f}s -> {linhas / dt:10,.0f} linhas/s")
+        print("Resultados idênticos:", estados["por linha"] == estados["em lote"])
+
+
+def _zerar_pico_rss():
+    """Zera o pico de RSS do processo (Linux); o filho herda o pico do pai no fork."""
+    try:
+        Path("/proc/self/clear_refs").write_text("5")
+    except OSError:
+        pass
+
+
+def _pico_rss_mb():
+    try:
+        for linha in Path("/proc/self/status").read_text().splitlines():
+            if linha.startswith("VmHWM:"):
+                return int(linha.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _pico_rss_importacao(args):
+    """Executa uma importação num processo novo e devolve o pico de RSS (MB)."""
+    csv_path, db_path, em_blocos = args
+    _zerar_pico_rss()
+    conn = get_conn(db_path)
+    init_db(conn)
+    conn.execute("INSERT INTO stores(name) VALUES('Bench')")
+    conn.commit()
+    if em_blocos:
+        bot.importar_planilha_em_blocos(conn, csv_path, store_id=1)
+    else:
+        bot.importar_planilha(conn, csv_path, store_id=1)
+    conn.close()
+    return _pico_rss_mb()
+
+
+def bench_memoria(tamanhos):
+    ctx = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as tmp:
+        for linhas in tamanhos:
+            csv_path = _gerar_planilha(str(Path(tmp) / f"inventario_{linhas}.csv"), linhas)
+            for modo, em_blocos in (("arquivo inteiro", False), ("em blocos", True)):
+                db_path = str(Path(tmp) / f"mem_{linhas}_{int(em_blocos)}.db")
+                with ctx.Pool(1) as pool:
+                    pico = pool.apply(_pico_rss_importacao, ((csv_path, db_path, em_blocos),))
+                print(f"{linhas:>9} linhas ({modo:15}): pico de RSS {pico:8.1f} MB")
+
+
+def _gerar_nfe(caminho, itens, seed=42):
+    """Gera uma NF-e (nfeProc) sintética com N itens; metade com <rastro> (lote e validade)."""
+    rnd = random.Random(seed)
+    hoje = date.today()
+    ncms = ["04012010", "19053100", "22021000", "33051000", "02071400", "85171231"]
+    dets = []
+    for i in range(1, itens + 1):
+        ean = f"789{rnd.randrange(10**10):010d}"
+        rastro = ""
+        if i % 2:
+            validade = (hoje + timedelta(days=rnd.randrange(5, 365))).isoformat()
+            rastro = (f"<rastro><nLote>L{i:05d}</nLote><qLote>{rnd.randrange(1, 99)}.000</qLote>"
+                      f"<dFab>{hoje.isoformat()}</dFab><dVal>{validade}</dVal></rastro>")
+        dets.append(
+            f'<det nItem="{i}"><prod><cProd>{i:06d}</cProd><cEAN>{ean}</cEAN>'
+            f"<xProd>PRODUTO SINTETICO {i}</xProd><NCM>{rnd.choice(ncms)}</NCM><CFOP>5102</CFOP>"
+            f"<uCom>UN</uCom><qCom>{rnd.randrange(1, 99)}.0000</qCom><vUnCom>9.90</vUnCom>"
+            f"<cEANTrib>{ean}</cEANTrib>{rastro}</prod>"
+            f"<imposto><ICMS><ICMS00><orig>0</orig><CST>00</CST></ICMS00></ICMS></imposto></det>"
+        )
+    Path(caminho).write_text(
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<nfeProc xmlns="http://www.portalfiscal.inf.br/nfe" versao="4.00"><NFe><infNFe Id="NFe1" versao="4.00">'
+        "<ide><cUF>35</cUF><nNF>1</nNF></ide><emit><xNome>DISTRIBUIDORA</xNome></emit>"
+        + "".join(dets)
+        + "<total><ICMSTot><vNF>0</vNF></ICMSTot></total></infNFe></NFe></nfeProc>",
+        encoding="utf-8",
+    )
+    return caminho
+
+
+def _parse_nfe_xml_etree(xml_path: str):
+    """Parser original de nfe_import (ElementTree + findtext por campo), referência do benchmark nfe."""
+    try:
+        root = ET.parse(xml_path).getroot()
+    except Exception as e:
+        raise ValueError(f"Erro ao ler o XML: {e}")
+
+    ns = root.tag.split("}")[0].strip("{") if root.tag.startswith("{") else ""
+    nsmap = {"ns": ns} if ns else {}
+    pereciveis_prefix = sorted(nfe_import.PREFIXOS_PERECIVEIS)
+
+    items = []
+    for det in root.findall(".//ns:det", nsmap):
+        prod = det.find("ns:prod", nsmap)
+        if prod is None:
+            continue
+        ean = (prod.findtext("ns:cProd", namespaces=nsmap) or "").strip()
+        name = (prod.findtext("ns:xProd", namespaces=nsmap) or "").strip()
+        qty = float(prod.findtext("ns:qCom", namespaces=nsmap) or 0)
+        lot = (
+            prod.findtext("ns:nLote", namespaces=nsmap)
+            or f"LOTE-{ean[-4:]}" if ean else "SEMLOTE"
+        )
+        expiry = (
+            prod.findtext("ns:dVal", namespaces=nsmap)
+            or prod.findtext("ns:dVenc", namespaces=nsmap)
+            or ""
+        )
+        ncm = (prod.findtext("ns:NCM", namespaces=nsmap) or "").strip()
+        if not expiry and not any(ncm.startswith(p) for p in pereciveis_prefix):
+            continue
+        if expiry:
+            expiry = expiry.split("T")[0]
+        items.append({"ean": ean, "product_name": name, "lot": lot,
+                      "expiry_date": expiry, "qty": qty, "ncm": ncm})
+
+    df = pd.DataFrame(items)
+    if df.empty:
+        return pd.DataFrame(columns=nfe_import.COLUNAS_NFE)
+    df = df[nfe_import.COLUNAS_NFE]
+    df["expiry_date"] = pd.to_datetime(df["expiry_date"], errors="coerce")
+    return df
+
+
+def bench_nfe(itens, repeticoes=5):
+    with tempfile.TemporaryDirectory() as tmp:
+        xml_path = _gerar_nfe(str(Path(tmp) / "nfe.xml"), itens)
+        tamanho = Path(xml_path).stat().st_size / 1024 / 1024
+        print(f"NF-e sintética: {itens} itens, {tamanho:.1f} MB")
+        for modo, parser in (("ElementTree", _parse_nfe_xml_etree),
+                             ("lxml iterparse", nfe_import.parse_nfe_xml)):
+            tempos = []
+            for _ in range(repeticoes):
+                t0 = time.perf_counter()
+                df = parser(xml_path)
+                tempos.append(time.perf_counter() - t0)
+            melhor = min(tempos)
+            print(f"{modo:15}: {len(df):5} linhas em {melhor * 1000:8.1f} ms -> {itens / melhor:10,.0f} itens/s")
+
+
+def _contagens(conn):
+    return tuple(
+        conn.execute(q).fetchone()
+        for q in (
+            "SELECT COUNT(*) FROM products",
+            "SELECT COUNT(*) FROM lots",
+            "SELECT COUNT(*), SUM(qty) FROM stock",
+            "SELECT COUNT(*), SUM(qty) FROM movements",
+        )
+    )
+
+
+def _aplicar_nfe_por_item(conn, df_nfe, store_id):
+    """Caminho antigo do painel: produtos/lotes com commit e depois um movimentar (com commit) por item."""
+    repo = get_repository(conn)
+    for row in df_nfe.itertuples(index=False):
+        repo.upsert_products([(row.ean, row.product_name)])
+        repo.upsert_lots([(row.ean, row.lot, row.expiry_date)])
+    conn.commit()
+    for row in df_nfe.itertuples(index=False):
+        bot.movimentar(conn, "receipt", row.ean, row.lot, int(round(row.qty)),
+                       observacao="Importado via NF-e", local=f"Loja {store_id}", store_id=store_id)
+
+
+def bench_nfe_aplicar(itens):
+    with tempfile.TemporaryDirectory() as tmp:
+        xml_path = _gerar_nfe(str(Path(tmp) / "nfe.xml"), itens)
+        df_nfe = nfe_import.parse_nfe_xml(xml_path)
+        df_nfe = df_nfe[df_nfe["qty"].round() > 0]
+        estados = {}
+        for modo in ("por item", "transação"):
+            conn = get_conn(str(Path(tmp) / f"aplicar_{len(estados)}.db"))
+            init_db(conn)
+            conn.execute("INSERT INTO stores(name) VALUES('Bench')")
+            conn.commit()
+            t0 = time.perf_counter()
+            if modo == "por item":
+                _aplicar_nfe_por_item(conn, df_nfe, 1)
+            else:
+                bot.aplicar_nfe(conn, df_nfe, store_id=1)
+            dt = time.perf_counter() - t0
+            estados[modo] = _contagens(conn)
+            print(f"NF-e {len(df_nfe)} itens ({modo:9}): {dt * 1000:8.1f} ms")
+            if modo == "transação":
+                # falha injetada no último movimento: nada da nota pode ficar gravado
+                antes = _contagens(conn)
+                conn.execute(f"""
+                    CREATE TRIGGER trg_bench_falha BEFORE INSERT ON movements
+                    WHEN NEW.ean = '{df_nfe["ean"].iloc[-1]}'
+                    BEGIN SELECT RAISE(ABORT, 'falha injetada'); END
+                """)
+                try:
+                    bot.aplicar_nfe(conn, df_nfe, store_id=1, chave="bench-rollback", origem="nfe.xml")
+                except Exception:
+                    pass
+                nfe_doc = conn.execute("SELECT COUNT(*) FROM nfe_documents").fetchone()[0]
+                print("Rollback completo após falha:", _contagens(conn) == antes and nfe_doc == 0)
+            conn.close()
+        print("Resultados idênticos:", estados["por item"] == estados["transação"])
+
+
+def bench_movimentos(linhas, seed=42):
+    """Fechamento de PDV sintético: entradas e vendas em 200 lotes, por linha vs. movimentar_lote."""
+    rnd = random.Random(seed)
+    lotes = [(f"789{i:010d}", f"L{i % 7}") for i in range(200)]
+    movs = [("receipt", e, l, 500, "carga inicial", None, 1) for e, l in lotes]
+    movs += [
+        (rnd.choice(("sale", "sale", "receipt")), *rnd.choice(lotes), rnd.randrange(1, 5), "PDV", None, 1)
+        for _ in range(linhas - len(movs))
+    ]
+    with tempfile.TemporaryDirectory() as tmp:
+        estados = {}
+        for modo in ("por linha", "em lote"):
+            conn = get_conn(str(Path(tmp) / f"mov_{len(estados)}.db"))
+            init_db(conn)
+            conn.execute("INSERT INTO stores(name) VALUES('Bench')")
+            conn.executemany("INSERT INTO products(ean, product_name) VALUES(?, 'Produto')", {(e,) for e, _ in lotes})
+            conn.executemany("INSERT INTO lots(ean, lot, expiry_date) VALUES(?, ?, '2030-01-01')", lotes)
+            conn.commit()
+            t0 = time.perf_counter()
+            if modo == "por linha":
+                erros = 0
+                for m in movs:
+                    try:
+                        bot.movimentar(conn, *m)
+                    except ValueError:
+                        erros += 1
+            else:
+                erros = int((bot.movimentar_lote(conn, movs)["status"] == "erro").sum())
+            dt = time.perf_counter() - t0
+            estados[modo] = _contagens(conn)
+            conn.close()
+            print(f"{len(movs)} movimentos ({modo:9}): {dt * 1000:8.1f} ms, {erros} rejeitado(s)")
+        print("Resultados idênticos:", estados["por linha"] == estados["em lote"])
+
+
+def bench_concorrencia(threads, estoque, postgres=False):
+    """
+    Várias threads (cada uma com sua conexão) vendendo 1 unidade do mesmo lote até
+    esgotar, com entradas ocasionais. Invariantes verificados no fim:
+    saldo >= 0, saldo = estoque + entradas - vendas aceitas e um movimento por operação aceita.
+    """
+    ean, lot = "7890000000001", "LCONC"
+    with tempfile.TemporaryDirectory() as tmp:
+        if postgres:
+            import db_supabase
+
+            def conectar():
+                return db_supabase.get_conn()
+            init = db_supabase.init_db
+        else:
+            db_path = str(Path(tmp) / "concorrencia.db")
+
+            def conectar():
+                return get_conn(db_path)
+            init = init_db
+
+        conn = conectar()
+        init(conn)
+        repo = get_repository(conn)
+        store_id = repo.get_or_create_store(f"Concorrência {ean}")
+        repo.upsert_products([(ean, "Produto concorrência")])
+        repo.upsert_lots([(ean, lot, "2030-01-01")])
+        repo.commit()
+        for tabela in ("movements", "stock"):
+            repo._execute(f"DELETE FROM {tabela} WHERE ean = ?", (ean,))
+        repo.commit()
+        bot.movimentar(conn, "receipt", ean, lot, estoque, local="Loja", store_id=store_id)
+
+        aceitas = {"sale": 0, "receipt": 0}
+        rejeitadas = [0]
+        trava = threading.Lock()
+        barreira = threading.Barrier(threads)
+
+        def operador(n):
+            c = conectar()
+            rnd = random.Random(n)
+            barreira.wait()
+            falhas_seguidas = 0
+            while falhas_seguidas < 3:
+                tipo = "receipt" if rnd.random() < 0.05 else "sale"
+                try:
+                    bot.movimentar(c, tipo, ean, lot, 1, local="Loja", store_id=store_id)
+                    with trava:
+                        aceitas[tipo] += 1
+                    falhas_seguidas = 0
+                except ValueError:
+                    with trava:
+                        rejeitadas[0] += 1
+                    falhas_seguidas += 1
+            c.close()
+
+        t0 = time.perf_counter()
+        ts = [threading.Thread(target=operador, args=(n,)) for n in range(threads)]
+        for t in ts:
+            t.start()
+        for t in ts:
+            t.join()
+        dt = time.perf_counter() - t0
+
+        saldo = repo.fetchone("SELECT qty FROM stock WHERE ean = ? AND lot = ?", (ean, lot))[0]
+        movs = {t: n for t, n in repo.fetchall("SELECT type, COUNT(*) FROM movements WHERE ean = ? GROUP BY type", (ean,))}
+        conn.close()
+
+        esperado = estoque + aceitas["receipt"] - aceitas["sale"]
+        total_ops = aceitas["sale"] + aceitas["receipt"]
+        print(f"{threads} threads ({'postgres' if postgres else 'sqlite'}): {total_ops} operações aceitas, "
+              f"{rejeitadas[0]} rejeitadas por falta de estoque em {dt:.2f}s")
+        print(f"saldo final={saldo} esperado={esperado}")
+        checks = {
+            "saldo nunca negativo": saldo >= 0,
+            "sem atualização perdida": saldo == esperado,
+            "um movimento por venda aceita": movs.get("sale", 0) == aceitas["sale"],
+            "um movimento por entrada aceita": movs.get("receipt", 0) == aceitas["receipt"] + 1,
+        }
+        for nome, ok in checks.items():
+            print(f"{'✅' if ok else '❌'} {nome}")
+        if not all(checks.values()):
+            raise SystemExit(1)
+
+
+def _gerar_movimentos(conn, linhas, lojas, dias, eans=5000, seed=42):
+    """Histórico sintético de movimentos (sem estoque): `lojas` lojas, `eans` produtos, últimos `dias` dias."""
+    rnd = random.Random(seed)
+    inicio = date.today() - timedelta(days=dias)
+    if not conn.execute("SELECT 1 FROM stores").fetchone():
+        conn.executemany("INSERT INTO stores(name) VALUES(?)", [(f"Loja {i}",) for i in range(lojas)])
+    conn.executemany(
+        "INSERT INTO movements(ts, type, ean, lot, qty, note, store_id) VALUES(?, ?, ?, 'L1', ?, 'bench', ?)",
+        (
+            (
+                (inicio + timedelta(days=rnd.randrange(dias + 1))).isoformat() + " 10:00:00",
+                rnd.choice(("receipt", "sale", "sale", "adjustment")),
+                f"789{rnd.randrange(eans):010d}",
+                rnd.randrange(1, 20),
+                rnd.randrange(1, lojas + 1),
+            )
+            for _ in range(linhas)
+        ),
+    )
+    conn.commit()
+    conn.execute("ANALYZE")
+
+
+def bench_kpis(linhas, lojas, seed=42, repeticoes=5):
+    """
+    Totais de movimentos de uma loja: SELECT * + filtro no pandas (painel antigo)
+    vs. SUM ... GROUP BY type no banco (reporting.kpis), com e sem período.
+    """
+    inicio = date.today() - timedelta(days=365)
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = get_conn(str(Path(tmp) / "kpis.db"))
+        init_db(conn)
+        _gerar_movimentos(conn, linhas, lojas, dias=365, seed=seed)
+        repo = get_repository(conn)
+        store_id = lojas // 2
+
+        def antigo():
+            mov = repo.query_df("SELECT * FROM movements WHERE store_id = ?", (store_id,), parse_dates=["ts"])
+            return {t: int(mov[mov["type"] == t]["qty"].sum()) for t in ("receipt", "sale", "adjustment")}
+
+        def novo():
+            return repo.movement_totals(store_id)
+
+        resultados = {}
+        for nome, fn in (("SELECT * + pandas", antigo), ("SUM ... GROUP BY", novo)):
+            tempos = []
+            for _ in range(repeticoes):
+                t0 = time.perf_counter()
+                resultados[nome] = fn()
+                tempos.append(time.perf_counter() - t0)
+            print(f"{linhas} movimentos / {lojas} lojas ({nome:17}): {min(tempos) * 1000:8.1f} ms")
+        print("Resultados idênticos:", resultados["SELECT * + pandas"] == resultados["SUM ... GROUP BY"])
+
+        t0 = time.perf_counter()
+        repo.movement_totals(store_id, ts_from=date.today() - timedelta(days=30), ts_to=date.today() + timedelta(days=1))
+        print(f"Últimos 30 dias (SUM ... GROUP BY): {(time.perf_counter() - t0) * 1000:8.1f} ms")
+
+        plano = conn.execute(
+            "EXPLAIN QUERY PLAN SELECT type, SUM(qty) FROM movements WHERE store_id = ? AND ts >= ? GROUP BY type",
+            (store_id, inicio.isoformat()),
+        ).fetchall()
+        for linha in plano:
+            print("  plano:", linha[-1])
+        conn.close()
+
+
+def bench_rollup(linhas, lojas, eans, anos=3, seed=42):
+    """
+    Tendência mensal de uma loja: GROUP BY mês direto em movements vs. leitura do
+    rollup movements_daily; mais o custo da reconstrução completa e da atualização incremental.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = get_conn(str(Path(tmp) / "rollup.db"))
+        init_db(conn)
+        _gerar_movimentos(conn, linhas, lojas, dias=365 * anos, eans=eans, seed=seed)
+        store_id = lojas // 2
+        meses = 12 * anos
+
+        t0 = time.perf_counter()
+        reporting.refresh_movements_daily(conn, full=True)
+        print(f"Reconstrução completa ({linhas} movimentos): {(time.perf_counter() - t0) * 1000:8.1f} ms")
+
+        _gerar_movimentos(conn, 1_000, lojas, dias=1, eans=eans, seed=seed + 1)
+        t0 = time.perf_counter()
+        n = reporting.refresh_movements_daily(conn)
+        print(f"Incremental ({n} movimentos novos):      {(time.perf_counter() - t0) * 1000:8.1f} ms")
+
+        inicio = (pd.Timestamp.today().normalize().replace(day=1) - pd.DateOffset(months=meses - 1)).date().isoformat()
+
+        def bruto():
+            return pd.read_sql_query(
+                "SELECT substr(ts, 1, 7) AS mes, type, SUM(qty) AS qty FROM movements"
+                " WHERE store_id = ? AND ts >= ? GROUP BY mes, type",
+                conn, params=(store_id, inicio),
+            )
+
+        def rollup():
+            return reporting.monthly_trend(conn, store_id=store_id, months=meses)
+
+        for nome, fn in (("movements (bruto)", bruto), ("movements_daily", rollup)):
+            tempos = []
+            for _ in range(5):
+                t0 = time.perf_counter()
+                res = fn()
+                tempos.append(time.perf_counter() - t0)
+            print(f"Tendência de {meses} meses ({nome:17}): {min(tempos) * 1000:8.1f} ms")
+            if nome == "movements (bruto)":
+                esperado = res.groupby("type")["qty"].sum().to_dict()
+        obtido = res[["recebido", "vendido", "ajustado"]].sum().to_dict()
+        print("Resultados idênticos:", obtido == {
+            "recebido": esperado.get("receipt", 0), "vendido": esperado.get("sale", 0),
+            "ajustado": esperado.get("adjustment", 0),
+        })
+        conn.close()
+
+
+# tabelas que podem ser varridas: minúsculas ou temporárias da própria consulta
+_SCAN_PERMITIDO = {"stores", "rollup_state", "schema_migrations", "_mov_lote", "m"}
+
+
+def _consultas_quentes(conn, store_id, ean, lot):
+    """Executa uma vez cada caminho quente, sempre filtrando por loja."""
+    hoje = date.today()
+    reporting.build_snapshots(conn, store_id=store_id)
+    reporting.build_snapshots(conn, store_id=store_id, expiry_from=hoje, expiry_to=hoje + timedelta(days=15))
+    reporting.build_snapshots(conn, store_id=store_id, ean=[ean])
+    reporting.expiry_buckets(conn, store_id=store_id)
+    bot.movimentar(conn, "receipt", ean, lot, 10, local="Loja", store_id=store_id)
+    bot.movimentar(conn, "sale", ean, lot, 1, local="Loja", store_id=store_id)
+    bot.movimentar_lote(conn, [
+        ("receipt", ean, lot, 2, "explain", "Loja", store_id),
+        ("sale", ean, lot, 1, "explain", "Loja", store_id),
+    ])
+    reporting.kpis(conn, store_id, hoje - timedelta(days=30), hoje)
+    reporting.refresh_movements_daily(conn)
+    reporting.monthly_trend(conn, store_id=store_id)
+
+
+def _varreduras_sqlite(conn, comandos):
+    varreduras = []
+    for sql in dict.fromkeys(comandos):
+        if not sql.lstrip().upper().startswith(("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")):
+            continue
+        plano = [linha[-1] for linha in conn.execute("EXPLAIN QUERY PLAN " + sql).fetchall()]
+        # a saída de views/subconsultas (CO-ROUTINE) é varrida em memória; as tabelas
+        # por trás delas aparecem em linhas próprias do plano
+        rotinas = {d.split()[1] for d in plano if d.startswith("CO-ROUTINE ")}
+        for detalhe in plano:
+            tabela = detalhe.split()[1] if detalhe.startswith("SCAN ") else None
+            if (tabela and " USING " not in detalhe and tabela != "CONSTANT"
+                    and tabela not in _SCAN_PERMITIDO and tabela not in rotinas):
+                varreduras.append((detalhe, sql))
+    return varreduras
+
+
+def _varreduras_postgres(conn, comandos):
+    varreduras = []
+    with conn.cursor() as cur:
+        cur.execute("SET enable_seqscan = off")  # só sobra Seq Scan onde nenhum índice serve
+        for sql in dict.fromkeys(comandos):
+            if not sql.lstrip().upper().startswith(("EXECUTE", "SELECT", "INSERT", "UPDATE", "DELETE", "WITH")):
+                continue
+            cur.execute("EXPLAIN " + sql)
+            for linha in cur.fetchall():
+                m = re.search(r"Seq Scan on (\w+)", linha["QUERY PLAN"])
+                if m and m.group(1) not in _SCAN_PERMITIDO:
+                    varreduras.append((linha["QUERY PLAN"].strip(), sql))
+        cur.execute("RESET enable_seqscan")
+    conn.rollback()
+    return varreduras
+
+
+def bench_explain(postgres=False):
+    """
+    Roda build_snapshots, expiry_buckets, movimentar(_lote), kpis e o rollup de uma
+    loja registrando cada SQL executado e faz EXPLAIN de todos: falha (exit 1) se
+    algum plano varrer uma tabela inteira.
+    """
+    ean, lot = "7890000000017", "LEXPLAIN"
+    comandos = []
+    with tempfile.TemporaryDirectory() as tmp:
+        if postgres:
+            import psycopg2.extras
+            import db_supabase
+
+            class _Registro:
+                def write(self, msg):
+                    comandos.append(msg.decode() if isinstance(msg, bytes) else msg)
+
+            class _Cursor(psycopg2.extras.LoggingCursor, psycopg2.extras.RealDictCursor):
+                pass
+
+            args, kwargs = db_supabase._connect_args()
+            kwargs["cursor_factory"] = _Cursor
+            conn = psycopg2.connect(*args, connection_factory=psycopg2.extras.LoggingConnection, **kwargs)
+            conn.initialize(_Registro())
+            db_supabase.init_db(conn, force=True)
+        else:
+            conn = get_conn(str(Path(tmp) / "explain.db"))
+            init_db(conn)
+
+        repo = get_repository(conn)
+        store_id = repo.get_or_create_store("Explain")
+        repo.upsert_products([(ean, "Produto explain")])
+        repo.upsert_lots([(ean, lot, "2030-01-01")])
+        repo.commit()
+
+        comandos.clear()
+        if not postgres:
+            conn.set_trace_callback(comandos.append)
+        _consultas_quentes(conn, store_id, ean, lot)
+        if not postgres:
+            conn.set_trace_callback(None)
+
+        # PREPARE/EXECUTE: o EXPLAIN vai no EXECUTE, com os parâmetros reais;
+        # execute_batch registra vários comandos separados por ";" em uma só mensagem
+        comandos = [
+            c.strip().rstrip(";")
+            for msg in comandos if not msg.lstrip().startswith("--")
+            for c in re.split(r";\s*(?=EXECUTE\b)", msg) if c.strip()
+        ]
+        varreduras = (_varreduras_postgres if postgres else _varreduras_sqlite)(conn, comandos)
+        conn.close()
+
+    print(f"{len(set(comandos))} comandos distintos analisados ({'postgres' if postgres else 'sqlite'})")
+    for detalhe, sql in varreduras:
+        print(f"❌ {detalhe}\n   {' '.join(sql.split())[:200]}")
+    if varreduras:
+        raise SystemExit(1)
+    print("✅ nenhuma varredura completa nas consultas quentes")
+
+
+def bench_alertas(lojas, itens, seed=42, repeticoes=3):
+    """
+    Leitura do estoque na rodada de alertas: um build_snapshots por loja (rodada
+    antiga do scheduler) vs. um snapshot único dividido com groupby("store_id").
+    """
+    rnd = random.Random(seed)
+    hoje = date.today()
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = get_conn(str(Path(tmp) / "alertas.db"))
+        init_db(conn)
+        conn.executemany("INSERT INTO stores(name) VALUES(?)", [(f"Loja {i}",) for i in range(1, lojas + 1)])
+        conn.executemany("INSERT INTO products(ean, product_name) VALUES(?, ?)",
+                         [(f"789{i:010d}", f"Produto {i}") for i in range(itens)])
+        conn.executemany("INSERT INTO lots(ean, lot, expiry_date) VALUES(?, 'L1', ?)",
+                         [(f"789{i:010d}", (hoje + timedelta(days=rnd.randrange(-10, 120))).isoformat())
+                          for i in range(itens)])
+        conn.executemany("INSERT INTO stock(ean, lot, qty, location, store_id) VALUES(?, 'L1', ?, 'Loja', ?)",
+                         [(f"789{i:010d}", rnd.randrange(1, 50), loja)
+                          for loja in range(1, lojas + 1) for i in range(itens)])
+        conn.commit()
+
+        def por_loja():
+            return {loja: reporting.build_snapshots(conn, store_id=loja) for loja in range(1, lojas + 1)}
+
+        def unico():
+            return dict(tuple(reporting.build_snapshots(conn).groupby("store_id")))
+
+        resultados = {}
+        for nome, fn in (("1 consulta por loja", por_loja), ("snapshot + groupby", unico)):
+            tempos = []
+            for _ in range(repeticoes):
+                t0 = time.perf_counter()
+                resultados[nome] = fn()
+                tempos.append(time.perf_counter() - t0)
+            print(f"{lojas} lojas x {itens} itens ({nome:19}): {min(tempos) * 1000:8.1f} ms")
+        a, b = resultados["1 consulta por loja"], resultados["snapshot + groupby"]
+        print("Resultados idênticos:",
+              all(a[k].reset_index(drop=True).equals(b[k].reset_index(drop=True)) for k in a))
+        conn.close()
+
+
+def bench_relatorios(lojas, itens, seed=42):
+    """
+    Relatórios PDF por segundo (um por loja) com o donut vetorial do reportlab vs.
+    o PNG do matplotlib (quando instalado), mais o tempo de import de report_pdf.
+    """
+    import subprocess
+    import sys
+
+    codigo = "import time; t = time.perf_counter(); import report_pdf; print(time.perf_counter() - t)"
+    dt = float(subprocess.run([sys.executable, "-c", codigo], cwd=Path(__file__).parent,
+                              capture_output=True, text=True, check=True).stdout)
+    print(f"import report_pdf: {dt * 1000:.0f} ms")
+
+    from report_pdf import gerar_relatorio_pdf
+
+    rnd = random.Random(seed)
+    hoje = pd.Timestamp.today().normalize()
+    df = pd.DataFrame({
+        "ean": [f"789{i:010d}" for i in range(lojas * itens)],
+        "product_name": [f"Produto {i % 500}" for i in range(lojas * itens)],
+        "lot": [f"L{i % 9}" for i in range(lojas * itens)],
+        "expiry_date": [hoje + pd.Timedelta(days=rnd.randrange(-10, 120)) for _ in range(lojas * itens)],
+        "qty": [rnd.randrange(1, 50) for _ in range(lojas * itens)],
+        "location": "Loja",
+        "store_id": [1 + i // itens for i in range(lojas * itens)],
+    })
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = get_conn(str(Path(tmp) / "relatorios.db"))
+        init_db(conn)
+        conn.executemany("INSERT INTO stores(name) VALUES(?)", [(f"Loja {i}",) for i in range(1, lojas + 1)])
+        conn.commit()
+        conn.close()
+
+        engines = ["reportlab"]
+        try:
+            import matplotlib  # noqa: F401
+            engines.append("matplotlib")
+        except ImportError:
+            print("matplotlib não instalado: só o donut vetorial será medido")
+
+        for engine in engines:
+            cfg = {"database_path": str(Path(tmp) / "relatorios.db"), "report_dir": str(Path(tmp) / engine),
+                   "pdf_chart_engine": engine}
+            gerar_relatorio_pdf(cfg, df[df["store_id"] == 1], 1, 1, 1, 1, store_id=1)  # aquecimento
+            t0 = time.perf_counter()
+            for store_id, df_loja in df.groupby("store_id"):
+                gerar_relatorio_pdf(cfg, df_loja, int(df_loja["qty"].sum()), 10, 5, 20, store_id=int(store_id))
+            dt = time.perf_counter() - t0
+            tamanho = sum(p.stat().st_size for p in Path(cfg["report_dir"]).glob("*.pdf")) / lojas / 1024
+            print(f"{lojas} relatórios ({engine:10}): {dt:.2f}s = {lojas / dt:6.1f} relatórios/s, ~{tamanho:.0f} KiB cada")
+
+
+def _lotes_loja(lotes, seed=42):
+    rnd = random.Random(seed)
+    hoje = pd.Timestamp.today().normalize()
+    return pd.DataFrame({
+        "product_name": [f"Produto {i % 5000} - descrição longa de exemplo" for i in range(lotes)],
+        "lot": [f"L{i:07d}" for i in range(lotes)],
+        "expiry_date": [hoje + pd.Timedelta(days=rnd.randrange(-30, 365)) for _ in range(lotes)],
+        "qty": [rnd.randrange(1, 50) for _ in range(lotes)],
+        "location": "Depósito",
+        "store_id": 1,
+    })
+
+
+def _pico_rss_relatorio(args):
+    """Gera a listagem completa num processo novo; devolve (pico de RSS MB, segundos, páginas)."""
+    lotes, report_dir, em_blocos = args
+    from reportlab.platypus import LongTable
+    import report_pdf
+
+    df = _lotes_loja(lotes)
+    _zerar_pico_rss()
+    cfg = {"database_path": str(Path(report_dir) / "nao_usado.db"), "report_dir": report_dir}
+    t0 = time.perf_counter()
+    if em_blocos:
+        caminho = report_pdf.gerar_relatorio_pdf(cfg, df, lotes, 0, 0, 0, completo=True)
+    else:
+        # listagem ingênua: resumo.values.tolist() inteiro numa única LongTable
+        caminho = str(Path(report_dir) / "tabela_unica.pdf")
+        resumo = df[["product_name", "lot", "expiry_date", "qty", "location"]].copy()
+        resumo["expiry_date"] = resumo["expiry_date"].dt.strftime("%d/%m/%Y")
+        tabela = LongTable([report_pdf.LISTING_COLUMNS] + resumo.values.tolist(),
+                           colWidths=report_pdf.LISTING_COL_WIDTHS, repeatRows=1)
+        tabela.setStyle(report_pdf.LISTING_TABLE_STYLE)
+        doc = report_pdf.SimpleDocTemplate(caminho, pagesize=report_pdf.A4, leftMargin=report_pdf.PAGE_MARGIN,
+                                           rightMargin=report_pdf.PAGE_MARGIN, topMargin=report_pdf.PAGE_MARGIN,
+                                           bottomMargin=report_pdf.PAGE_MARGIN)
+        doc.build([tabela])
+    dt = time.perf_counter() - t0
+    paginas = len(re.findall(rb"/Type /Page\b", Path(caminho).read_bytes()))
+    return _pico_rss_mb(), dt, paginas
+
+
+def bench_relatorio_completo(lotes):
+    """Pico de RSS da listagem completa: uma LongTable com todas as linhas vs. blocos sob demanda."""
+    ctx = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as tmp:
+        for modo, em_blocos in (("tabela única", False), ("em blocos", True)):
+            report_dir = str(Path(tmp) / modo.replace(" ", "_"))
+            Path(report_dir).mkdir()
+            with ctx.Pool(1) as pool:
+                pico, dt, paginas = pool.apply(_pico_rss_relatorio, ((lotes, report_dir, em_blocos),))
+            print(f"{lotes:>9} lotes ({modo:12}): {paginas} páginas em {dt:6.1f}s, pico de RSS {pico:8.1f} MB")
+
+
+def bench_email(mensagens):
+    """
+    E-mails de alerta contra um servidor SMTP local (aiosmtpd, STARTTLS com certificado
+    autoassinado): conexão + STARTTLS + login a cada mensagem (envio antigo) vs. a
+    sessão reaproveitada de expiry_bot.EnviadorEmail.
+    """
+    try:
+        from aiosmtpd.controller import Controller
+        from aiosmtpd.smtp import AuthResult
+    except ImportError:
+        print("aiosmtpd não instalado (pip install aiosmtpd): benchmark de e-mail indisponível")
+        return
+    import smtplib
+    import socket
+    import ssl
+    import logging
+    import subprocess
+
+    logging.getLogger("mail.log").setLevel(logging.ERROR)  # avisos de depreciação do aiosmtpd
+    with tempfile.TemporaryDirectory() as tmp:
+        cert, key = str(Path(tmp) / "cert.pem"), str(Path(tmp) / "key.pem")
+        subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-keyout", key, "-out", cert,
+                        "-days", "1", "-subj", "/CN=localhost"], check=True, capture_output=True)
+        tls = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        tls.load_cert_chain(cert, key)
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            porta = sock.getsockname()[1]
+
+        logins = []
+
+        class Caixa:
+            async def handle_DATA(self, server, session, envelope):
+                return "250 OK"
+
+        def autenticar(server, session, envelope, mechanism, auth_data):
+            logins.append(mechanism)
+            return AuthResult(success=True)
+
+        servidor = Controller(Caixa(), hostname="127.0.0.1", port=porta, tls_context=tls,
+                              require_starttls=True, authenticator=autenticar)
+        servidor.start()
+        try:
+            alert_cfg = {"enabled": True, "smtp_server": "127.0.0.1", "smtp_port": porta, "use_tls": True,
+                         "username": "bench", "password": "bench", "from_addr": "bench@localhost",
+                         "to_addrs": ["loja@localhost"]}
+            cfg = {"alert_email": alert_cfg}
+            corpo = "Itens a vencer\n" * 200
+
+            def antigo():
+                for i in range(mensagens):
+                    msg = bot.montar_email_alerta(alert_cfg, f"Alerta {i}", corpo)
+                    with smtplib.SMTP("127.0.0.1", porta) as server:
+                        server.starttls()
+                        server.login("bench", "bench")
+                        server.send_message(msg)
+
+            def sessao():
+                for i in range(mensagens):
+                    ok, info = bot.enviar_email_alerta(cfg, f"Alerta {i}", corpo)
+                    assert ok, info
+
+            def lote():
+                resultados = bot.enviar_emails_alerta(cfg, [(f"Alerta {i}", corpo, None) for i in range(mensagens)])
+                assert all(ok for ok, _ in resultados)
+
+            for nome, fn in (("conexão por e-mail", antigo), ("sessão reaproveitada", sessao), ("lote", lote)):
+                logins.clear()
+                t0 = time.perf_counter()
+                fn()
+                dt = time.perf_counter() - t0
+                print(f"{mensagens} e-mails ({nome:20}): {dt:6.2f}s = {mensagens / dt:7.1f} e-mails/s, "
+                      f"{len(logins)} login(s)")
+                bot.fechar_enviadores()
+        finally:
+            servidor.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    p_imp = sub.add_parser("importacao", help="importar_planilha por linha vs. em lote")
+    p_imp.add_argument("--linhas", type=int, default=100_000)
+
+    p_mem = sub.add_parser("memoria", help="pico de RSS da importação inteira vs. em blocos")
+    p_mem.add_argument("--linhas", type=int, nargs="+", default=[100_000, 400_000])
+
+    p_nfe = sub.add_parser("nfe", help="parse_nfe_xml (lxml iterparse) vs. parser ElementTree original")
+    p_nfe.add_argument("--itens", type=int, default=5_000)
+
+    p_apl = sub.add_parser("nfe-aplicar", help="aplicar NF-e item a item (movimentar) vs. transação única")
+    p_apl.add_argument("--itens", type=int, default=300)
+
+    p_mov = sub.add_parser("movimentos", help="movimentar por linha vs. movimentar_lote")
+    p_mov.add_argument("--linhas", type=int, default=5_000)
+
+    p_conc = sub.add_parser("concorrencia", help="vendas simultâneas do mesmo lote (invariantes de movimentar)")
+    p_conc.add_argument("--threads", type=int, default=16)
+    p_conc.add_argument("--estoque", type=int, default=500)
+    p_conc.add_argument("--postgres", action="store_true", help="usa o banco do Supabase (db_supabase)")
+
+    p_kpi = sub.add_parser("kpis", help="totais de movimentos: SELECT * + pandas vs. SUM ... GROUP BY type")
+    p_kpi.add_argument("--linhas", type=int, default=1_000_000)
+    p_kpi.add_argument("--lojas", type=int, default=50)
+
+    p_rol = sub.add_parser("rollup", help="tendência mensal: movements bruto vs. rollup movements_daily")
+    p_rol.add_argument("--linhas", type=int, default=2_000_000)
+    p_rol.add_argument("--lojas", type=int, default=5)
+    p_rol.add_argument("--eans", type=int, default=50, help="produtos por loja (densidade de vendas por dia)")
+
+    p_exp = sub.add_parser("explain", help="EXPLAIN das consultas quentes; falha em varredura completa")
+    p_exp.add_argument("--postgres", action="store_true", help="usa o banco do Supabase (db_supabase)")
+
+    p_ale = sub.add_parser("alertas", help="estoque da rodada de alertas: consulta por loja vs. snapshot único")
+    p_ale.add_argument("--lojas", type=int, default=50)
+    p_ale.add_argument("--itens", type=int, default=2_000)
+
+    p_rel = sub.add_parser("relatorios", help="relatórios PDF/s por loja: donut reportlab vs. matplotlib")
+    p_rel.add_argument("--lojas", type=int, default=50)
+    p_rel.add_argument("--itens", type=int, default=20)
+
+    p_mail = sub.add_parser("email", help="alertas por SMTP local: conexão por e-mail vs. sessão reaproveitada")
+    p_mail.add_argument("--mensagens", type=int, default=50)
+
+    p_rc = sub.add_parser("relatorio-completo", help="pico de RSS da listagem completa em PDF (LongTable única vs. blocos)")
+    p_rc.add_argument("--lotes", type=int, default=100_000)
+
+    args = parser.parse_args()
+    if args.bench == "importacao":
+        bench_importacao(args.linhas)
+    elif args.bench == "memoria":
+        bench_memoria(args.linhas)
+    elif args.bench == "nfe":
+        bench_nfe(args.itens)
+    elif args.bench == "nfe-aplicar":
+        bench_nfe_aplicar(args.itens)
+    elif args.bench == "movimentos":
+        bench_movimentos(args.linhas)
+    elif args.bench == "concorrencia":
+        bench_concorrencia(args.threads, args.estoque, postgres=args.postgres)
+    elif args.bench == "kpis":
+        bench_kpis(args.linhas, args.lojas)
+    elif args.bench == "rollup":
+        bench_rollup(args.linhas, args.lojas, args.eans)
+    elif args.bench == "explain":
+        bench_explain(postgres=args.postgres)
+    elif args.bench == "alertas":
+        bench_alertas(args.lojas, args.itens)
+    elif args.bench == "relatorios":
+        bench_relatorios(args.lojas, args.itens)
+    elif args.bench == "email":
+        bench_email(args.mensagens)
+    elif args.bench == "relatorio-completo":
+        bench_relatorio_completo(args.lotes)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+# config_lojas.py
+"""
+Configurações por loja (dias "a vencer", SMTP e dia do último alerta) na tabela
+store_settings, no lugar dos antigos config_loja_{id}.json.
+
+config_loja(conn, cfg, store_id) devolve o mesmo formato do antigo arquivo: o
+config.json global sobreposto pelo que a loja tiver gravado. As linhas ficam num
+cache em memória do processo; no máximo a cada CACHE_TTL segundos uma consulta
+às versões (store_id, version) descobre o que outro processo alterou, e só essas
+lojas são relidas. Gravações feitas por este processo invalidam o cache na hora.
+
+Uso:
+    migrar_configs_json(conn)                 # uma vez por banco: importa os JSON
+    cfg_loja = config_loja(conn, cfg, store_id)
+    salvar_config_loja(conn, store_id, near_expiry_days=15, alert_email={...})
+    registrar_alerta_enviado(conn, store_id, "2026-10-17")
+"""
+import json
+import threading
+import time
+from pathlib import Path
+
+from repository import get_repository
+
+RAIZ = Path(__file__).resolve().parents[1]
+CACHE_TTL = 2.0  # s entre verificações de versão
+
+_CACHE = {}           # store_id -> (version, {"near_expiry_days", "alert_email", "last_alert_sent"})
+_VALIDADO_EM = None   # time.monotonic() da última verificação de versões
+_LOCK = threading.Lock()
+_MIGRACAO_FEITA = False
+# versão registrada em schema_migrations de cada banco (fora da faixa das migrações de schema)
+MIGRACAO_JSON = (100, "store_settings_json")
+
+
+def _linha_para_config(near_expiry_days, alert_email, last_alert_sent):
+    config = {}
+    if near_expiry_days is not None:
+        config["near_expiry_days"] = int(near_expiry_days)
+    if alert_email:
+        config["alert_email"] = json.loads(alert_email)
+    if last_alert_sent is not None:
+        # DATE volta como date no Postgres e como texto no SQLite
+        config["last_alert_sent"] = str(last_alert_sent)[:10]
+    return config
+
+
+def _configuracoes(conn):
+    """Linhas de store_settings em memória, revalidadas pelas versões no máximo a cada CACHE_TTL s."""
+    global _VALIDADO_EM
+    with _LOCK:
+        if _VALIDADO_EM is not None and time.monotonic() - _VALIDADO_EM < CACHE_TTL:
+            return _CACHE
+
+        repo = get_repository(conn)
+        versoes = repo.store_settings_versions()
+        for store_id in set(_CACHE) - set(versoes):
+            del _CACHE[store_id]
+        alteradas = [sid for sid, v in versoes.items() if _CACHE.get(sid, (None,))[0] != v]
+        for store_id, dias, alert_email, ultimo, versao in repo.store_settings(alteradas):
+            _CACHE[int(store_id)] = (int(versao), _linha_para_config(dias, alert_email, ultimo))
+        _VALIDADO_EM = time.monotonic()
+        return _CACHE
+
+
+def invalidar_cache():
+    """Força a próxima leitura a conferir as versões no banco."""
+    global _VALIDADO_EM
+    with _LOCK:
+        _VALIDADO_EM = None
+
+
+def config_loja(conn, cfg, store_id):
+    """
+    Configuração efetiva da loja: cópia do cfg global com near_expiry_days,
+    alert_email e last_alert_sent da loja por cima. store_id None = só o global.
+    """
+    efetiva = dict(cfg)
+    efetiva["alert_email"] = dict(cfg.get("alert_email", {}))
+    efetiva.pop("last_alert_sent", None)
+    if store_id is None:
+        return efetiva
+
+    _, propria = _configuracoes(conn).get(int(store_id), (None, {}))
+    for chave, valor in propria.items():
+        efetiva[chave] = dict(valor) if isinstance(valor, dict) else valor
+    return efetiva
+
+
+def salvar_config_loja(conn, store_id, near_expiry_days=None, alert_email=None):
+    """Grava os dias "a vencer" e o bloco SMTP da loja (None = herda do config.json)."""
+    repo = get_repository(conn)
+    try:
+        repo.save_store_settings(
+            store_id,
+            None if near_expiry_days is None else int(near_expiry_days),
+            None if alert_email is None else json.dumps(alert_email, ensure_ascii=False),
+        )
+        repo.commit()
+    except Exception:
+        repo.rollback()
+        raise
+    invalidar_cache()
+
+
+def registrar_alerta_enviado(conn, store_id, dia):
+    """Marca o dia do último alerta da loja (um alerta por loja por dia)."""
+    repo = get_repository(conn)
+    try:
+        repo.set_last_alert_sent(store_id, dia)
+        repo.commit()
+    except Exception:
+        repo.rollback()
+        raise
+    invalidar_cache()
+
+
+def migrar_configs_json(conn, raiz=RAIZ, force=False):
+    """
+    Migração única dos config_loja_{id}.json de `raiz` para store_settings, registrada
+    em schema_migrations do banco de `conn`. Os arquivos ficam onde estão: o app
+    (Postgres) e o agendador (SQLite) importam cada um para o seu banco. Só importa
+    lojas que existem e ainda não têm configuração. Roda uma vez por processo (os
+    reruns do Streamlit viram no-op); force=True importa de novo mesmo num banco já
+    migrado. Devolve quantas lojas foram migradas.
+    """
+    global _MIGRACAO_FEITA
+    if _MIGRACAO_FEITA and not force:
+        return 0
+    repo = get_repository(conn)
+    versao, nome = MIGRACAO_JSON
+    if repo.migration_applied(versao) and not force:
+        _MIGRACAO_FEITA = True
+        return 0
+    lojas = {int(sid) for sid, _ in repo.list_stores()}
+    arquivos = {}
+    for arquivo in sorted(Path(raiz).glob("config_loja_*.json")):
+        sufixo = arquivo.stem[len("config_loja_"):]
+        if sufixo.isdigit() and int(sufixo) in lojas:  # config_loja_None.json não é de loja
+            arquivos[int(sufixo)] = arquivo
+
+    migradas = 0
+    try:
+        for store_id, arquivo in arquivos.items():
+            dados = json.loads(arquivo.read_text(encoding="utf-8"))
+            alert_email = dados.get("alert_email")
+            migradas += repo.import_store_settings(
+                store_id,
+                dados.get("near_expiry_days"),
+                None if alert_email is None else json.dumps(alert_email, ensure_ascii=False),
+                dados.get("last_alert_sent"),
+            )
+        repo.record_migration(versao, nome)
+        repo.commit()
+    except Exception:
+        repo.rollback()
+        raise
+
+    invalidar_cache()
+    _MIGRACAO_FEITA = True
+    return migradas
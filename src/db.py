@@ -1,4 +1,5 @@
 import sqlite3
+from datetime import date
 from pathlib import Path
 
 STORES_SCHEMA = """
@@ -42,6 +43,8 @@ CREATE TABLE IF NOT EXISTS lots (
     FOREIGN KEY (ean) REFERENCES products(ean) ON DELETE CASCADE
 );
 
+CREATE INDEX IF NOT EXISTS idx_lots_expiry ON lots(expiry_date);
+
 CREATE TABLE IF NOT EXISTS stock (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     ean TEXT NOT NULL,
@@ -68,6 +71,317 @@ CREATE TABLE IF NOT EXISTS movements (
 );
 """
 
+# === [ADD] Snapshot desnormalizado do estoque ===
+# Uma linha por registro de stock, já com nome do produto e validade do lote.
+# Mantido pelos triggers abaixo na mesma transação de quem altera stock,
+# lots ou products, então build_snapshots lê tudo com um único scan indexado.
+STOCK_SNAPSHOT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS stock_snapshot (
+    stock_id INTEGER PRIMARY KEY,
+    ean TEXT NOT NULL,
+    product_name TEXT NOT NULL,
+    lot TEXT NOT NULL,
+    expiry_date DATE NOT NULL,
+    qty INTEGER NOT NULL,
+    location TEXT,
+    store_id INTEGER
+);
+
+CREATE INDEX IF NOT EXISTS idx_stock_snapshot_store_expiry
+    ON stock_snapshot(store_id, expiry_date) WHERE qty > 0;
+CREATE INDEX IF NOT EXISTS idx_stock_snapshot_ean_lot
+    ON stock_snapshot(ean, lot);
+
+CREATE TRIGGER IF NOT EXISTS trg_snapshot_stock_ins AFTER INSERT ON stock
+BEGIN
+    INSERT OR REPLACE INTO stock_snapshot(stock_id, ean, product_name, lot, expiry_date, qty, location, store_id)
+    SELECT NEW.id, NEW.ean, p.product_name, NEW.lot, l.expiry_date, NEW.qty, NEW.location, NEW.store_id
+    FROM lots l JOIN products p ON p.ean = l.ean
+    WHERE l.ean = NEW.ean AND l.lot = NEW.lot;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_snapshot_stock_upd AFTER UPDATE ON stock
+WHEN OLD.ean = NEW.ean AND OLD.lot = NEW.lot
+BEGIN
+    UPDATE stock_snapshot
+    SET qty = NEW.qty, location = NEW.location, store_id = NEW.store_id
+    WHERE stock_id = NEW.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_snapshot_stock_upd_key AFTER UPDATE ON stock
+WHEN OLD.ean <> NEW.ean OR OLD.lot <> NEW.lot
+BEGIN
+    DELETE FROM stock_snapshot WHERE stock_id = OLD.id;
+    INSERT OR REPLACE INTO stock_snapshot(stock_id, ean, product_name, lot, expiry_date, qty, location, store_id)
+    SELECT NEW.id, NEW.ean, p.product_name, NEW.lot, l.expiry_date, NEW.qty, NEW.location, NEW.store_id
+    FROM lots l JOIN products p ON p.ean = l.ean
+    WHERE l.ean = NEW.ean AND l.lot = NEW.lot;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_snapshot_stock_del AFTER DELETE ON stock
+BEGIN
+    DELETE FROM stock_snapshot WHERE stock_id = OLD.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_snapshot_lots_ins AFTER INSERT ON lots
+BEGIN
+    INSERT OR REPLACE INTO stock_snapshot(stock_id, ean, product_name, lot, expiry_date, qty, location, store_id)
+    SELECT s.id, s.ean, p.product_name, s.lot, NEW.expiry_date, s.qty, s.location, s.store_id
+    FROM stock s JOIN products p ON p.ean = s.ean
+    WHERE s.ean = NEW.ean AND s.lot = NEW.lot;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_snapshot_lots_upd AFTER UPDATE ON lots
+BEGIN
+    DELETE FROM stock_snapshot WHERE ean = OLD.ean AND lot = OLD.lot;
+    INSERT OR REPLACE INTO stock_snapshot(stock_id, ean, product_name, lot, expiry_date, qty, location, store_id)
+    SELECT s.id, s.ean, p.product_name, s.lot, NEW.expiry_date, s.qty, s.location, s.store_id
+    FROM stock s JOIN products p ON p.ean = s.ean
+    WHERE s.ean = NEW.ean AND s.lot = NEW.lot;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_snapshot_lots_del AFTER DELETE ON lots
+BEGIN
+    DELETE FROM stock_snapshot WHERE ean = OLD.ean AND lot = OLD.lot;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_snapshot_products_ins AFTER INSERT ON products
+BEGIN
+    INSERT OR REPLACE INTO stock_snapshot(stock_id, ean, product_name, lot, expiry_date, qty, location, store_id)
+    SELECT s.id, s.ean, NEW.product_name, s.lot, l.expiry_date, s.qty, s.location, s.store_id
+    FROM stock s JOIN lots l ON l.ean = s.ean AND l.lot = s.lot
+    WHERE s.ean = NEW.ean;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_snapshot_products_upd AFTER UPDATE ON products
+WHEN OLD.ean <> NEW.ean OR OLD.product_name IS NOT NEW.product_name
+BEGIN
+    DELETE FROM stock_snapshot WHERE ean = OLD.ean;
+    INSERT OR REPLACE INTO stock_snapshot(stock_id, ean, product_name, lot, expiry_date, qty, location, store_id)
+    SELECT s.id, s.ean, NEW.product_name, s.lot, l.expiry_date, s.qty, s.location, s.store_id
+    FROM stock s JOIN lots l ON l.ean = s.ean AND l.lot = s.lot
+    WHERE s.ean = NEW.ean;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_snapshot_products_del AFTER DELETE ON products
+BEGIN
+    DELETE FROM stock_snapshot WHERE ean = OLD.ean;
+END;
+
+-- Carga inicial para bancos que já tinham estoque antes da tabela existir
+INSERT INTO stock_snapshot(stock_id, ean, product_name, lot, expiry_date, qty, location, store_id)
+SELECT s.id, s.ean, p.product_name, s.lot, l.expiry_date, s.qty, s.location, s.store_id
+FROM stock s
+JOIN lots l ON l.ean = s.ean AND l.lot = s.lot
+JOIN products p ON p.ean = s.ean
+WHERE NOT EXISTS (SELECT 1 FROM stock_snapshot);
+"""
+
+# === [ADD] NF-e já processadas (importação idempotente) ===
+# chave = chNFe (44 dígitos) ou "sha256:<hash do arquivo>" quando a nota não traz a chave.
+# Uma nota 'importada' nunca é aplicada de novo; 'erro' pode ser reprocessada.
+NFE_DOCUMENTS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS nfe_documents (
+    chave TEXT PRIMARY KEY,
+    origem TEXT,
+    store_id INTEGER,
+    status TEXT NOT NULL CHECK(status IN ('importada','erro')),
+    itens INTEGER NOT NULL DEFAULT 0,
+    erro TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (store_id) REFERENCES stores(id) ON DELETE SET NULL
+);
+"""
+
+# === [ADD] Rollup diário de movimentos (gráficos de tendência) ===
+# Uma linha por (loja, EAN, dia, tipo) com a qty somada; store_id 0 = movimento sem loja.
+# rollup_state guarda o último movements.id já agregado (atualização incremental).
+MOVEMENTS_DAILY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS movements_daily (
+    store_id INTEGER NOT NULL DEFAULT 0,
+    ean TEXT NOT NULL,
+    day DATE NOT NULL,
+    type TEXT NOT NULL,
+    qty INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (store_id, ean, day, type)
+);
+
+CREATE INDEX IF NOT EXISTS idx_movements_daily_store_day ON movements_daily(store_id, day);
+
+CREATE TABLE IF NOT EXISTS rollup_state (
+    name TEXT PRIMARY KEY,
+    last_id INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+"""
+
+# === [ADD] Fila de alertas por e-mail (outbox) ===
+# A interface e os agendadores só enfileiram; o worker de outbox_alertas envia,
+# com novas tentativas e backoff. 'enviando' com next_attempt_at vencido = worker
+# que caiu no meio do envio: a linha volta a ser reivindicada.
+ALERT_OUTBOX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS alert_outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    store_id INTEGER,
+    subject TEXT NOT NULL,
+    body TEXT NOT NULL,
+    attachment_name TEXT,
+    attachment BLOB,
+    status TEXT NOT NULL DEFAULT 'pendente'
+        CHECK(status IN ('pendente','enviando','enviado','falhou')),
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at TIMESTAMP NOT NULL,
+    last_error TEXT,
+    created_at TIMESTAMP NOT NULL,
+    sent_at TIMESTAMP,
+    FOREIGN KEY (store_id) REFERENCES stores(id) ON DELETE SET NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_alert_outbox_due
+    ON alert_outbox(next_attempt_at) WHERE status IN ('pendente','enviando');
+"""
+
+# === [ADD] Configurações por loja ===
+# Substitui os config_loja_{id}.json (migrados uma vez por config_lojas.migrar_configs_json).
+# alert_email é o bloco SMTP em JSON; NULL = herda do config.json. version sobe a cada
+# gravação e invalida o cache em memória de config_lojas nos outros processos.
+STORE_SETTINGS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS store_settings (
+    store_id INTEGER PRIMARY KEY,
+    near_expiry_days INTEGER,
+    alert_email TEXT,
+    last_alert_sent DATE,
+    version INTEGER NOT NULL DEFAULT 1,
+    updated_at TIMESTAMP,
+    FOREIGN KEY (store_id) REFERENCES stores(id) ON DELETE CASCADE
+);
+"""
+
+# === [ADD] Migrações versionadas ===
+# init_db aplica, em ordem, as versões que ainda não estão em schema_migrations.
+# Cada índice é (nome, "tabela(colunas) [WHERE ...]"); o mesmo catálogo existe em
+# db_supabase.py, onde os índices são criados com CREATE INDEX CONCURRENTLY.
+MIGRATIONS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    version INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+"""
+
+STOCK_KEY_INDEX = "uq_stock_chave"
+STOCK_KEY_COLUMNS = "(ean, lot, COALESCE(location, ''), COALESCE(store_id, 0))"
+
+
+def _unificar_chave_stock(conn: sqlite3.Connection) -> None:
+    """
+    Migração 3: índice único na chave de estoque com local/loja normalizados
+    (o mesmo de db_supabase). O UNIQUE(ean, lot, location, store_id) não casa
+    NULLs, então itens sem loja podiam ficar duplicados e movimentar alterava
+    todos. Duplicatas que já existam são somadas no registro de menor id.
+    """
+    conn.execute("""
+        UPDATE stock
+        SET qty = (
+            SELECT SUM(d.qty) FROM stock d
+            WHERE d.ean = stock.ean AND d.lot = stock.lot
+              AND COALESCE(d.location, '') = COALESCE(stock.location, '')
+              AND COALESCE(d.store_id, 0) = COALESCE(stock.store_id, 0)
+        )
+        WHERE EXISTS (
+            SELECT 1 FROM stock d
+            WHERE d.ean = stock.ean AND d.lot = stock.lot
+              AND COALESCE(d.location, '') = COALESCE(stock.location, '')
+              AND COALESCE(d.store_id, 0) = COALESCE(stock.store_id, 0)
+              AND d.id > stock.id
+        )
+        AND NOT EXISTS (
+            SELECT 1 FROM stock k
+            WHERE k.ean = stock.ean AND k.lot = stock.lot
+              AND COALESCE(k.location, '') = COALESCE(stock.location, '')
+              AND COALESCE(k.store_id, 0) = COALESCE(stock.store_id, 0)
+              AND k.id < stock.id
+        )
+    """)
+    conn.execute("""
+        DELETE FROM stock
+        WHERE EXISTS (
+            SELECT 1 FROM stock k
+            WHERE k.ean = stock.ean AND k.lot = stock.lot
+              AND COALESCE(k.location, '') = COALESCE(stock.location, '')
+              AND COALESCE(k.store_id, 0) = COALESCE(stock.store_id, 0)
+              AND k.id < stock.id
+        )
+    """)
+    conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {STOCK_KEY_INDEX} ON stock {STOCK_KEY_COLUMNS}")
+
+
+MIGRATIONS = [
+    (1, "indices_consultas_quentes", [
+        # KPIs (SUM ... GROUP BY type) e cargas de movimentos por loja/período
+        ("idx_movements_store_type_ts", "movements(store_id, type, ts)"),
+        ("idx_movements_store_ts", "movements(store_id, ts)"),
+        # FK stock.store_id (ON DELETE CASCADE) e estoque por loja; sem qty na
+        # chave para não encarecer cada movimentar, que só altera qty
+        ("idx_stock_store", "stock(store_id)"),
+        # FKs opcionais: só as linhas com loja entram no índice
+        ("idx_users_store", "users(store_id) WHERE store_id IS NOT NULL"),
+        ("idx_nfe_documents_store", "nfe_documents(store_id) WHERE store_id IS NOT NULL"),
+    ]),
+    (2, "arquivo_movimentos", [
+        # corte por data do arquivamento (arquivar_movimentos)
+        ("idx_movements_ts", "movements(ts)"),
+    ]),
+    # migração de dados (função): roda na mesma transação que a registra
+    (3, "stock_chave_unica", _unificar_chave_stock),
+]
+
+
+def _aplicar_migracoes(conn: sqlite3.Connection):
+    conn.executescript(MIGRATIONS_SCHEMA)
+    aplicadas = {r[0] for r in conn.execute("SELECT version FROM schema_migrations")}
+    for versao, nome, passos in MIGRATIONS:
+        if versao in aplicadas:
+            continue
+        with conn:  # IF NOT EXISTS: reaplicar uma versão interrompida é seguro
+            if callable(passos):
+                passos(conn)
+            else:
+                for indice, definicao in passos:
+                    conn.execute(f"CREATE INDEX IF NOT EXISTS {indice} ON {definicao}")
+            conn.execute("INSERT OR IGNORE INTO schema_migrations(version, name) VALUES(?, ?)", (versao, nome))
+
+# === [ADD] Arquivo de movimentos (períodos fechados) ===
+# Os meses fechados saem de main.movements para <banco>_arquivo.db, anexado como
+# "arquivo" só nas conexões que leem o histórico (anexar_arquivo). A view temporária
+# movements_all junta as duas tabelas; movimentar e o rollup incremental só tocam a
+# tabela quente.
+ARCHIVE_OPEN_MONTHS = 3
+
+ARCHIVE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS arquivo.movements (
+    id INTEGER PRIMARY KEY,
+    ts TIMESTAMP,
+    type TEXT NOT NULL,
+    ean TEXT NOT NULL,
+    lot TEXT NOT NULL,
+    qty INTEGER NOT NULL,
+    note TEXT,
+    store_id INTEGER
+);
+
+CREATE INDEX IF NOT EXISTS arquivo.idx_movements_store_type_ts ON movements(store_id, type, ts);
+CREATE INDEX IF NOT EXISTS arquivo.idx_movements_store_ts ON movements(store_id, ts);
+
+CREATE TEMP VIEW IF NOT EXISTS movements_all AS
+    SELECT id, ts, type, ean, lot, qty, note, store_id FROM main.movements
+    UNION ALL
+    -- entre as duas fases de arquivar_movimentos o id ainda pode estar na tabela quente
+    SELECT id, ts, type, ean, lot, qty, note, store_id FROM arquivo.movements a
+    WHERE NOT EXISTS (SELECT 1 FROM main.movements m WHERE m.id = a.id);
+"""
+
 # === [ADD] helpers de usuários ===
 def get_user_by_username(conn, username: str):
     cur = conn.cursor()
@@ -148,6 +462,11 @@ def get_store_id(conn, name: str):
     return create_store(conn, name)
 
 
+def archive_path(db_path) -> Path:
+    """Arquivo de movimentos ao lado do banco: estoque.db -> estoque_arquivo.db."""
+    db_path = Path(db_path)
+    return db_path.with_name(f"{db_path.stem}_arquivo{db_path.suffix or '.db'}")
+
 def get_conn(db_path: str):
     db_path = Path(db_path)
     db_path.parent.mkdir(parents=True, exist_ok=True)
@@ -155,8 +474,60 @@ def get_conn(db_path: str):
     conn.execute("PRAGMA foreign_keys = ON;")
     return conn
 
+def anexar_arquivo(conn: sqlite3.Connection) -> None:
+    """
+    Anexa o arquivo de movimentos como "arquivo" (criando tabela, índices e a view
+    movements_all) na primeira vez que a conexão precisa do histórico. O SQLite não
+    faz ATTACH com transação aberta, então chame antes de gravar.
+    """
+    bancos = {nome: arquivo for _, nome, arquivo in conn.execute("PRAGMA database_list")}
+    if "arquivo" in bancos:
+        return
+    if conn.in_transaction:
+        raise sqlite3.OperationalError("O arquivo de movimentos precisa ser anexado fora de uma transação aberta.")
+    caminho = str(archive_path(bancos["main"])) if bancos.get("main") else ":memory:"
+    conn.execute("ATTACH DATABASE ? AS arquivo", (caminho,))
+    conn.executescript(ARCHIVE_SCHEMA)
+
+def arquivar_movimentos(conn: sqlite3.Connection, meses_abertos: int = ARCHIVE_OPEN_MONTHS) -> int:
+    """
+    Move para o arquivo os movimentos dos meses fechados, mantendo na tabela quente
+    só os últimos `meses_abertos` meses (contando o atual). O rollup diário é
+    atualizado na mesma transação da cópia, antes, para nenhum movimento sair sem ser
+    agregado. Em WAL o commit não é atômico entre os dois arquivos, então são duas
+    fases: a cópia é gravada no arquivo primeiro e só depois saem da tabela quente
+    os ids que já estão lá. Uma queda entre as fases deixa o movimento nos dois
+    bancos (movements_all mostra um só), e a execução seguinte termina a limpeza.
+    Retorna o número de movimentos arquivados.
+    """
+    from repository import get_repository
+
+    hoje = date.today()
+    ano, mes = hoje.year, hoje.month - (meses_abertos - 1)
+    while mes <= 0:
+        ano, mes = ano - 1, mes + 12
+    anexar_arquivo(conn)
+    repo = get_repository(conn)
+    corte = date(ano, mes, 1)
+    try:
+        repo.refresh_movements_daily()
+        repo.copy_movements_to_archive(corte)
+        repo.commit()
+        n = repo.purge_archived_movements(corte)
+        repo.commit()
+    except Exception:
+        repo.rollback()
+        raise
+    return n
+
 def init_db(conn: sqlite3.Connection):
     conn.executescript(STORES_SCHEMA)
     conn.executescript(SCHEMA)
     conn.executescript(USERS_SCHEMA)
+    conn.executescript(STOCK_SNAPSHOT_SCHEMA)
+    conn.executescript(NFE_DOCUMENTS_SCHEMA)
+    conn.executescript(MOVEMENTS_DAILY_SCHEMA)
+    conn.executescript(ALERT_OUTBOX_SCHEMA)
+    conn.executescript(STORE_SETTINGS_SCHEMA)
     conn.commit()
+    _aplicar_migracoes(conn)
@@ -1,8 +1,14 @@
 # src/db_supabase.py
+import io
 import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date
 from typing import Optional, Any
 import psycopg2
 import psycopg2.extras
+import psycopg2.pool
 import pandas as pd
 
 # Em apps Streamlit, as credenciais vêm do .streamlit/secrets.toml
@@ -21,11 +27,8 @@ except Exception:
     }
 
 
-def get_conn(_ignored_path: str = ""):
-    """
-    Devolve uma conexão psycopg2 ao Postgres do Supabase.
-    O argumento é ignorado (mantido por compatibilidade com o SQLite).
-    """
+def _connect_args() -> tuple[tuple, dict]:
+    """Argumentos de psycopg2.connect montados a partir do secrets.toml / variáveis de ambiente."""
     required = ["host", "port", "database", "user", "password"]
     if not _SECRETS.get("uri"):
         missing = [k for k in required if not _SECRETS.get(k)]
@@ -33,25 +36,134 @@ def get_conn(_ignored_path: str = ""):
             raise RuntimeError(f"Faltam chaves no secrets.toml (postgres): {missing}")
 
     if _SECRETS.get("uri"):
-        conn = psycopg2.connect(
-            _SECRETS["uri"],
-            sslmode=_SECRETS.get("sslmode", "require"),
-            cursor_factory=psycopg2.extras.RealDictCursor,
-        )
-    else:
-        conn = psycopg2.connect(
-            host=_SECRETS["host"],
-            port=int(_SECRETS["port"]),
-            dbname=_SECRETS["database"],
-            user=_SECRETS["user"],
-            password=_SECRETS["password"],
-            sslmode=_SECRETS.get("sslmode", "require"),
-            cursor_factory=psycopg2.extras.RealDictCursor,
-        )
+        return (_SECRETS["uri"],), {
+            "sslmode": _SECRETS.get("sslmode", "require"),
+            "cursor_factory": psycopg2.extras.RealDictCursor,
+        }
+    return (), {
+        "host": _SECRETS["host"],
+        "port": int(_SECRETS["port"]),
+        "dbname": _SECRETS["database"],
+        "user": _SECRETS["user"],
+        "password": _SECRETS["password"],
+        "sslmode": _SECRETS.get("sslmode", "require"),
+        "cursor_factory": psycopg2.extras.RealDictCursor,
+    }
+
+
+def get_conn(_ignored_path: str = ""):
+    """
+    Devolve uma conexão psycopg2 ao Postgres do Supabase.
+    O argumento é ignorado (mantido por compatibilidade com o SQLite).
+    Para o app web prefira connection(), que usa o pool do processo.
+    """
+    args, kwargs = _connect_args()
+    conn = psycopg2.connect(*args, **kwargs)
     conn.autocommit = False
     return conn
 
 
+# ---------- POOL DE CONEXÕES ----------
+
+POOL_MIN = int(os.getenv("PGPOOL_MIN", "2"))   # conexões ociosas mantidas abertas (o psycopg2 fecha as excedentes)
+POOL_MAX = int(os.getenv("PGPOOL_MAX", "10"))
+POOL_TIMEOUT = float(os.getenv("PGPOOL_TIMEOUT", "30"))   # espera máx. por uma conexão livre (s)
+POOL_IDLE_CHECK = 60.0     # conexões paradas há mais que isso recebem um SELECT 1 antes do uso (s)
+POOL_MAX_AGE = 30 * 60.0   # conexões mais velhas que isso são recicladas (s)
+
+_POOL: Optional[psycopg2.pool.ThreadedConnectionPool] = None
+_POOL_LOCK = threading.Lock()
+_POOL_SLOTS = threading.BoundedSemaphore(POOL_MAX)
+_CONN_INFO: dict[int, tuple[float, float]] = {}   # id(conn) -> (criada_em, ultimo_uso)
+
+
+def get_pool() -> psycopg2.pool.ThreadedConnectionPool:
+    """Pool de conexões do processo, criado na primeira chamada."""
+    global _POOL
+    if _POOL is None or _POOL.closed:
+        with _POOL_LOCK:
+            if _POOL is None or _POOL.closed:
+                args, kwargs = _connect_args()
+                _POOL = psycopg2.pool.ThreadedConnectionPool(POOL_MIN, POOL_MAX, *args, **kwargs)
+    return _POOL
+
+
+def _conexao_saudavel(conn) -> bool:
+    """Descarta conexões fechadas, velhas demais ou que não respondem depois de muito tempo paradas."""
+    if conn.closed:
+        return False
+    agora = time.monotonic()
+    criada_em, ultimo_uso = _CONN_INFO.setdefault(id(conn), (agora, agora))
+    if agora - criada_em > POOL_MAX_AGE:
+        return False
+    if agora - ultimo_uso > POOL_IDLE_CHECK:
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+    return True
+
+
+def _devolver(pool, conn, descartar: bool = False) -> None:
+    if descartar or conn.closed:
+        _CONN_INFO.pop(id(conn), None)
+        pool.putconn(conn, close=True)
+        return
+    criada_em, _ = _CONN_INFO.get(id(conn), (time.monotonic(), 0.0))
+    _CONN_INFO[id(conn)] = (criada_em, time.monotonic())
+    pool.putconn(conn)   # o pool faz rollback de transações que ficaram abertas
+
+
+@contextmanager
+def connection():
+    """
+    Empresta uma conexão do pool durante o bloco (uma por requisição/rerun).
+    Em caso de erro faz rollback; conexões quebradas são fechadas e
+    substituídas, as demais voltam ao pool.
+
+        with connection() as conn:
+            ...
+    """
+    if not _POOL_SLOTS.acquire(timeout=POOL_TIMEOUT):
+        raise RuntimeError("Nenhuma conexão livre no pool do banco de dados.")
+    try:
+        pool = get_pool()
+        conn = pool.getconn()
+        descartadas = 0
+        while not _conexao_saudavel(conn):
+            _devolver(pool, conn, descartar=True)
+            descartadas += 1
+            if descartadas > POOL_MAX:
+                raise RuntimeError("Não foi possível obter uma conexão válida com o banco de dados.")
+            conn = pool.getconn()
+        conn.autocommit = False
+
+        try:
+            yield conn
+        except BaseException:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                pass
+            _devolver(pool, conn, descartar=conn.closed != 0)
+            raise
+        _devolver(pool, conn)
+    finally:
+        _POOL_SLOTS.release()
+
+
+def close_pool() -> None:
+    """Fecha todas as conexões do pool (ex.: no encerramento de scripts)."""
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is not None and not _POOL.closed:
+            _POOL.closeall()
+        _POOL = None
+        _CONN_INFO.clear()
+
+
 # ---------- SCHEMA ----------
 
 # stores (já existe no seu projeto)
@@ -92,6 +204,8 @@ CREATE TABLE IF NOT EXISTS lots (
     UNIQUE(ean, lot)
 );
 
+CREATE INDEX IF NOT EXISTS idx_lots_expiry ON lots(expiry_date);
+
 CREATE TABLE IF NOT EXISTS stock (
     id SERIAL PRIMARY KEY,
     ean TEXT NOT NULL REFERENCES products(ean) ON DELETE CASCADE,
@@ -114,14 +228,422 @@ CREATE TABLE IF NOT EXISTS movements (
 );
 """
 
+# snapshot desnormalizado do estoque (mantido por triggers, lido por build_snapshots)
+STOCK_SNAPSHOT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS stock_snapshot (
+    stock_id INTEGER PRIMARY KEY,
+    ean TEXT NOT NULL,
+    product_name TEXT NOT NULL,
+    lot TEXT NOT NULL,
+    expiry_date DATE NOT NULL,
+    qty INTEGER NOT NULL,
+    location TEXT,
+    store_id INTEGER
+);
+
+CREATE INDEX IF NOT EXISTS idx_stock_snapshot_store_expiry
+    ON stock_snapshot(store_id, expiry_date) WHERE qty > 0;
+CREATE INDEX IF NOT EXISTS idx_stock_snapshot_ean_lot
+    ON stock_snapshot(ean, lot);
+
+CREATE OR REPLACE FUNCTION stock_snapshot_sync_stock() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'UPDATE' AND OLD.ean = NEW.ean AND OLD.lot = NEW.lot THEN
+        UPDATE stock_snapshot
+        SET qty = NEW.qty, location = NEW.location, store_id = NEW.store_id
+        WHERE stock_id = NEW.id;
+        RETURN NULL;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        DELETE FROM stock_snapshot WHERE stock_id = OLD.id;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO stock_snapshot(stock_id, ean, product_name, lot, expiry_date, qty, location, store_id)
+        SELECT NEW.id, NEW.ean, p.product_name, NEW.lot, l.expiry_date, NEW.qty, NEW.location, NEW.store_id
+        FROM lots l JOIN products p ON p.ean = l.ean
+        WHERE l.ean = NEW.ean AND l.lot = NEW.lot
+        ON CONFLICT (stock_id) DO NOTHING;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION stock_snapshot_sync_lots() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        DELETE FROM stock_snapshot WHERE ean = OLD.ean AND lot = OLD.lot;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO stock_snapshot(stock_id, ean, product_name, lot, expiry_date, qty, location, store_id)
+        SELECT s.id, s.ean, p.product_name, s.lot, NEW.expiry_date, s.qty, s.location, s.store_id
+        FROM stock s JOIN products p ON p.ean = s.ean
+        WHERE s.ean = NEW.ean AND s.lot = NEW.lot
+        ON CONFLICT (stock_id) DO NOTHING;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION stock_snapshot_sync_products() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'UPDATE' AND OLD.ean = NEW.ean THEN
+        IF OLD.product_name IS DISTINCT FROM NEW.product_name THEN
+            UPDATE stock_snapshot SET product_name = NEW.product_name WHERE ean = NEW.ean;
+        END IF;
+        RETURN NULL;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        DELETE FROM stock_snapshot WHERE ean = OLD.ean;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO stock_snapshot(stock_id, ean, product_name, lot, expiry_date, qty, location, store_id)
+        SELECT s.id, s.ean, NEW.product_name, s.lot, l.expiry_date, s.qty, s.location, s.store_id
+        FROM stock s JOIN lots l ON l.ean = s.ean AND l.lot = s.lot
+        WHERE s.ean = NEW.ean
+        ON CONFLICT (stock_id) DO NOTHING;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'trg_stock_snapshot_stock') THEN
+        CREATE TRIGGER trg_stock_snapshot_stock AFTER INSERT OR UPDATE OR DELETE ON stock
+            FOR EACH ROW EXECUTE FUNCTION stock_snapshot_sync_stock();
+    END IF;
+    IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'trg_stock_snapshot_lots') THEN
+        CREATE TRIGGER trg_stock_snapshot_lots AFTER INSERT OR UPDATE OR DELETE ON lots
+            FOR EACH ROW EXECUTE FUNCTION stock_snapshot_sync_lots();
+    END IF;
+    IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'trg_stock_snapshot_products') THEN
+        CREATE TRIGGER trg_stock_snapshot_products AFTER INSERT OR UPDATE OR DELETE ON products
+            FOR EACH ROW EXECUTE FUNCTION stock_snapshot_sync_products();
+    END IF;
+END;
+$$;
+
+-- carga inicial para bancos que já tinham estoque antes da tabela existir
+INSERT INTO stock_snapshot(stock_id, ean, product_name, lot, expiry_date, qty, location, store_id)
+SELECT s.id, s.ean, p.product_name, s.lot, l.expiry_date, s.qty, s.location, s.store_id
+FROM stock s
+JOIN lots l ON l.ean = s.ean AND l.lot = s.lot
+JOIN products p ON p.ean = s.ean
+WHERE NOT EXISTS (SELECT 1 FROM stock_snapshot);
+"""
+
+# NF-e já processadas: chave = chNFe ou "sha256:<hash>" (importação idempotente)
+NFE_DOCUMENTS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS nfe_documents (
+    chave TEXT PRIMARY KEY,
+    origem TEXT,
+    store_id INTEGER REFERENCES stores(id) ON DELETE SET NULL,
+    status TEXT NOT NULL CHECK (status IN ('importada','erro')),
+    itens INTEGER NOT NULL DEFAULT 0,
+    erro TEXT,
+    created_at TIMESTAMP WITHOUT TIME ZONE DEFAULT NOW(),
+    updated_at TIMESTAMP WITHOUT TIME ZONE DEFAULT NOW()
+);
+"""
+
+# rollup diário de movimentos por (loja, EAN, dia, tipo); store_id 0 = sem loja.
+# rollup_state.last_id = último movements.id já agregado
+MOVEMENTS_DAILY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS movements_daily (
+    store_id INTEGER NOT NULL DEFAULT 0,
+    ean TEXT NOT NULL,
+    day DATE NOT NULL,
+    type TEXT NOT NULL,
+    qty BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (store_id, ean, day, type)
+);
+
+CREATE INDEX IF NOT EXISTS idx_movements_daily_store_day ON movements_daily(store_id, day);
+
+CREATE TABLE IF NOT EXISTS rollup_state (
+    name TEXT PRIMARY KEY,
+    last_id BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP WITHOUT TIME ZONE DEFAULT NOW()
+);
+"""
+
+# fila de alertas por e-mail (outbox_alertas): a UI só enfileira, o worker envia
+ALERT_OUTBOX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS alert_outbox (
+    id SERIAL PRIMARY KEY,
+    store_id INTEGER REFERENCES stores(id) ON DELETE SET NULL,
+    subject TEXT NOT NULL,
+    body TEXT NOT NULL,
+    attachment_name TEXT,
+    attachment BYTEA,
+    status TEXT NOT NULL DEFAULT 'pendente'
+        CHECK (status IN ('pendente','enviando','enviado','falhou')),
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    last_error TEXT,
+    created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    sent_at TIMESTAMP WITHOUT TIME ZONE
+);
+
+CREATE INDEX IF NOT EXISTS idx_alert_outbox_due
+    ON alert_outbox(next_attempt_at) WHERE status IN ('pendente','enviando');
+"""
+
+# configurações por loja (config_lojas); version invalida o cache dos outros processos
+STORE_SETTINGS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS store_settings (
+    store_id INTEGER PRIMARY KEY REFERENCES stores(id) ON DELETE CASCADE,
+    near_expiry_days INTEGER,
+    alert_email TEXT,
+    last_alert_sent DATE,
+    version INTEGER NOT NULL DEFAULT 1,
+    updated_at TIMESTAMP WITHOUT TIME ZONE
+);
+"""
+
+# movements particionada por mês em ts (migração 2). movements_default recebe o que
+# cair fora das partições existentes até manter_particoes criar o mês correspondente.
+MOVEMENTS_MONTHS_AHEAD = 3
+
+
+def _mes(d: date, n: int = 0) -> date:
+    """Primeiro dia do mês de d deslocado n meses."""
+    total = d.year * 12 + d.month - 1 + n
+    return date(total // 12, total % 12 + 1, 1)
+
+
+def _criar_particao_mes(cur, inicio: date) -> bool:
+    """
+    Cria a partição de movements do mês que começa em `inicio`, trazendo da
+    partição default as linhas desse mês. Retorna False se ela já existia.
+    """
+    nome = f"movements_y{inicio:%Y}m{inicio:%m}"
+    cur.execute("SELECT 1 FROM pg_class WHERE relname = %s", (nome,))
+    if cur.fetchone():
+        return False
+    fim = _mes(inicio, 1)
+    cur.execute(f"CREATE TABLE {nome} (LIKE movements INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+    cur.execute(f"""
+        WITH movidas AS (DELETE FROM movements_default WHERE ts >= %s AND ts < %s RETURNING *)
+        INSERT INTO {nome} SELECT * FROM movidas
+    """, (inicio, fim))
+    cur.execute(
+        f"ALTER TABLE movements ATTACH PARTITION {nome} FOR VALUES FROM (%s) TO (%s)",
+        (inicio.isoformat(), fim.isoformat()),
+    )
+    return True
 
-def init_db(conn) -> None:
-    """Cria tabelas que faltarem no Supabase (safe para rodar várias vezes)."""
+
+def _particionar_movements(cur) -> None:
+    """
+    Migração 2: recria movements como tabela particionada por RANGE (ts), uma
+    partição por mês do histórico até MOVEMENTS_MONTHS_AHEAD meses à frente.
+    A PK passa a ser (id, ts), exigência do particionamento; a sequência de id é mantida.
+    """
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = 'movements'::regclass")
+    if cur.fetchone()["relkind"] == "p":
+        return
+    cur.execute("LOCK TABLE movements IN ACCESS EXCLUSIVE MODE")
+    cur.execute("ALTER TABLE movements RENAME TO movements_legacy")
+    cur.execute("ALTER INDEX movements_pkey RENAME TO movements_legacy_pkey")
+    cur.execute("DROP INDEX IF EXISTS idx_movements_store_type_ts, idx_movements_store_ts")
+    cur.execute("ALTER SEQUENCE movements_id_seq OWNED BY NONE")
+    cur.execute("""
+        CREATE TABLE movements (
+            id INTEGER NOT NULL DEFAULT nextval('movements_id_seq'),
+            ts TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT NOW(),
+            type TEXT NOT NULL CHECK (type IN ('receipt','sale','adjustment')),
+            ean TEXT NOT NULL,
+            lot TEXT NOT NULL,
+            qty INTEGER NOT NULL,
+            note TEXT,
+            store_id INTEGER REFERENCES stores(id) ON DELETE CASCADE,
+            PRIMARY KEY (id, ts)
+        ) PARTITION BY RANGE (ts)
+    """)
+    cur.execute("CREATE TABLE movements_default PARTITION OF movements DEFAULT")
+
+    cur.execute("SELECT MIN(ts) AS inicio FROM movements_legacy")
+    primeiro = cur.fetchone()["inicio"]
+    hoje = date.today()
+    mes = _mes(primeiro) if primeiro is not None else _mes(hoje)
+    while mes <= _mes(hoje, MOVEMENTS_MONTHS_AHEAD):
+        _criar_particao_mes(cur, mes)
+        mes = _mes(mes, 1)
+
+    cur.execute("""
+        INSERT INTO movements (id, ts, type, ean, lot, qty, note, store_id)
+        SELECT id, COALESCE(ts, NOW()), type, ean, lot, qty, note, store_id FROM movements_legacy
+    """)
+    cur.execute("DROP TABLE movements_legacy")
+    cur.execute("ALTER SEQUENCE movements_id_seq OWNED BY movements.id")
+    # no pai: cada partição (atual e futura) recebe o seu índice
+    cur.execute("CREATE INDEX idx_movements_store_type_ts ON movements(store_id, type, ts)")
+    cur.execute("CREATE INDEX idx_movements_store_ts ON movements(store_id, ts)")
+
+
+def manter_particoes(conn, meses_a_frente: int = MOVEMENTS_MONTHS_AHEAD) -> int:
+    """
+    Garante as partições mensais de movements do mês atual até `meses_a_frente`
+    meses adiante (rodar com frequência, ex.: no init_db ou diariamente).
+    Retorna quantas partições foram criadas.
+    """
+    with conn.cursor() as cur:
+        cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('movements')")
+        row = cur.fetchone()
+        if not row or row["relkind"] != "p":
+            return 0
+        cur.execute("SELECT pg_advisory_xact_lock(%s)", (_MIGRATIONS_LOCK_ID,))
+        hoje = date.today()
+        criadas = sum(_criar_particao_mes(cur, _mes(hoje, n)) for n in range(meses_a_frente + 1))
+    conn.commit()
+    return criadas
+
+
+# chave de estoque usada pelo repositório: local/loja NULL casam com ''/0
+STOCK_KEY_INDEX = "uq_stock_chave"
+STOCK_KEY_COLUMNS = "(ean, lot, (COALESCE(location, '')), (COALESCE(store_id, 0)))"
+
+
+def _unificar_chave_stock(cur) -> None:
+    """
+    Migração 3: índice único na chave de estoque com local/loja normalizados.
+    O UNIQUE(ean, lot, location, store_id) não casa NULLs, então duas primeiras
+    entradas simultâneas sem loja criavam registros duplicados. Duplicatas que já
+    existam são somadas no registro de menor id antes de criar o índice.
+    """
+    cur.execute("LOCK TABLE stock IN SHARE ROW EXCLUSIVE MODE")
+    cur.execute("""
+        UPDATE stock s SET qty = d.total
+        FROM (
+            SELECT MIN(id) AS id, SUM(qty) AS total FROM stock
+            GROUP BY ean, lot, COALESCE(location, ''), COALESCE(store_id, 0)
+            HAVING COUNT(*) > 1
+        ) d
+        WHERE s.id = d.id
+    """)
+    cur.execute("""
+        DELETE FROM stock s USING stock k
+        WHERE s.ean = k.ean AND s.lot = k.lot
+          AND COALESCE(s.location, '') = COALESCE(k.location, '')
+          AND COALESCE(s.store_id, 0) = COALESCE(k.store_id, 0)
+          AND s.id > k.id
+    """)
+    cur.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {STOCK_KEY_INDEX} ON stock {STOCK_KEY_COLUMNS}")
+
+
+# migrações versionadas (mesmo catálogo de db.py); os índices são criados com
+# CREATE INDEX CONCURRENTLY, sem bloquear escritas nas tabelas já populadas
+MIGRATIONS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    version INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    applied_at TIMESTAMP WITHOUT TIME ZONE DEFAULT NOW()
+);
+"""
+
+MIGRATIONS = [
+    (1, "indices_consultas_quentes", [
+        ("idx_movements_store_type_ts", "movements(store_id, type, ts)"),
+        ("idx_movements_store_ts", "movements(store_id, ts)"),
+        # sem qty na chave: manter os UPDATEs de saldo como HOT updates
+        ("idx_stock_store", "stock(store_id)"),
+        ("idx_users_store", "users(store_id) WHERE store_id IS NOT NULL"),
+        ("idx_nfe_documents_store", "nfe_documents(store_id) WHERE store_id IS NOT NULL"),
+    ]),
+    # migração de dados (função): roda em uma transação, sem CONCURRENTLY
+    (2, "movements_particionada", _particionar_movements),
+    (3, "stock_chave_unica", _unificar_chave_stock),
+]
+
+_MIGRATIONS_LOCK_ID = 7_245_001  # pg_advisory_lock: uma instância do app migra por vez
+
+
+_SCHEMA_READY = False
+_SCHEMA_LOCK = threading.Lock()
+
+
+def init_db(conn, force: bool = False) -> None:
+    """
+    Cria tabelas que faltarem no Supabase (safe para rodar várias vezes).
+    Roda a DDL uma única vez por processo; os reruns do Streamlit viram no-op.
+    Use force=True para reaplicar (ex.: depois de recriar o banco).
+    """
+    global _SCHEMA_READY
+    if _SCHEMA_READY and not force:
+        return
+    with _SCHEMA_LOCK:
+        if _SCHEMA_READY and not force:
+            return
+        _init_schema(conn)
+        _SCHEMA_READY = True
+
+
+def _init_schema(conn) -> None:
     with conn.cursor() as cur:
         cur.execute(STORES_SCHEMA)
         cur.execute(USERS_SCHEMA)
         cur.execute(SCHEMA)
+        cur.execute(STOCK_SNAPSHOT_SCHEMA)
+        cur.execute(NFE_DOCUMENTS_SCHEMA)
+        cur.execute(MOVEMENTS_DAILY_SCHEMA)
+        cur.execute(ALERT_OUTBOX_SCHEMA)
+        cur.execute(STORE_SETTINGS_SCHEMA)
+        cur.execute(MIGRATIONS_SCHEMA)
     conn.commit()
+    _aplicar_migracoes(conn)
+    manter_particoes(conn)
+
+
+def _aplicar_migracoes(conn) -> None:
+    """
+    Aplica as versões pendentes de MIGRATIONS. CONCURRENTLY não roda dentro de
+    transação, então a conexão fica em autocommit durante a migração. Um índice
+    que ficou INVALID (build concorrente interrompido) é removido e recriado.
+    """
+    autocommit = conn.autocommit
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_lock(%s)", (_MIGRATIONS_LOCK_ID,))
+            try:
+                cur.execute("SELECT version FROM schema_migrations")
+                aplicadas = {r["version"] for r in cur.fetchall()}
+                for versao, nome, passos in MIGRATIONS:
+                    if versao in aplicadas:
+                        continue
+                    if callable(passos):
+                        conn.autocommit = False
+                        try:
+                            with conn.cursor() as tx:
+                                passos(tx)
+                                tx.execute(
+                                    "INSERT INTO schema_migrations (version, name) VALUES (%s, %s) ON CONFLICT (version) DO NOTHING",
+                                    (versao, nome),
+                                )
+                            conn.commit()
+                        except Exception:
+                            conn.rollback()
+                            raise
+                        finally:
+                            conn.autocommit = True
+                        continue
+                    for indice, definicao in passos:
+                        cur.execute("""
+                            SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+                            WHERE c.relname = %s AND NOT i.indisvalid
+                        """, (indice,))
+                        if cur.fetchone():
+                            cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {indice}")
+                        cur.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {indice} ON {definicao}")
+                    cur.execute(
+                        "INSERT INTO schema_migrations (version, name) VALUES (%s, %s) ON CONFLICT (version) DO NOTHING",
+                        (versao, nome),
+                    )
+            finally:
+                cur.execute("SELECT pg_advisory_unlock(%s)", (_MIGRATIONS_LOCK_ID,))
+    finally:
+        conn.autocommit = autocommit
 
 
 # ---------- HELPERS DE USUÁRIO ----------
@@ -228,3 +750,184 @@ def get_store_id(conn, name: str) -> int:
         if row:
             return row["id"]
     return create_store(conn, name)
+
+
+# ---------- CARGA EM LOTE (COPY) ----------
+
+def _copy_valor(v) -> str:
+    """Formata um valor para o formato texto do COPY (\\N = NULL)."""
+    if v is None:
+        return r"\N"
+    if isinstance(v, float) and v != v:  # NaN
+        return r"\N"
+    return (
+        str(v)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+class _CopyStream(io.TextIOBase):
+    """Arquivo somente-leitura que gera as linhas do COPY sob demanda (sem montar tudo em memória)."""
+
+    def __init__(self, linhas):
+        self._linhas = iter(linhas)
+        self._buf = ""
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buf) < size:
+            try:
+                row = next(self._linhas)
+            except StopIteration:
+                break
+            self._buf += "\t".join(_copy_valor(v) for v in row) + "\n"
+        if size < 0:
+            out, self._buf = self._buf, ""
+        else:
+            out, self._buf = self._buf[:size], self._buf[size:]
+        return out
+
+
+def copy_rows(cur, tabela: str, colunas: list[str], linhas) -> None:
+    """Envia um iterável de tuplas para a tabela com COPY ... FROM STDIN (uma única ida ao servidor)."""
+    cur.copy_expert(
+        f"COPY {tabela} ({', '.join(colunas)}) FROM STDIN",
+        _CopyStream(linhas),
+    )
+
+
+def bulk_insert_ignore(conn, tabela: str, colunas: list[str], linhas, chave: str = "id") -> int:
+    """
+    Insere linhas via COPY numa tabela temporária e faz o merge com
+    INSERT ... ON CONFLICT (chave) DO NOTHING. Retorna o nº de linhas novas.
+    """
+    cols = ", ".join(colunas)
+    with conn.cursor() as cur:
+        cur.execute(f"CREATE TEMP TABLE _bulk_{tabela} (LIKE {tabela} INCLUDING DEFAULTS) ON COMMIT DROP")
+        copy_rows(cur, f"_bulk_{tabela}", colunas, linhas)
+        cur.execute(
+            f"INSERT INTO {tabela} ({cols}) SELECT {cols} FROM _bulk_{tabela} "
+            f"ON CONFLICT ({chave}) DO NOTHING"
+        )
+        inseridas = cur.rowcount
+    conn.commit()
+    return inseridas
+
+
+def bulk_merge_estoque(conn, itens, store_id: int | None, nota: str, modo: str = "adjustment") -> int:
+    """
+    Grava products, lots, stock e movements de uma vez, numa transação:
+    COPY das linhas para uma tabela temporária + merges set-based.
+
+    itens: iterável de (ean, product_name, lot, expiry_date, qty, location)
+    modo:
+      - "adjustment": o saldo passa a ser a qty da última linha de cada
+        (ean, lote, local), como na importação de planilha;
+      - "receipt": as quantidades são somadas ao saldo, como nas entradas de NF-e.
+    Lotes sem validade recebem CURRENT_DATE + 180 dias.
+    Retorna o nº de linhas processadas.
+    """
+    if modo not in ("adjustment", "receipt"):
+        raise ValueError(f"Modo de carga inválido: {modo}")
+
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                CREATE TEMP TABLE _bulk_stage (
+                    seq BIGSERIAL,
+                    ean TEXT NOT NULL,
+                    product_name TEXT NOT NULL,
+                    lot TEXT NOT NULL,
+                    expiry_date DATE,
+                    qty INTEGER NOT NULL,
+                    location TEXT
+                ) ON COMMIT DROP
+            """)
+            copy_rows(cur, "_bulk_stage", ["ean", "product_name", "lot", "expiry_date", "qty", "location"], itens)
+
+            cur.execute("SELECT COUNT(*) AS n, COUNT(*) FILTER (WHERE qty <= 0) AS invalidas FROM _bulk_stage")
+            contagem = cur.fetchone()
+            if modo == "receipt" and contagem["invalidas"]:
+                raise ValueError("Quantidade deve ser maior que zero.")
+
+            # produtos: último nome não vazio de cada EAN
+            cur.execute("""
+                INSERT INTO products (ean, product_name)
+                SELECT DISTINCT ON (ean) ean, product_name
+                FROM _bulk_stage
+                ORDER BY ean, (product_name <> '') DESC, seq DESC
+                ON CONFLICT (ean) DO UPDATE
+                SET product_name = EXCLUDED.product_name
+                WHERE EXCLUDED.product_name <> ''
+                  AND products.product_name IS DISTINCT FROM EXCLUDED.product_name
+            """)
+
+            # lotes: primeira validade informada
+            cur.execute("""
+                INSERT INTO lots (ean, lot, expiry_date)
+                SELECT DISTINCT ON (ean, lot) ean, lot, COALESCE(expiry_date, CURRENT_DATE + 180)
+                FROM _bulk_stage
+                ORDER BY ean, lot, seq
+                ON CONFLICT (ean, lot) DO NOTHING
+            """)
+
+            # estoque: saldo final (ajuste) ou soma das entradas (recebimento) por (ean, lote, local)
+            if modo == "adjustment":
+                cur.execute("""
+                    CREATE TEMP TABLE _bulk_stock ON COMMIT DROP AS
+                    SELECT DISTINCT ON (ean, lot, location) ean, lot, location, GREATEST(qty, 0) AS qty
+                    FROM _bulk_stage
+                    ORDER BY ean, lot, location, seq DESC
+                """)
+                novo_saldo = "f.qty"
+                saldo_conflito = "EXCLUDED.qty"
+            else:
+                cur.execute("""
+                    CREATE TEMP TABLE _bulk_stock ON COMMIT DROP AS
+                    SELECT ean, lot, location, SUM(qty)::INTEGER AS qty
+                    FROM _bulk_stage
+                    GROUP BY ean, lot, location
+                """)
+                novo_saldo = "s.qty + f.qty"
+                saldo_conflito = "stock.qty + EXCLUDED.qty"
+
+            # local/loja podem ser NULL, e o UNIQUE do Postgres não casa NULLs:
+            # por isso o UPDATE ... FROM com IS NOT DISTINCT FROM antes do INSERT
+            cur.execute(f"""
+                UPDATE stock s
+                SET qty = {novo_saldo}
+                FROM _bulk_stock f
+                WHERE s.ean = f.ean AND s.lot = f.lot
+                  AND s.location IS NOT DISTINCT FROM f.location
+                  AND s.store_id IS NOT DISTINCT FROM %s
+            """, (store_id,))
+            cur.execute(f"""
+                INSERT INTO stock (ean, lot, qty, location, store_id)
+                SELECT f.ean, f.lot, f.qty, f.location, %s
+                FROM _bulk_stock f
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM stock s
+                    WHERE s.ean = f.ean AND s.lot = f.lot
+                      AND s.location IS NOT DISTINCT FROM f.location
+                      AND s.store_id IS NOT DISTINCT FROM %s
+                )
+                ON CONFLICT {STOCK_KEY_COLUMNS} DO UPDATE SET qty = {saldo_conflito}
+            """, (store_id, store_id))
+
+            # um movimento por linha, na ordem do arquivo
+            cur.execute("""
+                INSERT INTO movements (type, ean, lot, qty, note, store_id)
+                SELECT %s, ean, lot, qty, %s, %s
+                FROM _bulk_stage
+                ORDER BY seq
+            """, (modo, nota, store_id))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return contagem["n"]
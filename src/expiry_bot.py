@@ -5,8 +5,12 @@ from datetime import datetime
 import pandas as pd
 from db import get_conn, init_db
 import reporting
+from repository import get_repository
 import sqlite3
 import smtplib
+import threading
+import time
+import atexit
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.base import MIMEBase
@@ -26,30 +30,27 @@ def garantir_db(cfg):
 
 
 # === IMPORTAÇÃO DE PLANILHA ===
-def importar_planilha(conn, caminho_arquivo, store_id=None):
-    df = (
-        pd.read_excel(caminho_arquivo)
-        if caminho_arquivo.lower().endswith(".xlsx")
-        else pd.read_csv(caminho_arquivo)
-    )
-
-    # aceitar cabeçalhos em PT-BR
-    mapa = {
-        "ean": "ean",
-        "nome_produto": "product_name",
-        "produto": "product_name",
-        "product_name": "product_name",
-        "lote": "lot",
-        "data_validade": "expiry_date",
-        "validade": "expiry_date",
-        "expiry_date": "expiry_date",
-        "quantidade": "qty",
-        "qty": "qty",
-        "local": "location",
-        "location": "location",
-    }
-    cols_norm = {c: mapa.get(c.strip().lower(), c.strip().lower()) for c in df.columns}
-    df.rename(columns=cols_norm, inplace=True)
+# aceitar cabeçalhos em PT-BR
+MAPA_COLUNAS_PLANILHA = {
+    "ean": "ean",
+    "nome_produto": "product_name",
+    "produto": "product_name",
+    "product_name": "product_name",
+    "lote": "lot",
+    "data_validade": "expiry_date",
+    "validade": "expiry_date",
+    "expiry_date": "expiry_date",
+    "quantidade": "qty",
+    "qty": "qty",
+    "local": "location",
+    "location": "location",
+}
+
+
+def _normalizar_planilha(df):
+    """Renomeia cabeçalhos, valida colunas/datas e devolve as linhas prontas para gravar."""
+    cols_norm = {c: MAPA_COLUNAS_PLANILHA.get(str(c).strip().lower(), str(c).strip().lower()) for c in df.columns}
+    df = df.rename(columns=cols_norm)
 
     required = {"ean", "product_name", "lot", "expiry_date", "qty", "location"}
     missing = required - set(df.columns.str.lower())
@@ -61,15 +62,21 @@ def importar_planilha(conn, caminho_arquivo, store_id=None):
         bad = df[df["expiry_date"].isna()]
         raise ValueError(f"Datas de validade inválidas nas linhas: {bad.index.tolist()}")
 
-    cur = conn.cursor()
-    for _, r in df.iterrows():
-        ean = str(r["ean"]).strip()
-        pname = str(r["product_name"]).strip()
-        lot = str(r["lot"]).strip()
-        expiry = r["expiry_date"].date().isoformat()
-        qty = int(r["qty"])
-        location = None if pd.isna(r.get("location")) else str(r["location"]).strip()
+    out = pd.DataFrame({
+        "ean": df["ean"].fillna("").astype(str).str.strip(),
+        "product_name": df["product_name"].fillna("").astype(str).str.strip(),
+        "lot": df["lot"].fillna("").astype(str).str.strip(),
+        "expiry_date": df["expiry_date"].dt.strftime("%Y-%m-%d"),
+        "qty": df["qty"].astype(int),
+        "location": df["location"].astype(str).str.strip().astype(object).where(df["location"].notna(), None),
+    }, index=df.index)
+    return out
+
 
+def _aplicar_planilha_por_linha(conn, linhas, store_id, nota):
+    """Caminho original: seis comandos por linha da planilha."""
+    cur = conn.cursor()
+    for ean, pname, lot, expiry, qty, location in linhas.itertuples(index=False, name=None):
         cur.execute("INSERT OR IGNORE INTO products(ean, product_name) VALUES(?,?)", (ean, pname))
         cur.execute(
             "UPDATE products SET product_name=COALESCE(NULLIF(?, ''), product_name) WHERE ean=?",
@@ -89,20 +96,388 @@ def importar_planilha(conn, caminho_arquivo, store_id=None):
         )
         cur.execute(
             "INSERT INTO movements(type, ean, lot, qty, note, store_id) VALUES('adjustment',?,?,?,?,?)",
-            (ean, lot, qty, f"Importação {Path(caminho_arquivo).name}", store_id),
+            (ean, lot, qty, nota, store_id),
         )
-    conn.commit()
+
+
+def _aplicar_planilha_em_lote(conn, linhas, store_id, nota, modo="adjustment"):
+    """
+    Caminho em lote: carrega as linhas numa tabela temporária com executemany
+    e aplica products, lots, stock e movements com poucos INSERT ... SELECT.
+    Mesmo resultado do caminho por linha: nome do produto = último não vazio,
+    validade do lote = primeira ocorrência, saldo = última linha de cada
+    (ean, lote, local) e um movimento 'adjustment' por linha do arquivo.
+    Com modo="receipt" (entradas de NF-e) as quantidades são somadas ao saldo,
+    como em db_supabase.bulk_merge_estoque; lotes sem validade recebem hoje + 180 dias.
+    """
+    if modo not in ("adjustment", "receipt"):
+        raise ValueError(f"Modo de carga inválido: {modo}")
+    cur = conn.cursor()
+    cur.execute("DROP TABLE IF EXISTS temp._import_stage")
+    cur.execute("DROP TABLE IF EXISTS temp._import_final")
+    cur.execute("""
+        CREATE TEMP TABLE _import_stage (
+            seq INTEGER PRIMARY KEY,
+            ean TEXT NOT NULL,
+            product_name TEXT NOT NULL,
+            lot TEXT NOT NULL,
+            expiry_date TEXT,
+            qty INTEGER NOT NULL,
+            location TEXT
+        )
+    """)
+    cur.executemany(
+        "INSERT INTO _import_stage(ean, product_name, lot, expiry_date, qty, location) VALUES(?,?,?,?,?,?)",
+        linhas.itertuples(index=False, name=None),
+    )
+    cur.execute("CREATE INDEX temp._import_stage_ean ON _import_stage(ean, seq)")
+    if modo == "receipt" and cur.execute("SELECT 1 FROM _import_stage WHERE qty <= 0 LIMIT 1").fetchone():
+        raise ValueError("Quantidade deve ser maior que zero.")
+
+    # produtos: cria os que faltam e aplica o último nome não vazio
+    cur.execute("""
+        INSERT OR IGNORE INTO products(ean, product_name)
+        SELECT ean, product_name FROM _import_stage ORDER BY seq
+    """)
+    cur.execute("""
+        UPDATE products
+        SET product_name = (
+            SELECT st.product_name FROM _import_stage st
+            WHERE st.ean = products.ean AND st.product_name <> ''
+            ORDER BY st.seq DESC LIMIT 1
+        )
+        WHERE ean IN (SELECT ean FROM _import_stage WHERE product_name <> '')
+    """)
+
+    # lotes: a primeira validade informada vence (INSERT OR IGNORE)
+    cur.execute("""
+        INSERT OR IGNORE INTO lots(ean, lot, expiry_date)
+        SELECT ean, lot, IFNULL(expiry_date, date('now', '+180 days')) FROM _import_stage ORDER BY seq
+    """)
+
+    # estoque: saldo final = última linha de cada (ean, lote, local) no ajuste,
+    # ou a soma das linhas no recebimento
+    if modo == "adjustment":
+        cur.execute("""
+            CREATE TEMP TABLE _import_final AS
+            SELECT ean, lot, location, IFNULL(location, '') AS loc_key, MAX(qty, 0) AS qty
+            FROM _import_stage
+            WHERE seq IN (SELECT MAX(seq) FROM _import_stage GROUP BY ean, lot, IFNULL(location, ''))
+        """)
+        novo_saldo = "f.qty"
+    else:
+        cur.execute("""
+            CREATE TEMP TABLE _import_final AS
+            SELECT ean, lot, MAX(location) AS location, IFNULL(location, '') AS loc_key, SUM(qty) AS qty
+            FROM _import_stage
+            GROUP BY ean, lot, IFNULL(location, '')
+        """)
+        novo_saldo = "stock.qty + f.qty"
+    cur.execute("CREATE UNIQUE INDEX temp._import_final_key ON _import_final(ean, lot, loc_key)")
+    cur.execute(f"""
+        UPDATE stock
+        SET qty = (
+            SELECT {novo_saldo} FROM _import_final f
+            WHERE f.ean = stock.ean AND f.lot = stock.lot AND f.loc_key = IFNULL(stock.location, '')
+        )
+        WHERE (ean, lot) IN (SELECT ean, lot FROM _import_final)
+          AND store_id IS ?
+          AND EXISTS (
+            SELECT 1 FROM _import_final f
+            WHERE f.ean = stock.ean AND f.lot = stock.lot AND f.loc_key = IFNULL(stock.location, '')
+          )
+    """, (store_id,))
+    cur.execute("""
+        INSERT INTO stock(ean, lot, qty, location, store_id)
+        SELECT f.ean, f.lot, f.qty, f.location, ?
+        FROM _import_final f
+        WHERE NOT EXISTS (
+            SELECT 1 FROM stock s
+            WHERE s.ean = f.ean AND s.lot = f.lot
+              AND IFNULL(s.location, '') = f.loc_key AND s.store_id IS ?
+        )
+    """, (store_id, store_id))
+
+    # um movimento por linha do arquivo
+    cur.execute("""
+        INSERT INTO movements(type, ean, lot, qty, note, store_id)
+        SELECT ?, ean, lot, qty, ?, ? FROM _import_stage ORDER BY seq
+    """, (modo, nota, store_id))
+
+    cur.execute("DROP TABLE temp._import_final")
+    cur.execute("DROP TABLE temp._import_stage")
+
+
+def _gravar_planilha(conn, linhas, store_id, nota, bulk=True, modo="adjustment"):
+    """Grava as linhas normalizadas numa transação, no caminho certo para o banco."""
+    if not isinstance(conn, sqlite3.Connection):
+        # Postgres (Supabase): COPY para tabela temporária + merges, já com commit
+        import db_supabase
+        db_supabase.bulk_merge_estoque(
+            conn, linhas.itertuples(index=False, name=None), store_id, nota, modo=modo
+        )
+        return
+
+    try:
+        if bulk or modo != "adjustment":
+            _aplicar_planilha_em_lote(conn, linhas, store_id, nota, modo=modo)
+        else:
+            _aplicar_planilha_por_linha(conn, linhas, store_id, nota)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def importar_planilha(conn, caminho_arquivo, store_id=None, bulk=True):
+    """
+    Importa uma planilha de estoque (XLSX/CSV) para a loja informada.
+    bulk=True (padrão) usa o caminho em lote via tabela temporária;
+    bulk=False mantém o caminho original linha a linha.
+    Em conexões Postgres a carga vai sempre por COPY (db_supabase.bulk_merge_estoque).
+    """
+    df = (
+        pd.read_excel(caminho_arquivo)
+        if caminho_arquivo.lower().endswith(".xlsx")
+        else pd.read_csv(caminho_arquivo)
+    )
+    linhas = _normalizar_planilha(df)
+    nota = f"Importação {Path(caminho_arquivo).name}"
+
+    _gravar_planilha(conn, linhas, store_id, nota, bulk=bulk)
+
+    return {
+        "total_itens": len(linhas),
+        "sucesso": True,
+        "mensagem": f"{len(linhas)} itens importados para a loja {store_id or 'Global'}.",
+    }
+
+
+# === IMPORTAÇÃO EM BLOCOS (ARQUIVOS GRANDES) ===
+TAMANHO_BLOCO_IMPORTACAO = 5000
+
+
+def _contar_linhas_csv(caminho_arquivo):
+    """Conta as linhas de dados do CSV lendo em blocos binários (memória constante)."""
+    total = 0
+    with open(caminho_arquivo, "rb") as f:
+        for buf in iter(lambda: f.read(1 << 20), b""):
+            total += buf.count(b"\n")
+    return max(total - 1, 0)
+
+
+def _blocos_de_linhas(linhas, tamanho_bloco):
+    """Agrupa um iterador de linhas (cabeçalho primeiro) em DataFrames de até N linhas."""
+    linhas = iter(linhas)
+    cabecalho = [str(c) if c is not None else "" for c in next(linhas, [])]
+    bloco, inicio = [], 0
+    for row in linhas:
+        if row is None or all(v is None or v == "" for v in row):
+            continue
+        bloco.append(row)
+        if len(bloco) >= tamanho_bloco:
+            yield pd.DataFrame(bloco, columns=cabecalho, index=range(inicio, inicio + len(bloco)))
+            inicio += len(bloco)
+            bloco = []
+    if bloco:
+        yield pd.DataFrame(bloco, columns=cabecalho, index=range(inicio, inicio + len(bloco)))
+
+
+def _ler_planilha_em_blocos(caminho_arquivo, tamanho_bloco, motor_excel=None):
+    """
+    Lê a planilha em blocos de DataFrame, sem carregar o arquivo inteiro.
+    Retorna (gerador_de_blocos, total_de_linhas_ou_None).
+      - CSV: pd.read_csv com chunksize
+      - XLSX: iterador read-only do openpyxl (memória constante); com
+        motor_excel="calamine" usa o python-calamine, se instalado, que é
+        bem mais rápido mas mantém a aba inteira em memória nativa.
+    """
+    if not caminho_arquivo.lower().endswith(".xlsx"):
+        return pd.read_csv(caminho_arquivo, chunksize=tamanho_bloco), _contar_linhas_csv(caminho_arquivo)
+
+    if motor_excel == "calamine":
+        try:
+            from python_calamine import CalamineWorkbook
+        except ImportError:
+            motor_excel = None
+        else:
+            sheet = CalamineWorkbook.from_path(caminho_arquivo).get_sheet_by_index(0)
+            return _blocos_de_linhas(sheet.iter_rows(), tamanho_bloco), max(sheet.height - 1, 0)
+
+    from openpyxl import load_workbook
+    wb = load_workbook(caminho_arquivo, read_only=True, data_only=True)
+    ws = wb.worksheets[0]
+    total = (ws.max_row - 1) if ws.max_row else None
+
+    def _gerar():
+        try:
+            yield from _blocos_de_linhas(ws.iter_rows(values_only=True), tamanho_bloco)
+        finally:
+            wb.close()
+
+    return _gerar(), total
+
+
+def importar_planilha_em_blocos(conn, caminho_arquivo, store_id=None,
+                                tamanho_bloco=TAMANHO_BLOCO_IMPORTACAO, progresso=None, motor_excel=None):
+    """
+    Importação em streaming para planilhas muito grandes: cada bloco é lido,
+    validado e gravado (caminho em lote) na sua própria transação, então o
+    pico de memória não depende do tamanho do arquivo e um erro aparece no
+    bloco em que ocorre, sem esperar a leitura do arquivo inteiro.
+    progresso(linhas_processadas, total_ou_None) é chamado após cada bloco.
+    Blocos já gravados permanecem se um bloco posterior falhar.
+    """
+    blocos, total = _ler_planilha_em_blocos(caminho_arquivo, tamanho_bloco, motor_excel)
+    nota = f"Importação {Path(caminho_arquivo).name}"
+    processadas = 0
+    n_blocos = 0
+
+    for bloco in blocos:
+        try:
+            linhas = _normalizar_planilha(bloco)
+        except ValueError as e:
+            raise ValueError(f"{e} ({processadas} linha(s) já importada(s) antes deste bloco)") from e
+
+        _gravar_planilha(conn, linhas, store_id, nota)
+
+        processadas += len(linhas)
+        n_blocos += 1
+        if progresso:
+            progresso(processadas, total)
 
     return {
-        "total_itens": len(df),
+        "total_itens": processadas,
         "sucesso": True,
-        "mensagem": f"{len(df)} itens importados para a loja {store_id or 'Global'}.",
+        "mensagem": f"{processadas} itens importados para a loja {store_id or 'Global'} em {n_blocos} bloco(s).",
+    }
+
+
+# === IMPORTAÇÃO DE NF-e EM LOTE ===
+def _linhas_nfe(df_nfe, store_id):
+    """Converte o DataFrame de parse_nfe_xml no formato de _gravar_planilha (entrada)."""
+    # int() por item, como no painel original: qCom fracionário é truncado (2.6 -> 2)
+    qty = df_nfe["qty"].fillna(0).astype(float).astype(int)
+    return pd.DataFrame({
+        "ean": df_nfe["ean"].astype(str),
+        "product_name": df_nfe["product_name"].fillna("").astype(str),
+        "lot": df_nfe["lot"].astype(str),
+        "expiry_date": df_nfe["expiry_date"].dt.strftime("%Y-%m-%d").astype(object)
+                       .where(df_nfe["expiry_date"].notna(), None),
+        "qty": qty,
+        "location": f"Loja {store_id}",
+    })[qty > 0]
+
+
+def aplicar_nfes(conn, notas, store_id=None):
+    """
+    Aplica NF-e já lidas numa única transação, tudo ou nada:
+    products, lots, stock (somando as entradas) e um movimento 'receipt' por
+    item, com comandos em lote (staging + INSERT ... SELECT no SQLite, COPY +
+    merges no Postgres), e o registro de cada nota em nfe_documents.
+
+    notas: iterável de (chave, origem, df_nfe), com df_nfe vindo de
+    nfe_import.parse_nfe_xml; chave=None grava sem controle de duplicidade.
+    Retorna {chave: nº de itens gravados} para as notas aplicadas; notas que
+    já constam como importadas ficam de fora. Em erro faz rollback e relança.
+    """
+    repo = get_repository(conn)
+    aplicadas, blocos = {}, []
+    try:
+        for chave, origem, df_nfe in notas:
+            linhas = _linhas_nfe(df_nfe, store_id)
+            # importação concorrente da mesma nota: quem registrar primeiro aplica
+            if chave is not None and not repo.claim_nfe_document(chave, origem, store_id, len(linhas)):
+                continue
+            aplicadas[chave] = len(linhas)
+            blocos.append(linhas)
+
+        linhas = pd.concat(blocos, ignore_index=True) if blocos else None
+        if linhas is not None and len(linhas):
+            nota = f"Importado via NF-e ({len(blocos)} arquivo(s))"
+            _gravar_planilha(conn, linhas, store_id, nota, modo="receipt")  # commit único
+        else:
+            repo.commit()
+    except Exception:
+        repo.rollback()
+        raise
+    return aplicadas
+
+
+def aplicar_nfe(conn, df_nfe, store_id=None, chave=None, origem=None):
+    """Aplica uma NF-e lida por parse_nfe_xml numa transação. Retorna o nº de itens, ou None se já importada."""
+    return aplicar_nfes(conn, [(chave, origem, df_nfe)], store_id=store_id).get(chave)
+
+
+def importar_nfes_em_lote(conn, origem, store_id=None, max_workers=None):
+    """
+    Importa várias NF-e de uma vez: origem é uma pasta, um .zip ou uma lista de
+    (nome, bytes) vinda do uploader. Os XMLs são lidos em paralelo
+    (nfe_import.parse_nfes_em_lote) e todos os itens perecíveis entram como
+    'receipt' numa única transação da loja.
+
+    A importação é idempotente: cada nota é identificada pela chave de acesso
+    (ou pelo hash do arquivo) e consultada em nfe_documents antes do parse;
+    notas já importadas (ou repetidas no mesmo lote) são puladas como
+    'duplicada'. O registro em nfe_documents é gravado na mesma transação do
+    estoque. Arquivos com erro ficam de fora, aparecem no resumo por arquivo
+    e podem ser reenviados.
+    """
+    from nfe_import import _fontes_nfe, chave_nfe, parse_nfes_em_lote
+
+    repo = get_repository(conn)
+    fontes = _fontes_nfe(origem)
+    chaves = [chave_nfe(fonte) for _, fonte in fontes]
+    ja_importadas = repo.nfe_imported(chaves)
+
+    resumo, pendentes, vistas = [], [], set()
+    for (nome, fonte), chave in zip(fontes, chaves):
+        item = {"arquivo": nome, "chave": chave, "status": "duplicada", "itens": 0, "erro": None}
+        resumo.append(item)
+        if chave in ja_importadas or chave in vistas:
+            continue
+        vistas.add(chave)
+        pendentes.append((item, nome, fonte))
+
+    lidas = parse_nfes_em_lote([(nome, fonte) for _, nome, fonte in pendentes], max_workers=max_workers)
+
+    lidas_ok = []
+    for (item, _, _), (_, df_nfe, erro) in zip(pendentes, lidas):
+        if erro:
+            item.update(status="erro", erro=erro)
+        else:
+            lidas_ok.append((item, df_nfe))
+
+    aplicadas = aplicar_nfes(conn, [(item["chave"], item["arquivo"], df) for item, df in lidas_ok], store_id)
+    for item, _ in lidas_ok:
+        if item["chave"] in aplicadas:
+            n = aplicadas[item["chave"]]
+            item.update(status="ok" if n else "sem perecíveis", itens=n)
+    total = sum(aplicadas.values())
+
+    erros = [r for r in resumo if r["status"] == "erro"]
+    if erros:
+        for r in erros:
+            repo.record_nfe_error(r["chave"], r["arquivo"], store_id, r["erro"])
+        repo.commit()
+
+    duplicadas = sum(1 for r in resumo if r["status"] == "duplicada")
+    importadas = len(resumo) - len(erros) - duplicadas
+    return {
+        "total_itens": total,
+        "sucesso": not erros,
+        "mensagem": (
+            f"{total} itens de {importadas} NF-e importados para a loja {store_id or 'Global'}"
+            + (f"; {duplicadas} NF-e já importada(s) ignorada(s)" if duplicadas else "")
+            + (f"; {len(erros)} arquivo(s) com erro." if erros else ".")
+        ),
+        "arquivos": resumo,
     }
 
 
 # === MOVIMENTAÇÃO (ENTRADA/SAÍDA) ===
 def movimentar(conn, tipo, ean, lot, qty, observacao=None, local=None, store_id=None):
-    """Registra entrada ou saída de estoque, criando o registro se necessário."""
+    """Registra entrada ou saída de estoque, criando o registro se necessário. Retorna o novo saldo."""
     if not ean or not lot:
         raise ValueError("EAN e Lote são obrigatórios.")
     if qty <= 0:
@@ -112,106 +487,389 @@ def movimentar(conn, tipo, ean, lot, qty, observacao=None, local=None, store_id=
     if tipo not in ("receipt", "sale"):
         raise ValueError(f"Tipo de movimento inválido: {tipo}")
 
-    cur = conn.cursor()
-    sign = 1 if tipo == "receipt" else -1
-
-    # Usa 0 como padrão se não houver loja vinculada
-    store_id = store_id or 0
+    # Sem loja vinculada o registro fica com store_id NULL (0 violaria a FK de stores)
+    store_id = store_id or None
     local = local or "Loja 01"
 
-    # Cria o registro de estoque se não existir
-    cur.execute("""
-        INSERT OR IGNORE INTO stock (ean, lot, qty, location, store_id)
-        VALUES (?, ?, 0, ?, ?)
-    """, (ean, lot, local, store_id))
+    # Saldo e movimento numa operação atômica: sem ler-calcular-gravar em Python,
+    # duas vendas simultâneas do mesmo lote não perdem atualização nem negativam
+    # (o savepoint desfaz só este movimento, sem perder o que o chamador ainda não confirmou)
+    repo = get_repository(conn)
+    repo.savepoint("movimentar")
+    try:
+        ok, saldo = repo.move_stock(tipo, ean, lot, qty, observacao or "", local, store_id)
+    except Exception:
+        repo.rollback_to_savepoint("movimentar")
+        raise
+    if not ok:
+        # saldo insuficiente: move_stock não gravou nada
+        repo.release_savepoint("movimentar")
+        raise ValueError(f"Estoque insuficiente para {ean}-{lot}: atual={saldo}, tentativa={qty}")
+    repo.commit()
+    return saldo
+
+
+
+COLUNAS_MOVIMENTO = ["tipo", "ean", "lot", "qty", "observacao", "local", "store_id"]
+
+
+def _normalizar_movimentos(movimentos):
+    """Lista de dicts/tuplas (na ordem dos parâmetros de movimentar) ou DataFrame -> DataFrame padronizado."""
+    if isinstance(movimentos, pd.DataFrame):
+        df = movimentos.reindex(columns=COLUNAS_MOVIMENTO).reset_index(drop=True)
+    else:
+        movimentos = list(movimentos)
+        if movimentos and isinstance(movimentos[0], dict):
+            df = pd.DataFrame(movimentos).reindex(columns=COLUNAS_MOVIMENTO)
+        else:
+            df = pd.DataFrame([tuple(m) for m in movimentos],
+                              columns=COLUNAS_MOVIMENTO[:max((len(m) for m in movimentos), default=4)])
+            df = df.reindex(columns=COLUNAS_MOVIMENTO)
+
+    out = pd.DataFrame({
+        "tipo": df["tipo"].fillna("").astype(str).str.strip().str.lower(),
+        "ean": df["ean"].fillna("").astype(str).str.strip(),
+        "lot": df["lot"].fillna("").astype(str).str.strip(),
+        "qty": pd.to_numeric(df["qty"], errors="coerce"),
+        "observacao": df["observacao"].fillna("").astype(str),
+        # mesmos padrões de movimentar: local "Loja 01" e loja NULL quando não informada
+        "local": df["local"].where(df["local"].notna() & (df["local"].astype(str).str.strip() != ""), "Loja 01").astype(str),
+        "store_id": pd.to_numeric(df["store_id"], errors="coerce").astype("Int64"),
+    })
+    out.loc[out["store_id"] == 0, "store_id"] = pd.NA
+    return out
+
+
+def movimentar_lote(conn, movimentos):
+    """
+    Registra várias entradas (receipt) e saídas (sale) numa única transação.
 
-    # Busca registro existente
-    row = cur.execute("""
-        SELECT id, qty FROM stock
-        WHERE ean=? AND lot=? AND IFNULL(store_id,0)=? AND IFNULL(location,'')=IFNULL(?, '')
-    """, (ean, lot, store_id, local)).fetchone()
+    movimentos: DataFrame com as colunas tipo, ean, lot, qty[, observacao, local,
+    store_id] ou lista de dicts/tuplas na ordem dos parâmetros de movimentar.
 
-    if not row:
-        raise sqlite3.IntegrityError("Falha ao localizar o registro de estoque após criação.")
+    As linhas são validadas de forma vetorizada; os deltas são somados por
+    (ean, lote, local, loja) e aplicados com poucos comandos set-based, mais um
+    executemany dos movimentos. O saldo é verificado na ordem das linhas: se em
+    algum ponto uma chave ficaria negativa (ou o lote não existe), todas as
+    linhas dessa chave são rejeitadas e as demais seguem.
 
-    stock_id, current_qty = row
-    new_qty = current_qty + (sign * qty)
-    if new_qty < 0:
-        raise ValueError(f"Estoque insuficiente para {ean}-{lot}: atual={current_qty}, tentativa={qty}")
+    Retorna um DataFrame por linha de entrada com status ('ok' | 'erro'),
+    erro e saldo (saldo da chave logo após a linha).
+    """
+    df = _normalizar_movimentos(movimentos)
+    df["status"] = "ok"
+    df["erro"] = None
+    df["saldo"] = pd.array([pd.NA] * len(df), dtype="Int64")
+
+    def rejeitar(mask, msg):
+        mask = mask & (df["status"] == "ok")
+        df.loc[mask, "status"] = "erro"
+        df.loc[mask, "erro"] = msg if isinstance(msg, str) else msg[mask]
+
+    rejeitar((df["ean"] == "") | (df["lot"] == ""), "EAN e Lote são obrigatórios.")
+    rejeitar(~df["tipo"].isin(["receipt", "sale"]), "Tipo de movimento inválido: " + df["tipo"])
+    rejeitar(df["qty"].isna() | (df["qty"] <= 0) | (df["qty"] % 1 != 0), "Quantidade deve ser maior que zero.")
+
+    validas = df[df["status"] == "ok"].copy()
+    if validas.empty:
+        return df
+
+    validas["qty"] = validas["qty"].astype(int)
+    validas["delta"] = validas["qty"].where(validas["tipo"] == "receipt", -validas["qty"])
+    validas["_store"] = validas["store_id"].fillna(0).astype(int)
+    chave = ["ean", "lot", "local", "_store"]
+
+    repo = get_repository(conn)
+    try:
+        deltas = validas.groupby(chave, sort=False)["delta"].sum().reset_index()
+        repo.stage_stock_deltas(
+            (e, l, loc, (int(st) or None), int(d)) for e, l, loc, st, d in deltas.itertuples(index=False, name=None)
+        )
+        saldos = pd.DataFrame(repo.staged_stock_balances(),
+                              columns=["ean", "lot", "local", "store_id", "atual", "lote_existe"])
+        saldos["_store"] = saldos["store_id"].fillna(0).astype(int)
+        # uma linha por chave, mesmo que o estoque tenha registros duplicados
+        saldos = saldos.groupby(chave, sort=False).agg(atual=("atual", "sum"), lote_existe=("lote_existe", "max"))
+        validas = validas.join(saldos, on=chave)
+
+        # verificação vetorizada do saldo corrente de cada chave
+        validas["saldo"] = validas["atual"] + validas.groupby(chave, sort=False)["delta"].cumsum()
+        por_chave = validas.groupby(chave, sort=False)
+        negativa = por_chave["saldo"].transform("min") < 0
+        sem_lote = validas["lote_existe"] == 0
+        ruins = negativa | sem_lote
+
+        df.loc[validas.index, "saldo"] = validas["saldo"].astype("Int64")
+        msg = pd.Series(
+            "Estoque insuficiente para " + validas["ean"] + "-" + validas["lot"]
+            + ": atual=" + validas["atual"].astype(str),
+            index=validas.index,
+        ).where(~sem_lote, "Lote não cadastrado: " + validas["ean"] + "-" + validas["lot"])
+        rejeitar(df.index.isin(validas.index[ruins]), msg.reindex(df.index))
+        df.loc[df["status"] == "erro", "saldo"] = pd.NA
+
+        if ruins.any():
+            rejeitadas = validas[ruins].drop_duplicates(chave)
+            repo.unstage_stock_keys(
+                (e, l, loc, st or None) for e, l, loc, st in rejeitadas[chave].itertuples(index=False, name=None)
+            )
+
+        aceitas = validas[~ruins]
+        if not aceitas.empty:
+            repo.apply_staged_deltas()
+            repo.record_movements(
+                (t, e, l, q, o, (int(st) if pd.notna(st) else None))
+                for t, e, l, q, o, st in aceitas[["tipo", "ean", "lot", "qty", "observacao", "store_id"]]
+                .itertuples(index=False, name=None)
+            )
+        repo.commit()
+    except Exception:
+        repo.rollback()
+        raise
+    return df
 
-    # Atualiza o estoque
-    cur.execute("UPDATE stock SET qty=? WHERE id=?", (new_qty, stock_id))
 
-    # Registra o movimento
-    cur.execute("""
-        INSERT INTO movements (type, ean, lot, qty, note, store_id, ts)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-    """, (tipo, ean, lot, qty, observacao or "", store_id, datetime.now().isoformat(timespec="seconds")))
+# === ENVIO DE ALERTA POR E-MAIL ===
+class EntregaIncerta(OSError):
+    """Conexão perdida depois do DATA: o e-mail pode ter sido entregue, então não é reenviado."""
 
-    conn.commit()
 
+class _SessaoSMTP(smtplib.SMTP):
+    """smtplib.SMTP que registra quando o DATA começou: a partir daí reenviar pode duplicar o e-mail."""
+
+    dados_enviados = False
+
+    def data(self, msg):
+        self.dados_enviados = True
+        return super().data(msg)
+
+
+class EnviadorEmail:
+    """
+    Sessão SMTP autenticada, reaproveitada entre mensagens (STARTTLS + login uma vez só).
+    - enviar_lote(mensagens): envia todas pela mesma sessão, devolve [(ok, info), ...]
+    - reconecta sozinho quando o servidor derruba a conexão
+    - códigos 4xx (limite de envio, 421 do Gmail etc.) esperam com backoff exponencial
+      antes de tentar de novo; 5xx falham na hora
+    - queda de conexão depois do DATA não é reenviada (a mensagem pode ter chegado)
+    Uma instância é segura para várias threads: cada tentativa usa a sessão com
+    exclusividade, e as esperas do backoff acontecem fora da trava.
+    """
+
+    def __init__(self, alert_cfg, tentativas=4, espera_inicial=2.0, espera_maxima=60.0, timeout=30):
+        self.smtp_server = alert_cfg.get("smtp_server")
+        self.smtp_port = alert_cfg.get("smtp_port", 587)
+        self.use_tls = alert_cfg.get("use_tls", True)
+        self.username = alert_cfg.get("username")
+        self._password = alert_cfg.get("password")
+        self.tentativas = tentativas
+        self.espera_inicial = espera_inicial
+        self.espera_maxima = espera_maxima
+        self.timeout = timeout
+        self._smtp = None
+        self._lock = threading.Lock()
+
+    def _conectar(self):
+        smtp = _SessaoSMTP(self.smtp_server, self.smtp_port, timeout=self.timeout)
+        try:
+            if self.use_tls:
+                smtp.starttls()
+            smtp.login(self.username, self._password)
+        except Exception:
+            smtp.close()
+            raise
+        self._smtp = smtp
+
+    def _descartar_sessao(self):
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except Exception:
+                self._smtp.close()
+            self._smtp = None
+
+    def fechar(self):
+        with self._lock:
+            self._descartar_sessao()
+
+    def _tentar(self, msg, ultima):
+        """
+        Uma tentativa de envio com a sessão travada. Devolve None se enviou; senão,
+        se a próxima tentativa deve esperar o backoff. Levanta o erro quando não há o que repetir.
+        """
+        with self._lock:
+            try:
+                if self._smtp is None:
+                    self._conectar()
+                self._smtp.dados_enviados = False
+                self._smtp.send_message(msg)
+                return None
+            except smtplib.SMTPResponseException as e:
+                # o servidor respondeu com erro: a mensagem não foi aceita, repetir é seguro
+                if not 400 <= e.smtp_code < 500 or ultima:
+                    raise
+                # Limite de envio / falha temporária: recomeça a sessão após o backoff
+                self._descartar_sessao()
+                return True
+            except smtplib.SMTPServerDisconnected as e:
+                incerto = self._smtp is not None and self._smtp.dados_enviados
+                self._smtp = None
+                if incerto:
+                    raise EntregaIncerta(
+                        f"conexão perdida depois do DATA, e-mail não reenviado (pode ter sido entregue): {e}"
+                    ) from e
+                if ultima:
+                    raise
+                # Sessão ociosa derrubada pelo servidor: reconecta na hora (e com backoff se repetir)
+                return False
+            except smtplib.SMTPException:
+                raise
+            except OSError as e:
+                incerto = self._smtp is not None and self._smtp.dados_enviados
+                self._descartar_sessao()
+                if incerto:
+                    raise EntregaIncerta(
+                        f"falha de rede depois do DATA, e-mail não reenviado (pode ter sido entregue): {e}"
+                    ) from e
+                if ultima:
+                    raise
+                # Falha de rede (timeout, conexão recusada): espera antes de reconectar
+                return True
+
+    def enviar(self, msg):
+        """Envia uma mensagem (com as novas tentativas); levanta o último erro se não conseguir."""
+        espera = self.espera_inicial
+        for tentativa in range(1, self.tentativas + 1):
+            esperar = self._tentar(msg, ultima=tentativa == self.tentativas)
+            if esperar is None:
+                return
+            # a espera fica fora da trava: as outras threads seguem usando a sessão
+            if esperar or tentativa > 1:
+                time.sleep(espera)
+                espera = min(espera * 2, self.espera_maxima)
+
+    def enviar_lote(self, mensagens):
+        resultados = []
+        for msg in mensagens:
+            try:
+                self.enviar(msg)
+                resultados.append((True, f"E-mail enviado com sucesso para {msg['To']}"))
+            except Exception as e:
+                resultados.append((False, f"Erro ao enviar e-mail: {e}"))
+        return resultados
+
+
+_ENVIADORES = {}
+_ENVIADORES_LOCK = threading.Lock()
+
+
+def obter_enviador(alert_cfg):
+    """Um EnviadorEmail por servidor/porta/credencial, compartilhado pelo processo inteiro."""
+    chave = (
+        alert_cfg.get("smtp_server"), alert_cfg.get("smtp_port", 587), alert_cfg.get("use_tls", True),
+        alert_cfg.get("username"), alert_cfg.get("password"),
+    )
+    with _ENVIADORES_LOCK:
+        enviador = _ENVIADORES.get(chave)
+        if enviador is None:
+            enviador = _ENVIADORES[chave] = EnviadorEmail(alert_cfg)
+        return enviador
+
+
+@atexit.register
+def fechar_enviadores():
+    with _ENVIADORES_LOCK:
+        enviadores = list(_ENVIADORES.values())
+        _ENVIADORES.clear()
+    for enviador in enviadores:
+        enviador.fechar()
+
+
+def falha_definitiva(erro):
+    """
+    Erros de envio que não adianta repetir: resposta 5xx do servidor, todos os
+    destinatários recusados com 5xx, ou entrega incerta (repetir pode duplicar).
+    """
+    if isinstance(erro, EntregaIncerta):
+        return True
+    if isinstance(erro, smtplib.SMTPResponseException):
+        return erro.smtp_code >= 500
+    if isinstance(erro, smtplib.SMTPRecipientsRefused):
+        return all(codigo >= 500 for codigo, _ in erro.recipients.values())
+    return False
+
+
+def validar_alert_cfg(cfg):
+    """Devolve (alert_cfg, None) ou (None, motivo) quando o envio não é possível."""
+    alert_cfg = cfg.get("alert_email", {})
+    if not alert_cfg.get("enabled", False):
+        return None, "Envio de e-mail desativado."
+    username = alert_cfg.get("username")
+    campos = [alert_cfg.get("smtp_server"), username, alert_cfg.get("password"),
+              alert_cfg.get("from_addr", username), alert_cfg.get("to_addrs", [])]
+    if not all(campos):
+        return None, "Configuração de e-mail incompleta."
+    return alert_cfg, None
+
+
+def montar_email_alerta(alert_cfg, subject, body, anexos=None):
+    """Monta a mensagem MIME (texto simples + anexos) a partir do bloco alert_email."""
+    from_addr = alert_cfg.get("from_addr", alert_cfg.get("username"))
+    to_addrs = alert_cfg.get("to_addrs", [])
+
+    msg = MIMEMultipart()
+    msg["From"] = from_addr
+    msg["To"] = ", ".join(to_addrs)
+    msg["Subject"] = subject
+
+    # Corpo do e-mail
+    msg.attach(MIMEText(body, "plain", "utf-8"))
+
+    # Anexa arquivos (caminhos ou tuplas (nome, bytes) vindas da fila), se existirem
+    if anexos:
+        for arquivo in anexos:
+            if isinstance(arquivo, tuple):
+                nome, conteudo = arquivo
+            elif os.path.exists(arquivo):
+                nome = os.path.basename(arquivo)
+                with open(arquivo, "rb") as f:
+                    conteudo = f.read()
+            else:
+                print(f"⚠️ Arquivo não encontrado para anexo: {arquivo}")
+                continue
+            part = MIMEBase("application", "octet-stream")
+            part.set_payload(conteudo)
+            encoders.encode_base64(part)
+            part.add_header("Content-Disposition", f'attachment; filename="{nome}"')
+            msg.attach(part)
+    return msg
 
 
-# === ENVIO DE ALERTA POR E-MAIL ===
 def enviar_email_alerta(cfg, subject, body, anexos=None):
     """
     Envia e-mail de alerta com ou sem anexos.
     - cfg: dicionário de configuração (inclui alert_email)
     - subject: assunto do e-mail
     - body: corpo do e-mail (texto simples)
-    - anexos: lista de caminhos de arquivos (ex: [pdf_path])
+    - anexos: lista de caminhos de arquivos (ex: [pdf_path]) ou tuplas (nome, bytes)
+    Usa a sessão SMTP compartilhada de obter_enviador (sem novo handshake por e-mail).
     """
-    try:
-        alert_cfg = cfg.get("alert_email", {})
-        if not alert_cfg.get("enabled", False):
-            return False, "Envio de e-mail desativado."
-
-        smtp_server = alert_cfg.get("smtp_server")
-        smtp_port = alert_cfg.get("smtp_port", 587)
-        username = alert_cfg.get("username")
-        password = alert_cfg.get("password")
-        from_addr = alert_cfg.get("from_addr", username)
-        to_addrs = alert_cfg.get("to_addrs", [])
-
-        if not all([smtp_server, username, password, from_addr, to_addrs]):
-            return False, "Configuração de e-mail incompleta."
-
-        # Monta mensagem
-        msg = MIMEMultipart()
-        msg["From"] = from_addr
-        msg["To"] = ", ".join(to_addrs)
-        msg["Subject"] = subject
-
-        # Corpo do e-mail
-        msg.attach(MIMEText(body, "plain", "utf-8"))
-
-        # Anexa arquivos, se existirem
-        if anexos:
-            for arquivo in anexos:
-                if os.path.exists(arquivo):
-                    with open(arquivo, "rb") as f:
-                        part = MIMEBase("application", "octet-stream")
-                        part.set_payload(f.read())
-                    encoders.encode_base64(part)
-                    part.add_header(
-                        "Content-Disposition",
-                        f'attachment; filename="{os.path.basename(arquivo)}"',
-                    )
-                    msg.attach(part)
-                else:
-                    print(f"⚠️ Arquivo não encontrado para anexo: {arquivo}")
-
-        # Envia o e-mail
-        with smtplib.SMTP(smtp_server, smtp_port) as server:
-            if alert_cfg.get("use_tls", True):
-                server.starttls()
-            server.login(username, password)
-            server.send_message(msg)
-
-        return True, f"E-mail enviado com sucesso para {', '.join(to_addrs)}"
+    return enviar_emails_alerta(cfg, [(subject, body, anexos)])[0]
+
 
+def enviar_emails_alerta(cfg, mensagens):
+    """
+    Envia várias mensagens [(subject, body, anexos), ...] pela mesma sessão SMTP.
+    Retorna [(ok, info), ...] na mesma ordem.
+    """
+    try:
+        alert_cfg, motivo = validar_alert_cfg(cfg)
+        if alert_cfg is None:
+            return [(False, motivo)] * len(mensagens)
+        msgs = [montar_email_alerta(alert_cfg, subject, body, anexos) for subject, body, anexos in mensagens]
+        return obter_enviador(alert_cfg).enviar_lote(msgs)
     except Exception as e:
-        return False, f"Erro ao enviar e-mail: {e}"
+        return [(False, f"Erro ao enviar e-mail: {e}")] * len(mensagens)
 
 
 # === EXPORTAR RELATÓRIOS (COM FILTRO DE LOJA) ===
@@ -222,9 +880,7 @@ def exportar_relatorios(conn, cfg, store_id=None):
     """
     from reporting import to_console
 
-    df = reporting.build_snapshots(conn)
-    if store_id and "store_id" in df.columns:
-        df = df[df["store_id"] == store_id]
+    df = reporting.build_snapshots(conn, store_id=store_id or None)
 
     outdir = Path(cfg["report_dir"])
     outdir.mkdir(parents=True, exist_ok=True)
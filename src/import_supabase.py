@@ -1,6 +1,7 @@
 import pandas as pd
 import psycopg2
 import streamlit as st
+from db_supabase import bulk_insert_ignore
 
 # 📦 Lê os CSVs exportados
 users = pd.read_csv("users_export.csv")
@@ -16,38 +17,33 @@ conn = psycopg2.connect(
     password=creds["password"],
     sslmode=creds.get("sslmode", "require")
 )
-cur = conn.cursor()
 
-# ✅ Insere as lojas primeiro
-for _, row in stores.iterrows():
-    cur.execute("""
-        INSERT INTO stores (id, name)
-        VALUES (%s, %s)
-        ON CONFLICT (id) DO NOTHING;
-    """, (int(row["id"]), row["name"]))
-
-conn.commit()
+# ✅ Insere as lojas primeiro (COPY + ON CONFLICT: uma ida ao banco por tabela)
+bulk_insert_ignore(
+    conn, "stores", ["id", "name"],
+    ((int(row["id"]), row["name"]) for _, row in stores.iterrows()),
+)
 
 # ✅ Agora insere os usuários
-for _, row in users.iterrows():
-    cur.execute("""
-        INSERT INTO users (id, username, name, email, pwd_hash, role, is_active, store_id, created_at)
-        VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s)
-        ON CONFLICT (id) DO NOTHING;
-    """, (
-        int(row["id"]),
-        row["username"],
-        row["name"],
-        row["email"],
-        row["pwd_hash"],
-        row["role"],
-        bool(row["is_active"]),
-        None if pd.isna(row["store_id"]) else int(row["store_id"]),
-        row["created_at"]
-    ))
+bulk_insert_ignore(
+    conn, "users",
+    ["id", "username", "name", "email", "pwd_hash", "role", "is_active", "store_id", "created_at"],
+    (
+        (
+            int(row["id"]),
+            row["username"],
+            row["name"],
+            row["email"],
+            row["pwd_hash"],
+            row["role"],
+            int(bool(row["is_active"])),
+            None if pd.isna(row["store_id"]) else int(row["store_id"]),
+            row["created_at"],
+        )
+        for _, row in users.iterrows()
+    ),
+)
 
-conn.commit()
-cur.close()
 conn.close()
 
 print("✅ Dados importados com sucesso para o Supabase!")
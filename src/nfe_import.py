@@ -1,76 +1,240 @@
-import xml.etree.ElementTree as ET
+import hashlib
+import io
+import multiprocessing
+import os
+import re
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+
+from lxml import etree
 import pandas as pd
 
+COLUNAS_NFE = ["ean", "product_name", "lot", "expiry_date", "qty", "ncm"]
+
+# Capítulos do NCM (2 primeiros dígitos) considerados alimentos/perecíveis
+PREFIXOS_PERECIVEIS = frozenset({
+    "02", "03", "04", "07", "08", "09",
+    "10", "11", "15", "16", "17", "18", "19", "20",
+})
+
+
+def _gtin_valido(codigo: str) -> bool:
+    """cEAN/cEANTrib vêm como 'SEM GTIN' (ou vazios) quando o item não tem código de barras."""
+    return codigo.isdigit() and len(codigo) in (8, 12, 13, 14)
+
+
+@lru_cache(maxsize=4)
+def _xpath_campos_prod(ns: str):
+    """XPath compilado uma vez por namespace: todos os filhos de <prod> de um <det>."""
+    if ns:
+        return etree.XPath("n:prod/*", namespaces={"n": ns})
+    return etree.XPath("prod/*")
 
-def parse_nfe_xml(xml_path: str):
+
+def _iter_det(origem):
+    """Percorre os <det> da nota liberando cada item (e os irmãos já lidos) da memória."""
+    contexto = etree.iterparse(
+        origem, events=("end",), tag="{*}det",
+        resolve_entities=False, no_network=True, huge_tree=True,
+    )
+    for _, det in contexto:
+        yield det
+        det.clear()
+        while det.getprevious() is not None:
+            del det.getparent()[0]
+
+
+def parse_nfe_xml(xml_path):
     """
     Lê o XML da NF-e e retorna um DataFrame com produtos perecíveis.
     Critérios:
-      - Possui tag <dVal> (data de validade) OU
+      - Possui data de validade (<rastro>/<dVal>, <dVal> ou <dVenc>) OU
       - NCM começa com prefixos de alimentos.
     Campos retornados:
       ean, product_name, lot, expiry_date, qty, ncm
+
+    O EAN vem de cEAN (ou cEANTrib) quando é um GTIN válido; caso contrário, cProd.
+    Itens com vários <rastro> geram uma linha por lote, com a quantidade de qLote.
+    O arquivo é lido em streaming (iterparse), então notas com milhares de itens
+    não precisam ser carregadas inteiras na memória.
     """
+    cols = {c: [] for c in COLUNAS_NFE}
+    xp_campos = None
+
     try:
-        tree = ET.parse(xml_path)
-        root = tree.getroot()
-    except Exception as e:
+        for det in _iter_det(xml_path):
+            if xp_campos is None:
+                ns = det.tag[1:].split("}")[0] if det.tag.startswith("{") else ""
+                xp_campos = _xpath_campos_prod(ns)
+                corte = len(ns) + 2 if ns else 0  # remove o "{namespace}" das tags
+
+            # Uma única avaliação de XPath por item; os campos saem por nome da tag
+            campos, rastros = {}, []
+            for el in xp_campos(det):
+                tag = el.tag[corte:]
+                if tag == "rastro":
+                    rastros.append({c.tag[corte:]: (c.text or "") for c in el if isinstance(c.tag, str)})
+                else:
+                    campos[tag] = el.text or ""
+            if not campos:
+                continue  # <det> sem <prod>
+
+            cean = campos.get("cEAN", "").strip()
+            if not _gtin_valido(cean):
+                cean = campos.get("cEANTrib", "").strip()
+            ean = cean if _gtin_valido(cean) else campos.get("cProd", "").strip()
+
+            name = campos.get("xProd", "").strip()
+            qcom = float(campos.get("qCom") or 0)
+            ncm = campos.get("NCM", "").strip()
+            # layouts antigos/fora do padrão trazem lote e validade direto em <prod>
+            lote_padrao = campos.get("nLote", "").strip() or (f"LOTE-{ean[-4:]}" if ean else "SEMLOTE")
+            validade_padrao = campos.get("dVal") or campos.get("dVenc") or ""
+
+            if rastros:
+                lotes = [
+                    (
+                        r.get("nLote", "").strip() or lote_padrao,
+                        r.get("dVal") or validade_padrao,
+                        float(r.get("qLote") or 0) if len(rastros) > 1 else qcom,
+                    )
+                    for r in rastros
+                ]
+            else:
+                lotes = [(lote_padrao, validade_padrao, qcom)]
+
+            for lot, expiry, qty in lotes:
+                # Filtro de perecíveis
+                if not expiry and ncm[:2] not in PREFIXOS_PERECIVEIS:
+                    continue
+                cols["ean"].append(ean)
+                cols["product_name"].append(name)
+                cols["lot"].append(lot)
+                cols["expiry_date"].append(expiry.split("T")[0].strip() if expiry else None)
+                cols["qty"].append(qty)
+                cols["ncm"].append(ncm)
+    except (etree.LxmlError, OSError) as e:
+        # XML malformado, arquivo inexistente ou ilegível
         raise ValueError(f"Erro ao ler o XML: {e}")
 
-    # Detecta namespace
-    ns = ""
-    if root.tag.startswith("{"):
-        ns = root.tag.split("}")[0].strip("{")
-    nsmap = {"ns": ns} if ns else {}
-
-    pereciveis_prefix = [
-        "02", "03", "04", "07", "08", "09",
-        "10", "11", "15", "16", "17", "18", "19", "20"
-    ]
-
-    items = []
-
-    for det in root.findall(".//ns:det", nsmap):
-        prod = det.find("ns:prod", nsmap)
-        if prod is None:
-            continue
-
-        ean = (prod.findtext("ns:cProd", namespaces=nsmap) or "").strip()
-        name = (prod.findtext("ns:xProd", namespaces=nsmap) or "").strip()
-        qty = float(prod.findtext("ns:qCom", namespaces=nsmap) or 0)
-        lot = (
-            prod.findtext("ns:nLote", namespaces=nsmap)
-            or f"LOTE-{ean[-4:]}" if ean else "SEMLOTE"
-        )
-        expiry = (
-            prod.findtext("ns:dVal", namespaces=nsmap)
-            or prod.findtext("ns:dVenc", namespaces=nsmap)
-            or ""
-        )
-        ncm = (prod.findtext("ns:NCM", namespaces=nsmap) or "").strip()
-
-        # Filtro de perecíveis
-        if not expiry and not any(ncm.startswith(p) for p in pereciveis_prefix):
-            continue
-
-        if expiry:
-            expiry = expiry.split("T")[0]
-
-        items.append({
-            "ean": ean,
-            "product_name": name,
-            "lot": lot,
-            "expiry_date": expiry,
-            "qty": qty,
-            "ncm": ncm,
-        })
-
-    df = pd.DataFrame(items)
-    if df.empty:
-        return pd.DataFrame(columns=["ean", "product_name", "lot", "expiry_date", "qty", "ncm"])
-
-    # Normaliza e ordena colunas
-    df = df[["ean", "product_name", "lot", "expiry_date", "qty", "ncm"]]
+    df = pd.DataFrame(cols, columns=COLUNAS_NFE)
+    df["qty"] = df["qty"].astype(float)
     df["expiry_date"] = pd.to_datetime(df["expiry_date"], errors="coerce")
-
     return df
+
+
+# === IMPORTAÇÃO EM LOTE (PASTA / ZIP / VÁRIOS ARQUIVOS) ===
+def _fontes_nfe(origem):
+    """
+    Lista (nome, fonte) de cada XML a processar. origem pode ser:
+      - uma pasta (busca *.xml recursivamente);
+      - um arquivo .zip ou .xml;
+      - uma lista de (nome, bytes), como vem do uploader (ZIPs são expandidos).
+    fonte é o caminho do arquivo ou o conteúdo em bytes.
+    """
+    if isinstance(origem, (str, os.PathLike)):
+        caminho = Path(origem)
+        if caminho.is_dir():
+            return [
+                (str(p.relative_to(caminho)), str(p))
+                for p in sorted(caminho.rglob("*"))
+                if p.is_file() and p.suffix.lower() == ".xml"
+            ]
+        if caminho.suffix.lower() == ".zip":
+            return _fontes_zip(caminho.name, caminho)
+        return [(caminho.name, str(caminho))]
+
+    fontes = []
+    for nome, conteudo in origem:
+        if nome.lower().endswith(".zip"):
+            fontes.extend(_fontes_zip(nome, io.BytesIO(conteudo) if isinstance(conteudo, bytes) else conteudo))
+        else:
+            fontes.append((nome, conteudo))
+    return fontes
+
+
+def _fontes_zip(nome_zip, arquivo):
+    with zipfile.ZipFile(arquivo) as zf:
+        return [
+            (f"{nome_zip}/{info.filename}", zf.read(info))
+            for info in zf.infolist()
+            if not info.is_dir() and info.filename.lower().endswith(".xml")
+        ]
+
+
+# chNFe: atributo Id="NFe<44 dígitos>" de <infNFe> ou <chNFe> do protocolo (nfeProc)
+_RE_ID_INFNFE = re.compile(rb"""<(?:\w+:)?infNFe\b[^>]*?\bId\s*=\s*["']NFe(\d{44})["']""")
+_RE_CHNFE = re.compile(rb"<(?:\w+:)?chNFe>\s*(\d{44})\s*</")
+
+
+def chave_nfe(fonte) -> str:
+    """
+    Identificador da nota sem fazer o parse do XML: a chave de acesso (chNFe,
+    44 dígitos) ou, se o arquivo não a tiver, "sha256:<hash do conteúdo>".
+    """
+    conteudo = fonte if isinstance(fonte, bytes) else Path(fonte).read_bytes()
+    m = _RE_ID_INFNFE.search(conteudo) or _RE_CHNFE.search(conteudo)
+    if m:
+        return m.group(1).decode("ascii")
+    return "sha256:" + hashlib.sha256(conteudo).hexdigest()
+
+
+def _parse_fonte(item):
+    """Executado nos processos filhos: (nome, fonte) -> (nome, DataFrame ou None, erro)."""
+    nome, fonte = item
+    try:
+        df = parse_nfe_xml(io.BytesIO(fonte) if isinstance(fonte, bytes) else fonte)
+        return nome, df, None
+    except Exception as e:
+        return nome, None, str(e)
+
+
+def parse_nfes_em_lote(origem, max_workers=None):
+    """
+    Lê várias NF-e em paralelo (ProcessPoolExecutor) com parse_nfe_xml.
+    origem: como em _fontes_nfe, ou uma lista (nome, caminho ou bytes) já montada.
+    Retorna uma lista de (nome, DataFrame ou None, erro) na ordem dos arquivos;
+    um XML inválido não interrompe os demais.
+    """
+    fontes = _fontes_nfe(origem)
+    if len(fontes) <= 1 or max_workers == 1:
+        return [_parse_fonte(f) for f in fontes]
+
+    max_workers = min(max_workers or os.cpu_count() or 1, len(fontes))
+    # spawn: o app roda dentro do servidor do Streamlit, com várias threads ativas
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=ctx) as pool:
+        return list(pool.map(_parse_fonte, fontes, chunksize=max(1, len(fontes) // (max_workers * 4))))
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="Importa em lote as NF-e (XML) de uma pasta ou de um ZIP.")
+    parser.add_argument("origem", help="pasta com os XMLs ou arquivo .zip")
+    parser.add_argument("--loja", type=int, default=None, help="store_id que recebe as entradas")
+    parser.add_argument("--workers", type=int, default=None, help="nº de processos (padrão: nº de CPUs)")
+    parser.add_argument("--postgres", action="store_true", help="usa o banco do Supabase (db_supabase)")
+    args = parser.parse_args()
+
+    import expiry_bot as bot
+
+    if args.postgres:
+        from db_supabase import get_conn, init_db
+        conn = get_conn()
+    else:
+        from db import get_conn, init_db
+        cfg = json.loads((Path(__file__).resolve().parents[1] / "config.json").read_text(encoding="utf-8"))
+        conn = get_conn(cfg["database_path"])
+    init_db(conn)
+
+    res = bot.importar_nfes_em_lote(conn, args.origem, store_id=args.loja, max_workers=args.workers)
+    for arq in res["arquivos"]:
+        detalhe = arq["erro"] or f"{arq['itens']} item(ns)"
+        print(f"{'✅' if arq['status'] == 'ok' else '⚠️'} {arq['arquivo']}: {arq['status']} — {detalhe}")
+    print(res["mensagem"])
+    if not res["sucesso"]:
+        raise SystemExit(1)
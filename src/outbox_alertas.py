@@ -0,0 +1,214 @@
+# outbox_alertas.py
+"""
+Fila durável dos alertas por e-mail (tabela alert_outbox).
+
+A interface e os agendadores só chamam enfileirar_alerta (um INSERT com o PDF
+em bytes). Quem fala com o SMTP é processar_outbox, rodado pelo worker em thread
+do app (iniciar_worker) ou ao fim da rodada do agendador. Um envio que falha
+volta para a fila com backoff exponencial; depois de MAX_TENTATIVAS a linha fica
+como 'falhou', com o último erro em last_error. Falhas que não adianta repetir
+(loja com envio desativado ou configuração incompleta, 5xx do servidor, entrega
+incerta) vão direto para 'falhou'.
+
+Uso:
+    worker = iniciar_worker(conectar, lambda conn, store_id: config_loja(conn, cfg, store_id))
+    enfileirar_alerta(conn, store_id, "Assunto", "Corpo", anexos=[pdf_path])
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import expiry_bot as bot
+from repository import get_repository
+
+MAX_TENTATIVAS = 6
+BACKOFF_INICIAL = 30.0    # s até a 2ª tentativa; dobra a cada falha
+BACKOFF_MAXIMO = 3600.0
+RESERVA = 600.0           # s em que uma linha reivindicada fica com o mesmo worker
+INTERVALO_WORKER = 5.0    # s entre consultas à fila quando ela está vazia
+
+_WORKER = None
+_WORKER_LOCK = threading.Lock()
+
+
+def enfileirar_alerta(conn, store_id, subject, body, anexos=None):
+    """
+    Grava o alerta na fila (commit incluso) e acorda o worker, se houver.
+    anexos: no máximo um — caminho do PDF ou tupla (nome, bytes). Devolve o id.
+    """
+    nome = conteudo = None
+    if anexos:
+        if len(anexos) > 1:
+            raise ValueError("A fila de alertas guarda um anexo por e-mail.")
+        anexo = anexos[0]
+        if isinstance(anexo, tuple):
+            nome, conteudo = anexo
+        else:
+            nome, conteudo = Path(anexo).name, Path(anexo).read_bytes()
+
+    repo = get_repository(conn)
+    try:
+        alert_id = repo.enqueue_alert(store_id, subject, body, nome, conteudo)
+        repo.commit()
+    except Exception:
+        repo.rollback()
+        raise
+
+    if _WORKER is not None:
+        _WORKER.acordar()
+    return alert_id
+
+
+def _proxima_tentativa(tentativas):
+    """Horário da próxima tentativa, ou None quando o alerta esgotou as tentativas."""
+    if tentativas >= MAX_TENTATIVAS:
+        return None
+    espera = min(BACKOFF_INICIAL * 2 ** (tentativas - 1), BACKOFF_MAXIMO)
+    return datetime.now() + timedelta(seconds=espera)
+
+
+def _enviar(alerta, cfg):
+    """Devolve (ok, info, definitivo, segundos); definitivo = falha que não adianta repetir."""
+    if isinstance(cfg, Exception):
+        return False, f"Erro ao carregar a configuração da loja: {cfg}", False, 0.0
+    alert_cfg, motivo = bot.validar_alert_cfg(cfg)
+    if alert_cfg is None:
+        return False, motivo, True, 0.0
+    t0 = time.perf_counter()
+    try:
+        anexos = None
+        if alerta["attachment"] is not None:
+            anexos = [(alerta["attachment_name"] or "relatorio.pdf", alerta["attachment"])]
+        msg = bot.montar_email_alerta(alert_cfg, alerta["subject"], alerta["body"], anexos=anexos)
+        bot.obter_enviador(alert_cfg).enviar(msg)
+        ok, info, definitivo = True, f"E-mail enviado com sucesso para {msg['To']}", False
+    except Exception as e:
+        ok, info, definitivo = False, f"Erro ao enviar e-mail: {e}", bot.falha_definitiva(e)
+    return ok, info, definitivo, time.perf_counter() - t0
+
+
+def processar_outbox(conn, resolver_cfg, limite=50, envios=1):
+    """
+    Reivindica até `limite` alertas vencidos, envia em até `envios` threads e grava
+    o resultado de cada um assim que ele termina (só a thread chamadora usa conn).
+    resolver_cfg(conn, store_id) devolve a config com o bloco alert_email da loja.
+    Retorna [{"id", "store_id", "ok", "info", "segundos", "proxima"}, ...].
+    """
+    repo = get_repository(conn)
+    try:
+        alertas = repo.claim_alerts(limite, RESERVA)
+        repo.commit()
+    except Exception:
+        repo.rollback()
+        raise
+    if not alertas:
+        return []
+
+    configs = {}
+    for store_id in {a["store_id"] for a in alertas}:
+        try:
+            configs[store_id] = resolver_cfg(conn, store_id)
+        except Exception as e:
+            configs[store_id] = e
+
+    resultados = []
+    with ThreadPoolExecutor(max_workers=max(1, min(int(envios), len(alertas)))) as pool:
+        futuros = {pool.submit(_enviar, alerta, configs[alerta["store_id"]]): alerta for alerta in alertas}
+        for futuro in as_completed(futuros):
+            alerta = futuros[futuro]
+            ok, info, definitivo, dt = futuro.result()
+            proxima = None
+            try:
+                if ok:
+                    repo.mark_alert_sent(alerta["id"])
+                else:
+                    proxima = None if definitivo else _proxima_tentativa(alerta["attempts"])
+                    repo.mark_alert_failed(alerta["id"], info, proxima)
+                repo.commit()
+            except Exception:
+                repo.rollback()
+                raise
+            resultados.append({"id": alerta["id"], "store_id": alerta["store_id"], "ok": ok, "info": info,
+                               "segundos": dt, "proxima": proxima})
+    return resultados
+
+
+def drenar_outbox(conn, resolver_cfg, envios=1, limite=50, espera_maxima=0):
+    """
+    Processa a fila até não sobrar alerta vencido. Para quem não tem o worker
+    (o agendador do SQLite): enquanto a próxima nova tentativa pendente vencer em
+    até `espera_maxima` segundos, espera por ela e continua; as que ficarem mais
+    longe são entregues na próxima rodada (ou pelo worker do app).
+    """
+    resultados = []
+    while True:
+        lote = processar_outbox(conn, resolver_cfg, limite=limite, envios=envios)
+        resultados.extend(lote)
+        if len(lote) == limite:
+            continue
+        proxima = get_repository(conn).next_alert_due() if espera_maxima > 0 else None
+        if proxima is None:
+            return resultados
+        espera = (proxima - datetime.now()).total_seconds()
+        if espera > espera_maxima:
+            return resultados
+        time.sleep(max(espera, 0) + 1)  # next_attempt_at é gravado em segundos inteiros
+
+
+class WorkerOutbox(threading.Thread):
+    """
+    Thread daemon que drena a fila em segundo plano com uma conexão própria
+    (conectar() é chamado de novo se a conexão cair).
+    """
+
+    def __init__(self, conectar, resolver_cfg, intervalo=INTERVALO_WORKER, envios=1):
+        super().__init__(name="outbox-alertas", daemon=True)
+        self.conectar = conectar
+        self.resolver_cfg = resolver_cfg
+        self.intervalo = intervalo
+        self.envios = envios
+        self._acordar = threading.Event()
+        self._parar = threading.Event()
+
+    def acordar(self):
+        self._acordar.set()
+
+    def parar(self):
+        self._parar.set()
+        self._acordar.set()
+
+    def run(self):
+        conn = None
+        while not self._parar.is_set():
+            processados = []
+            try:
+                if conn is None:
+                    conn = self.conectar()
+                processados = processar_outbox(conn, self.resolver_cfg, envios=self.envios)
+                for r in processados:
+                    if not r["ok"]:
+                        print(f"⚠️ Alerta #{r['id']} não enviado: {r['info']}")
+            except Exception as e:
+                print(f"⚠️ Worker da fila de alertas: {e}")
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+                conn = None
+            if not processados:
+                self._acordar.wait(self.intervalo)
+                self._acordar.clear()
+        if conn is not None:
+            conn.close()
+
+
+def iniciar_worker(conectar, resolver_cfg, **kwargs):
+    """Sobe o worker da fila uma vez por processo; as chamadas seguintes devolvem o mesmo."""
+    global _WORKER
+    with _WORKER_LOCK:
+        if _WORKER is None or not _WORKER.is_alive():
+            _WORKER = WorkerOutbox(conectar, resolver_cfg, **kwargs)
+            _WORKER.start()
+        return _WORKER
@@ -3,39 +3,31 @@ import streamlit as st
 import pandas as pd
 import plotly.express as px
 from pathlib import Path
-import json
+import shutil
 from datetime import datetime, timedelta
 
 from db_supabase import get_conn, init_db
 import reporting
+from repository import get_repository
 import expiry_bot as bot
+import outbox_alertas
+import config_lojas
 from report_pdf import gerar_relatorio_pdf
-from nfe_import import parse_nfe_xml
 import streamlit.components.v1 as components
 
 
 def main(conn, cfg, user):
 
     store_id = user.get("store_id")
-    # Caminho do config (usado ao salvar alterações na aba de Configurações)
-    # --- Carregar configuração específica da loja ---
-    # --- Carregar configuração específica da loja (SEM cache global) ---
-    CFG_PATH = Path(__file__).resolve().parents[1] / "config.json"
-    CFG_STORE_PATH = Path(__file__).resolve().parents[1] / f"config_loja_{store_id}.json"
-
-    # Se não existir o arquivo da loja, cria com base na config global
-    if not CFG_STORE_PATH.exists():
-        Path(CFG_STORE_PATH).write_text(json.dumps(cfg, indent=2, ensure_ascii=False), encoding="utf-8")
-
-    # Carrega a configuração da loja diretamente (sem cache compartilhado)
-    with open(CFG_STORE_PATH, "r", encoding="utf-8") as f:
-        cfg = json.load(f)
+    # --- Configuração efetiva da loja (store_settings, com cache por versão em config_lojas) ---
+    cfg_global = cfg
+    cfg = config_lojas.config_loja(conn, cfg_global, store_id)
 
     # <<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
 
 
     # ADIÇÃO: indicador de loja atual na barra lateral (informativo)
-    st.sidebar.info(f"🧭 Loja atual: {store_id}")
+    st.sidebar.info(f"🧭 Loja atual: {'Todas as lojas' if store_id is None else store_id}")
 
     st.markdown("""
     <style>
@@ -98,46 +90,38 @@ def main(conn, cfg, user):
     st.title("Controle LRC — Sistema de Controle de Validades")
 
     # ------------------ PRÉ-CÁLCULOS COMPARTILHADOS ------------------
-    df = reporting.build_snapshots(conn)
+    # filtro de loja aplicado no SQL: o operador só recebe as linhas da sua loja;
+    # usuário sem loja (store_id None) vê a rede inteira, como kpis, a tendência e o PDF
+    df = reporting.build_snapshots(conn, store_id=store_id)
     if df is None or df.empty:
         df = pd.DataFrame(columns=["ean","product_name","lot","expiry_date","qty","location","store_id"])
-    else:
-        if "store_id" in df.columns:
-            # normaliza tipos para comparação
-            try:
-                df["store_id"] = df["store_id"].astype(str)
-                sid = "" if store_id is None else str(store_id)
-                df = df[df["store_id"] == sid]
-            except Exception:
-                # fallback: tenta como int
-                try:
-                    df["store_id"] = df["store_id"].astype("Int64")
-                    if store_id is not None:
-                        df = df[df["store_id"] == int(store_id)]
-                except Exception:
-                    pass
     near = reporting.near_expiry(df, cfg["near_expiry_days"])
     exp = reporting.expired(df)
+
+    # Faixas de vencimento (hoje, até 7 dias, até N dias) em uma consulta agrupada
+    dias_alerta = int(cfg["near_expiry_days"])
+    faixa_curta = min(7, dias_alerta)
+    hist = reporting.expiry_buckets(conn, store_id=store_id, limits=(0, faixa_curta, dias_alerta))
+    faixas = reporting.bucket_totals(hist)
+
+    def itens_faixa(dias):
+        return faixas.get(f"ate_{dias}", {}).get("itens", 0)
+
     # 🔔 Banner de alerta dentro do painel principal (refinado)
     if near is not None and not near.empty:
         total = int(near["qty"].sum()) if "qty" in near.columns else len(near)
 
-        # Calcula faixas de vencimento
-        hoje = datetime.now().date()
-        near["dias_restantes"] = pd.to_datetime(near["expiry_date"]).dt.date - hoje
-        near["dias_restantes"] = near["dias_restantes"].apply(lambda x: x.days if pd.notna(x) else None)
-
-        ate7 = near[near["dias_restantes"] <= 7]
-        ate15 = near[(near["dias_restantes"] > 7) & (near["dias_restantes"] <= 15)]
-        vencendo_hoje = near[near["dias_restantes"] == 0]
+        vencendo_hoje = itens_faixa(0)
+        ate7 = vencendo_hoje + (itens_faixa(faixa_curta) if faixa_curta > 0 else 0)
+        ate_n = itens_faixa(dias_alerta) if dias_alerta > faixa_curta else 0
 
         resumo = []
-        if not vencendo_hoje.empty:
-            resumo.append(f"🟥 {len(vencendo_hoje)} vencendo **HOJE**")
-        if not ate7.empty:
-            resumo.append(f"🟧 {len(ate7)} vencendo em até **7 dias**")
-        if not ate15.empty:
-            resumo.append(f"🟨 {len(ate15)} vencendo em até **15 dias**")
+        if vencendo_hoje:
+            resumo.append(f"🟥 {vencendo_hoje} vencendo **HOJE**")
+        if ate7:
+            resumo.append(f"🟧 {ate7} vencendo em até **{faixa_curta} dias**")
+        if ate_n:
+            resumo.append(f"🟨 {ate_n} vencendo em até **{dias_alerta} dias**")
 
         resumo_str = " | ".join(resumo) if resumo else f"⚠️ {total} item(ns) próximos da validade"
 
@@ -175,90 +159,66 @@ def main(conn, cfg, user):
         st.subheader("📥 Importar Planilha de Estoque (Excel/CSV)")
         file = st.file_uploader("Selecione o arquivo de estoque", type=["xlsx", "csv"], key="upload_estoque")
         if file:
-            tmp = Path("data") / f"upload_{datetime.now().strftime('%H%M%S')}"
+            # mantém a extensão original: é ela que decide entre leitor CSV e XLSX
+            tmp = Path("data") / f"upload_{datetime.now().strftime('%H%M%S')}{Path(file.name).suffix.lower()}"
             tmp.parent.mkdir(parents=True, exist_ok=True)
             with open(tmp, "wb") as f:
-                f.write(file.read())
+                shutil.copyfileobj(file, f)
             if st.button("Importar Planilha", type="primary"):
+                barra = st.progress(0.0, text="Importando planilha...")
+
+                def _progresso(linhas, total):
+                    if total:
+                        barra.progress(min(linhas / total, 1.0), text=f"{linhas} de {total} linha(s) importada(s)")
+                    else:
+                        barra.progress(0.0, text=f"{linhas} linha(s) importada(s)")
+
                 try:
-                    bot.importar_planilha(conn, str(tmp), store_id=store_id)
-                    st.success("Importação concluída com sucesso!")
+                    res = bot.importar_planilha_em_blocos(conn, str(tmp), store_id=store_id, progresso=_progresso)
+                    barra.progress(1.0, text="Importação concluída")
+                    st.success(f"Importação concluída com sucesso! {res['mensagem']}")
                 except Exception as e:
                     st.error(str(e))
+                finally:
+                    tmp.unlink(missing_ok=True)
 
         st.divider()
         st.subheader("📄 Importar Nota Fiscal Eletrônica (XML) — automático para perecíveis")
         xml_file = st.file_uploader("Selecione o arquivo .xml da NF-e", type=["xml"], key="upload_xml")
         if xml_file:
-            tmp_xml = Path("data") / f"nfe_{datetime.now().strftime('%H%M%S')}.xml"
-            tmp_xml.parent.mkdir(parents=True, exist_ok=True)
-            with open(tmp_xml, "wb") as f:
-                f.write(xml_file.read())
-            df_nfe = parse_nfe_xml(str(tmp_xml))
-            if df_nfe.empty:
-                st.warning("Nenhum produto perecível encontrado na nota fiscal.")
-            else:
-                st.success(f"{len(df_nfe)} produto(s) perecível(is) encontrado(s). Itens serão registrados automaticamente.")
-                st.dataframe(df_nfe, use_container_width=True)
-                try:
-                    # 1️⃣ Primeiro, insere todos os produtos e lotes
-                    for _, row in df_nfe.iterrows():
-                        ean = str(row["ean"])
-                        pname = str(row["product_name"])
-                        lot = str(row["lot"])
-                        expiry = row["expiry_date"]
-                        # Garante que expiry seja string no formato YYYY-MM-DD
-                        if pd.notna(expiry):
-                            if isinstance(expiry, pd.Timestamp):
-                                expiry = expiry.date().isoformat()
-                            elif isinstance(expiry, str):
-                                expiry = expiry.strip()
-                            else:
-                                expiry = str(expiry)
-                        else:
-                            expiry = None
-
-                        cur = conn.cursor()
-                        cur.execute(
-                            "INSERT INTO products(ean, product_name) VALUES(%s,%s) ON CONFLICT (ean) DO NOTHING",
-                            (ean, pname)
-                        )
-                        cur.execute("UPDATE products SET product_name=COALESCE(NULLIF(%s, ''), product_name) WHERE ean=%s", (pname, ean))
-                        if expiry:
-                            cur.execute(
-                                "INSERT INTO lots(ean, lot, expiry_date) VALUES(%s,%s,%s) ON CONFLICT (ean, lot) DO NOTHING",
-                                (ean, lot, expiry)
-                            )
-                        else:
-                            cur.execute(
-                                "INSERT INTO lots(ean, lot, expiry_date) VALUES(%s,%s,CURRENT_DATE + INTERVAL '180 days') ON CONFLICT (ean, lot) DO NOTHING",
-                                (ean, lot)
-                            )
-
-
-
-                    # 2️⃣ Faz um único commit no final da importação
-                    conn.commit()
-
-                    # 3️⃣ Agora registra os movimentos
-                    for _, row in df_nfe.iterrows():
-                        ean = str(row["ean"])
-                        lot = str(row["lot"])
-                        qty = int(row["qty"]) if not pd.isna(row["qty"]) else 0
-                        bot.movimentar(
-                            conn,
-                            "receipt",
-                            ean,
-                            lot,
-                            qty,
-                            observacao="Importado via NF-e",
-                            local=f"Loja {store_id}",
-                            store_id=store_id,
-                        )
+            # Idempotente: a mesma nota (chave de acesso) não entra duas vezes,
+            # nem quando o Streamlit reexecuta a página com o arquivo ainda selecionado
+            try:
+                res = bot.importar_nfes_em_lote(conn, [(xml_file.name, xml_file.getvalue())], store_id=store_id)
+                arq = res["arquivos"][0] if res["arquivos"] else {"status": "sem perecíveis"}
+                if arq["status"] == "duplicada":
+                    st.info(f"NF-e {arq['chave']} já foi importada — nada a fazer.")
+                elif arq["status"] == "erro":
+                    st.error(f"Erro ao ler a NF-e: {arq['erro']}")
+                elif arq["status"] == "sem perecíveis":
+                    st.warning("Nenhum produto perecível encontrado na nota fiscal.")
+                else:
+                    st.success(f"{arq['itens']} produto(s) perecível(is) registrado(s). NF-e processada e estoque atualizado com sucesso!")
+            except Exception as e:
+                st.error(f"Erro ao registrar itens da NF-e: {e}")
 
-                    st.success("NF-e processada e estoque atualizado com sucesso!")
-                except Exception as e:
-                    st.error(f"Erro ao registrar itens da NF-e: {e}")
+        st.subheader("🗂️ Importar várias NF-e (XMLs ou ZIP)")
+        xml_files = st.file_uploader(
+            "Selecione os arquivos .xml das NF-e ou um .zip com eles",
+            type=["xml", "zip"], accept_multiple_files=True, key="upload_xml_lote",
+        )
+        if xml_files and st.button("📥 Importar NF-e selecionadas", key="btn_importar_nfe_lote"):
+            try:
+                with st.spinner(f"Processando {len(xml_files)} arquivo(s)..."):
+                    res = bot.importar_nfes_em_lote(
+                        conn, [(f.name, f.getvalue()) for f in xml_files], store_id=store_id
+                    )
+                (st.success if res["sucesso"] else st.warning)(res["mensagem"])
+                st.dataframe(pd.DataFrame(res["arquivos"]).rename(columns={
+                    "arquivo": "Arquivo", "status": "Status", "itens": "Itens", "erro": "Erro"
+                }), use_container_width=True)
+            except Exception as e:
+                st.error(f"Erro ao importar as NF-e: {e}")
 
         st.divider()
         st.subheader("➕ Registrar Entrada (cria lote automaticamente)")
@@ -273,47 +233,12 @@ def main(conn, cfg, user):
 
         if submitted_r:
             try:
-                cur = conn.cursor()
-                # Garante que o produto exista
-                cur.execute(
-                    "INSERT INTO products(ean, product_name) VALUES(%s, %s) ON CONFLICT (ean) DO NOTHING",
-                    (ean_r, pname_r)
-                )
-                cur.execute("UPDATE products SET product_name = COALESCE(NULLIF(%s, ''), product_name) WHERE ean = %s", (pname_r, ean_r))
-
-                # Garante que o lote exista
-                cur.execute(
-                    "INSERT INTO lots(ean, lot, expiry_date) VALUES(%s,%s,%s) ON CONFLICT (ean, lot) DO NOTHING",
-                    (ean_r, lot_r, expiry_r.isoformat())
-                )
+                # Garante que o produto e o lote existam
+                repo = get_repository(conn)
+                repo.upsert_products([(ean_r, pname_r)])
+                repo.upsert_lots([(ean_r, lot_r, expiry_r)])
 
-
-                # Verifica se já existe item igual no estoque da mesma loja
-                cur.execute("""
-                    SELECT qty FROM stock WHERE ean=%s AND lot=%s AND store_id=%s
-                """, (ean_r, lot_r, store_id))
-                row = cur.fetchone()
-
-                if row:
-                    # Atualiza a quantidade existente
-                    nova_qtd = row[0] + qty_r
-                    cur.execute("""
-                        UPDATE stock
-                        SET qty=%s, location=%s, updated_at=CURRENT_TIMESTAMP
-                        WHERE ean=%s AND lot=%s AND store_id=%s
-                    """, (nova_qtd, location_r, ean_r, lot_r, store_id))
-                    st.info(f"Item já existia — quantidade atualizada para {nova_qtd}.")
-                else:
-                    # Cria novo registro de estoque
-                    cur.execute("""
-                        INSERT INTO stock (ean, lot, qty, location, store_id)
-                        VALUES (%s, %s, %s, %s, %s)
-                    """, (ean_r, lot_r, qty_r, location_r, store_id))
-                    st.success("Novo item de estoque criado com sucesso!")
-
-                conn.commit()
-
-                # Registra o movimento
+                # Soma a entrada no estoque da loja (criando o registro) e registra o movimento
                 bot.movimentar(
                     conn,
                     "receipt",
@@ -324,6 +249,7 @@ def main(conn, cfg, user):
                     local=location_r,
                     store_id=store_id,
                 )
+                st.success("Entrada registrada com sucesso!")
 
             except Exception as e:
                 st.error(f"Erro ao registrar: {e}")
@@ -424,24 +350,6 @@ def main(conn, cfg, user):
 
     
 
-    total_estoque = int(df["qty"].sum()) if not df.empty else 0
-    total_vencido = int(exp["qty"].sum()) if not exp.empty else 0
-    total_a_vencer = int(near["qty"].sum()) if not near.empty else 0
-
-    if store_id is None:
-        mov = pd.read_sql_query(
-            "SELECT * FROM movements WHERE store_id IS NULL",
-            conn,
-            parse_dates=["ts"]
-        )
-    else:
-        mov = pd.read_sql_query(
-            "SELECT * FROM movements WHERE store_id = %s",
-            conn,
-            params=(store_id,),
-            parse_dates=["ts"]
-        )
-
     # ------------------ ABA 1: Operacional ------------------
     with abas[1]:
         st.subheader("📋 Estoque Atual")
@@ -492,10 +400,10 @@ def main(conn, cfg, user):
             colA, colB = st.columns(2)
             if colA.button("💾 Salvar Alterações"):
                 try:
-                    cur = conn.cursor()
-                    cur.execute("UPDATE stock SET qty=%s, location=%s WHERE ean=%s AND lot=%s", (nova_qtd, novo_local, ean_sel, lot_sel))
-                    cur.execute("UPDATE lots SET expiry_date=%s WHERE ean=%s AND lot=%s", (nova_data.isoformat(), ean_sel, lot_sel))
-                    conn.commit()
+                    repo = get_repository(conn)
+                    repo.update_stock_item(ean_sel, lot_sel, item["store_id"], int(nova_qtd), novo_local)
+                    repo.update_lot_expiry(ean_sel, lot_sel, nova_data)
+                    repo.commit()
                     st.success("Item atualizado com sucesso!")
                 except Exception as e:
                     st.error(f"Erro ao atualizar: {e}")
@@ -504,10 +412,9 @@ def main(conn, cfg, user):
                 confirm = st.checkbox("Confirmar exclusão permanente do item")
                 if confirm:
                     try:
-                        cur = conn.cursor()
-                        cur.execute("DELETE FROM stock WHERE ean=%s AND lot=%s", (ean_sel, lot_sel))
-                        cur.execute("DELETE FROM lots WHERE ean=%s AND lot=%s", (ean_sel, lot_sel))
-                        conn.commit()
+                        repo = get_repository(conn)
+                        repo.delete_stock_item(ean_sel, lot_sel, item["store_id"])
+                        repo.commit()
                         st.warning("Item excluído com sucesso!")
                     except Exception as e:
                         st.error(f"Erro ao excluir: {e}")
@@ -566,13 +473,21 @@ def main(conn, cfg, user):
      
        
     # ------------------ ABA 2: Relatórios e Indicadores ------------------
-    total_recebido = int(mov[mov["type"] == "receipt"]["qty"].sum()) if not mov.empty else 0
-    total_vendido = int(mov[mov["type"] == "sale"]["qty"].sum()) if not mov.empty else 0
-    perc_vendido = (total_vendido / total_recebido * 100) if total_recebido > 0 else 0
-    perc_vencido = (total_vencido / total_recebido * 100) if total_recebido > 0 else 0
-    
     with abas[2]:
         st.subheader("📊 Indicadores (KPIs)")
+        periodo = st.date_input("Período dos movimentos (vazio = todo o histórico)", value=(), key="kpi_periodo")
+        data_inicio = periodo[0] if len(periodo) > 0 else None
+        data_fim = periodo[1] if len(periodo) > 1 else data_inicio
+
+        kpi = reporting.kpis(conn, store_id, data_inicio, data_fim, dias_alerta=dias_alerta, hist=hist)
+        total_estoque = kpi["em_estoque"]
+        total_vencido = kpi["vencido"]
+        total_a_vencer = kpi["a_vencer"]
+        total_recebido = kpi["recebido"]
+        total_vendido = kpi["vendido"]
+        perc_vendido = (total_vendido / total_recebido * 100) if total_recebido > 0 else 0
+        perc_vencido = (total_vencido / total_recebido * 100) if total_recebido > 0 else 0
+
         c1,c2,c3,c4,c5 = st.columns(5)
         c1.metric("📦 Em Estoque", total_estoque)
         c2.metric("🛒 Vendidos", total_vendido, f"{perc_vendido:.1f}%")
@@ -587,6 +502,44 @@ def main(conn, cfg, user):
         fig2 = px.pie(dist_df, values="Quantidade", names="Categoria", title="Distribuição do Estoque")
         st.plotly_chart(fig2, use_container_width=True)
 
+        st.divider()
+        st.subheader("📈 Tendência Mensal")
+        # lê só o rollup diário (movements_daily): o app agrega os movimentos novos no
+        # máximo a cada reporting.ROLLUP_MAX_AGE s; o botão força na hora
+        colT1, colT2, colT3 = st.columns([3, 1, 1])
+        produtos = df[["ean", "product_name"]].drop_duplicates("ean").sort_values("product_name")
+        opcoes_prod = [None] + produtos["ean"].tolist()
+        nomes_prod = dict(zip(produtos["ean"], produtos["product_name"]))
+        ean_trend = colT1.selectbox(
+            "Produto", opcoes_prod,
+            format_func=lambda e: "Todos os produtos" if e is None else f"{nomes_prod[e]} ({e})",
+            key="trend_ean",
+        )
+        meses_trend = colT2.number_input("Meses", min_value=3, max_value=60, value=12, step=1, key="trend_meses")
+        if colT3.button("🔄 Atualizar histórico"):
+            n = reporting.refresh_movements_daily(conn)
+            st.toast(f"{n} movimento(s) agregado(s).")
+        else:
+            try:
+                reporting.refresh_movements_daily_if_stale(conn)
+            except Exception as e:
+                st.caption(f"⚠️ Histórico não atualizado agora: {e}")
+
+        trend = reporting.monthly_trend(conn, store_id=store_id, ean=ean_trend, months=int(meses_trend))
+        if trend[["recebido", "vendido", "ajustado"]].to_numpy().sum() == 0:
+            st.info("Sem movimentos no período (ou o histórico ainda não foi atualizado).")
+        else:
+            trend_long = trend.melt(
+                id_vars="mes", value_vars=["recebido", "vendido", "ajustado"],
+                var_name="Tipo", value_name="Quantidade",
+            )
+            fig3 = px.bar(trend_long, x="mes", y="Quantidade", color="Tipo", barmode="group",
+                          title="Recebido x Vendido x Ajustado por mês")
+            st.plotly_chart(fig3, use_container_width=True)
+            fig4 = px.line(trend, x="mes", y="sell_through", markers=True,
+                           title="Sell-through (% vendido / recebido)")
+            st.plotly_chart(fig4, use_container_width=True)
+
         st.divider()
         colA, colB = st.columns(2)
         if colA.button("📊 Gerar Relatório Excel"):
@@ -595,6 +548,9 @@ def main(conn, cfg, user):
             with open(path, "rb") as f:
                 colA.download_button("Baixar Excel", f, file_name=Path(path).name)
 
+        pdf_completo = colB.checkbox(
+            "Listagem completa (todos os lotes, por faixa de validade)", key="pdf_completo"
+        )
         if colB.button("📄 Gerar Relatório PDF"):
             pdf_path = gerar_relatorio_pdf(
                 cfg,
@@ -603,7 +559,8 @@ def main(conn, cfg, user):
                 total_a_vencer=total_a_vencer,
                 total_vencido=total_vencido,
                 total_vendido=total_vendido,
-                store_id=user.get("store_id")
+                store_id=user.get("store_id"),
+                completo=pdf_completo
             )
             colB.success(f"PDF gerado em: {pdf_path}")
             with open(pdf_path, "rb") as f:
@@ -616,25 +573,34 @@ def main(conn, cfg, user):
             st.caption("Configure o Gmail (senha de app) em ⚙️ Configurações antes de enviar.")
 
             # Seletor de loja para envio de alerta
-            lojas = conn.execute("SELECT id, name FROM stores").fetchall()
+            lojas = get_repository(conn).list_stores()
             loja_opcoes = {f"{s[1]} (ID {s[0]})": s[0] for s in lojas}
             loja_sel_alerta = st.selectbox("Selecione a loja para enviar o alerta", options=list(loja_opcoes.keys()))
 
             if st.button("📤 Enviar alerta agora"):
                 store_id_alerta = loja_opcoes[loja_sel_alerta]
-                df_alerta = reporting.build_snapshots(conn)
-                df_alerta = df_alerta[df_alerta["store_id"] == store_id_alerta]
+                inicio, fim = reporting.near_expiry_window(cfg["near_expiry_days"])
+                df_alerta = reporting.build_snapshots(
+                    conn, store_id=store_id_alerta, expiry_from=inicio, expiry_to=fim
+                )
                 near_alerta = reporting.near_expiry(df_alerta, cfg["near_expiry_days"])
 
                 if near_alerta.empty:
                     st.info(f"Nenhum produto próximo da validade para a loja {loja_sel_alerta}.")
                 else:
                     near_body = reporting.to_console(near_alerta, f"Itens a vencer em {cfg['near_expiry_days']} dias")
-                    ok, info = bot.enviar_email_alerta(cfg, f"⚠️ Alerta: produtos a vencer — {loja_sel_alerta}", near_body)
-                    if ok:
-                        st.success(info)
+                    cfg_alerta = config_lojas.config_loja(conn, cfg_global, store_id_alerta)
+                    if not cfg_alerta.get("alert_email", {}).get("enabled", False):
+                        st.warning(f"Envio de e-mails desativado para a loja {loja_sel_alerta}.")
                     else:
-                        st.error(f"❌ {info}")
+                        # Só enfileira: o worker da fila (iniciado no app) envia e refaz as tentativas
+                        alert_id = outbox_alertas.enfileirar_alerta(
+                            conn, store_id_alerta, f"⚠️ Alerta: produtos a vencer — {loja_sel_alerta}", near_body
+                        )
+                        st.success(f"📥 Alerta #{alert_id} na fila de envio; o e-mail sai em segundo plano.")
+
+            with st.expander("📬 Fila de envio de alertas"):
+                st.dataframe(get_repository(conn).alert_outbox(limit=20), use_container_width=True)
     else:
         with abas[3]:
             st.info("🔒 Acesso restrito: apenas administradores podem visualizar e enviar alertas.")
@@ -644,7 +610,7 @@ def main(conn, cfg, user):
         with abas[4]:
             st.subheader("⚙️ Parâmetros do Sistema (Administrador)")
 
-            lojas = conn.execute("SELECT id, name FROM stores").fetchall()
+            lojas = get_repository(conn).list_stores()
 
             # ✅ Verifica se há lojas cadastradas
             if not lojas:
@@ -664,13 +630,8 @@ def main(conn, cfg, user):
                 st.error("Erro: loja selecionada não encontrada. Recarregue a página.")
                 st.stop()
 
-            CFG_STORE_PATH = Path(__file__).resolve().parents[1] / f"config_loja_{loja_id}.json"
-
-            # Carrega ou herda config da loja
-            if CFG_STORE_PATH.exists():
-                cfg_loja = json.loads(CFG_STORE_PATH.read_text(encoding="utf-8"))
-            else:
-                cfg_loja = cfg.copy()
+            # Configuração da loja (ou herdada do config.json)
+            cfg_loja = config_lojas.config_loja(conn, cfg_global, loja_id)
 
             # Formulário de configuração
             days = st.number_input(
@@ -697,8 +658,7 @@ def main(conn, cfg, user):
                 enabled = st.checkbox("Habilitar envio de e-mails", value=bool(cfg_loja.get("alert_email", {}).get("enabled", False)))
 
             if st.button("💾 Salvar configurações da loja selecionada"):
-                cfg_loja["near_expiry_days"] = int(days)
-                cfg_loja["alert_email"] = {
+                config_lojas.salvar_config_loja(conn, loja_id, near_expiry_days=int(days), alert_email={
                     "enabled": bool(enabled),
                     "smtp_server": smtp_server,
                     "smtp_port": int(smtp_port),
@@ -707,9 +667,7 @@ def main(conn, cfg, user):
                     "password": password,
                     "from_addr": from_addr,
                     "to_addrs": [a.strip() for a in to_addrs.split(",") if a.strip()]
-                }
-
-                CFG_STORE_PATH.write_text(json.dumps(cfg_loja, indent=2, ensure_ascii=False), encoding="utf-8")
+                })
                 st.success(f"Configurações atualizadas para {loja_sel}.")
                 st.rerun()
     else:
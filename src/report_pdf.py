@@ -2,21 +2,284 @@ from reportlab.lib.pagesizes import A4
 from reportlab.lib import colors
 from reportlab.lib.units import cm
 from reportlab.platypus import (
-    SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, Image
+    SimpleDocTemplate, Table, LongTable, TableStyle, Paragraph, Spacer, Image, PageBreak
 )
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.graphics.shapes import Drawing, String
+from reportlab.graphics.charts.piecharts import Pie
 from datetime import datetime
+from functools import lru_cache
+from itertools import chain
 from pathlib import Path
 import pandas as pd
 import io
-import matplotlib.pyplot as plt
 import sqlite3
 
+from reporting import EXPIRY_BUCKET_LIMITS
 
-def gerar_relatorio_pdf(cfg, df, total_estoque, total_a_vencer, total_vencido, total_vendido, store_id=None):
+# =====================
+# 🎨 Estilos (montados uma vez por processo, reaproveitados em todo relatório)
+# =====================
+_STYLES = getSampleStyleSheet()
+STYLE_NORMAL = _STYLES["Normal"]
+STYLE_TITLE = ParagraphStyle(
+    'Title',
+    parent=_STYLES['Heading1'],
+    alignment=1,
+    fontSize=16,
+    spaceAfter=10,
+    textColor=colors.darkblue
+)
+STYLE_SUBTITLE = ParagraphStyle(
+    'SubTitle',
+    parent=STYLE_NORMAL,
+    fontSize=10,
+    textColor=colors.black,
+    alignment=1
+)
+
+KPI_TABLE_STYLE = TableStyle([
+    ("BACKGROUND", (0, 0), (-1, 0), colors.lightblue),
+    ("TEXTCOLOR", (0, 0), (-1, 0), colors.white),
+    ("ALIGN", (0, 0), (-1, -1), "CENTER"),
+    ("GRID", (0, 0), (-1, -1), 0.5, colors.grey),
+    ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
+])
+PRODUCT_TABLE_STYLE = TableStyle([
+    ("BACKGROUND", (0, 0), (-1, 0), colors.lightgrey),
+    ("TEXTCOLOR", (0, 0), (-1, 0), colors.black),
+    ("ALIGN", (0, 0), (-1, -1), "CENTER"),
+    ("GRID", (0, 0), (-1, -1), 0.25, colors.grey),
+    ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
+    ("FONTSIZE", (0, 0), (-1, -1), 8),
+])
+
+# cor fixa por categoria (não muda quando alguma fatia é zero)
+DONUT_COLORS = {
+    "Vendidos": "#4B9FE1",
+    "A Vencer": "#FFC857",
+    "Vencidos": "#E84855",
+    "Em Estoque": "#3CB371",
+}
+DONUT_SIZE = 9 * cm
+
+
+# =====================
+# 🥧 Donut de distribuição do estoque
+# =====================
+def _donut_vetorial(categorias):
+    """Donut desenhado com reportlab.graphics: vetorial, sem rasterizar nem importar matplotlib."""
+    titulo = 0.8 * cm
+    d = Drawing(DONUT_SIZE, DONUT_SIZE + titulo)
+    d.add(String(DONUT_SIZE / 2, DONUT_SIZE + titulo / 2, "Distribuição do Estoque",
+                 textAnchor="middle", fontName="Helvetica-Bold", fontSize=12,
+                 fillColor=colors.HexColor("#333333")))
+
+    total = sum(categorias.values())
+    pie = Pie()
+    diametro = DONUT_SIZE * 0.62
+    pie.x = pie.y = (DONUT_SIZE - diametro) / 2
+    pie.width = pie.height = diametro
+    pie.data = list(categorias.values())
+    pie.labels = [f"{nome} {valor / total:.1%}" for nome, valor in categorias.items()]
+    pie.innerRadiusFraction = 0.55
+    pie.startAngle = 90
+    pie.direction = "clockwise"
+    pie.simpleLabels = 1
+    pie.checkLabelOverlap = 1
+    pie.slices.strokeColor = colors.white
+    pie.slices.strokeWidth = 1.5
+    pie.slices.labelRadius = 1.22
+    pie.slices.fontName = "Helvetica-Bold"
+    pie.slices.fontSize = 8
+    for i, nome in enumerate(categorias):
+        pie.slices[i].fillColor = colors.HexColor(DONUT_COLORS[nome])
+    d.add(pie)
+    return d
+
+
+def _donut_matplotlib(categorias):
+    """Fallback opcional: PNG do matplotlib, importado só quando usado."""
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots(figsize=(4.5, 4.5), facecolor="white")
+    ax.pie(
+        categorias.values(),
+        labels=categorias.keys(),
+        autopct="%1.1f%%",
+        startangle=90,
+        counterclock=False,
+        pctdistance=0.8,
+        textprops={"fontsize": 9, "color": "black", "weight": "bold"},
+        wedgeprops={"linewidth": 1.5, "edgecolor": "white"},
+        colors=[DONUT_COLORS[nome] for nome in categorias],
+    )
+    centre_circle = plt.Circle((0, 0), 0.55, fc="white", lw=0)
+    fig.gca().add_artist(centre_circle)
+    ax.set_title("Distribuição do Estoque", fontsize=12, fontweight="bold", color="#333333", pad=12)
+    plt.tight_layout()
+    img_buf = io.BytesIO()
+    plt.savefig(img_buf, format="png", dpi=150, bbox_inches="tight", facecolor="white")
+    plt.close(fig)
+    img_buf.seek(0)
+    return Image(img_buf, width=DONUT_SIZE, height=DONUT_SIZE)
+
+
+def grafico_distribuicao(categorias, engine="reportlab"):
+    """
+    Flowable do donut. engine="matplotlib" força o PNG antigo; se o desenho
+    vetorial falhar, o matplotlib (se instalado) é usado como reserva.
+    """
+    categorias = {k: v for k, v in categorias.items() if v > 0}
+    if not categorias:
+        return Paragraph("<i>Sem estoque para o gráfico de distribuição.</i>", STYLE_SUBTITLE)
+    if engine != "matplotlib":
+        try:
+            return _donut_vetorial(categorias)
+        except Exception:
+            pass
+    return _donut_matplotlib(categorias)
+
+
+# =====================
+# 📚 Listagem completa (auditoria)
+# =====================
+PAGE_MARGIN = 1.2 * cm
+LISTING_COLUMNS = ["Produto", "Lote", "Validade", "Qtde", "Local"]
+LISTING_COL_WIDTHS = [7.2 * cm, 2.8 * cm, 2.4 * cm, 1.8 * cm, 4.2 * cm]
+LISTING_NAME_CHARS = 45  # células não quebram linha: nomes longos são cortados
+STYLE_BUCKET = ParagraphStyle(
+    'Faixa',
+    parent=_STYLES['Heading3'],
+    textColor=colors.darkblue,
+    spaceAfter=6
+)
+LISTING_TABLE_STYLE = TableStyle([
+    ("BACKGROUND", (0, 0), (-1, 0), colors.lightgrey),
+    ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
+    ("FONTSIZE", (0, 0), (-1, -1), 7),
+    ("ALIGN", (1, 0), (-1, -1), "CENTER"),
+    ("GRID", (0, 0), (-1, -1), 0.25, colors.grey),
+    ("TOPPADDING", (0, 0), (-1, -1), 1),
+    ("BOTTOMPADDING", (0, 0), (-1, -1), 1),
+])
+
+# mesmas faixas de reporting.expiry_buckets, na ordem de urgência
+LISTING_BUCKETS = (
+    ["vencido"] + [f"ate_{d}" for d in EXPIRY_BUCKET_LIMITS] + ["saudavel", "sem_validade"]
+)
+BUCKET_TITLES = {
+    "vencido": "Vencidos",
+    **{f"ate_{d}": f"Vencem em até {d} dias" for d in EXPIRY_BUCKET_LIMITS},
+    "saudavel": f"Vencem em mais de {EXPIRY_BUCKET_LIMITS[-1]} dias",
+    "sem_validade": "Sem validade cadastrada",
+}
+
+
+@lru_cache(maxsize=1)
+def _linhas_por_pagina():
+    """
+    (linhas no 1º bloco de uma faixa, linhas nos demais): quantas linhas de dados
+    cabem numa página A4 abaixo do cabeçalho da tabela, medidas uma vez com wrap().
+    """
+    largura = A4[0] - 2 * PAGE_MARGIN
+    altura = A4[1] - 2 * PAGE_MARGIN - 12  # padding padrão do Frame (6 pt em cima e embaixo)
+    amostra = LongTable([LISTING_COLUMNS, LISTING_COLUMNS], colWidths=LISTING_COL_WIDTHS)
+    amostra.setStyle(LISTING_TABLE_STYLE)
+    linha = amostra.wrap(largura, altura)[1] / 2
+    titulo = Paragraph(BUCKET_TITLES["vencido"], STYLE_BUCKET).wrap(largura, altura)[1] + STYLE_BUCKET.spaceAfter
+    demais = int(altura // linha) - 2  # cabeçalho + 1 linha de folga
+    return int((altura - titulo) // linha) - 2, demais
+
+
+def _blocos_listagem(df, primeiro, demais):
+    """
+    Gera (faixa, total da faixa, linhas) com as linhas já formatadas, faixa a faixa
+    e em blocos de até `primeiro`/`demais` linhas; só o bloco corrente vira lista Python.
+    """
+    hoje = pd.Timestamp.today().normalize()
+    validade = pd.to_datetime(df["expiry_date"], errors="coerce")
+    dias = (validade - hoje).dt.days
+    limites = [-float("inf"), -1] + list(EXPIRY_BUCKET_LIMITS) + [float("inf")]
+    faixa = pd.cut(dias, bins=limites, labels=False).fillna(len(LISTING_BUCKETS) - 1).astype(int)
+
+    ordem = (
+        pd.DataFrame({"faixa": faixa.to_numpy(), "validade": validade.to_numpy(),
+                      "produto": df["product_name"].to_numpy()})
+        .sort_values(["faixa", "validade", "produto"], kind="stable")
+    )
+    posicoes = ordem.index.to_numpy()
+    faixas = ordem["faixa"].to_numpy()
+    colunas = df[["product_name", "lot", "expiry_date", "qty", "location"]].reset_index(drop=True)
+
+    inicio = 0
+    while inicio < len(posicoes):
+        codigo = faixas[inicio]
+        fim_faixa = int(faixas.searchsorted(codigo, side="right"))
+        total = fim_faixa - inicio
+        tamanho = primeiro
+        while inicio < fim_faixa:
+            bloco = colunas.iloc[posicoes[inicio:min(inicio + tamanho, fim_faixa)]]
+            linhas = list(zip(
+                bloco["product_name"].astype(str).str.slice(0, LISTING_NAME_CHARS),
+                bloco["lot"].astype(str),
+                pd.to_datetime(bloco["expiry_date"], errors="coerce").dt.strftime("%d/%m/%Y").fillna("—"),
+                bloco["qty"].astype(int).astype(str),
+                bloco["location"].fillna("").astype(str),
+            ))
+            yield LISTING_BUCKETS[codigo], total, linhas
+            inicio += len(linhas)
+            tamanho = demais
+        inicio = fim_faixa
+
+
+def _flowables_listagem(df):
+    """Uma página nova por faixa de validade; cada bloco é uma LongTable com cabeçalho repetido."""
+    primeiro, demais = _linhas_por_pagina()
+    faixa_atual = None
+    for faixa, total, linhas in _blocos_listagem(df, primeiro, demais):
+        if faixa != faixa_atual:
+            faixa_atual = faixa
+            yield PageBreak()
+            yield Paragraph(f"<b>{BUCKET_TITLES[faixa]}</b> — {total} lote(s)", STYLE_BUCKET)
+        tabela = LongTable([LISTING_COLUMNS] + linhas, colWidths=LISTING_COL_WIDTHS, repeatRows=1)
+        tabela.setStyle(LISTING_TABLE_STYLE)
+        yield tabela
+
+
+class _FlowablesSobDemanda(list):
+    """
+    Lista que o doc.build consome pela frente (del lista[0]): a cada item
+    consumido puxa mais do gerador, mantendo só `janela` flowables em memória.
+    """
+
+    def __init__(self, itens, janela=4):
+        super().__init__()
+        self._fonte = iter(itens)
+        self._janela = janela
+        self._encher()
+
+    def _encher(self):
+        while self._fonte is not None and len(self) < self._janela:
+            try:
+                self.append(next(self._fonte))
+            except StopIteration:
+                self._fonte = None
+
+    def __delitem__(self, i):
+        super().__delitem__(i)
+        self._encher()
+
+
+def gerar_relatorio_pdf(cfg, df, total_estoque, total_a_vencer, total_vencido, total_vendido, store_id=None,
+                        completo=False):
     """
     Gera um relatório PDF resumido e em uma única página.
     Filtra por loja, inclui gráficos e resumos.
+    Com completo=True, a primeira página traz os indicadores e as seguintes listam
+    todos os lotes agrupados por faixa de validade (memória limitada a poucas páginas).
     """
 
     # =====================
@@ -53,27 +316,10 @@ def gerar_relatorio_pdf(cfg, df, total_estoque, total_a_vencer, total_vencido, t
     doc = SimpleDocTemplate(
         pdf_path_str,
         pagesize=A4,
-        leftMargin=1.2 * cm,
-        rightMargin=1.2 * cm,
-        topMargin=1.2 * cm,
-        bottomMargin=1.2 * cm
-    )
-
-    styles = getSampleStyleSheet()
-    style_title = ParagraphStyle(
-        'Title',
-        parent=styles['Heading1'],
-        alignment=1,
-        fontSize=16,
-        spaceAfter=10,
-        textColor=colors.darkblue
-    )
-    style_subtitle = ParagraphStyle(
-        'SubTitle',
-        parent=styles['Normal'],
-        fontSize=10,
-        textColor=colors.black,
-        alignment=1
+        leftMargin=PAGE_MARGIN,
+        rightMargin=PAGE_MARGIN,
+        topMargin=PAGE_MARGIN,
+        bottomMargin=PAGE_MARGIN
     )
 
     elements = []
@@ -81,8 +327,8 @@ def gerar_relatorio_pdf(cfg, df, total_estoque, total_a_vencer, total_vencido, t
     # =====================
     # 🏷️ Cabeçalho
     # =====================
-    elements.append(Paragraph(f"<b>Relatório de Validades — {loja_nome}</b>", style_title))
-    elements.append(Paragraph(f"Gerado em {datetime.now().strftime('%d/%m/%Y %H:%M')}", style_subtitle))
+    elements.append(Paragraph(f"<b>Relatório de Validades — {loja_nome}</b>", STYLE_TITLE))
+    elements.append(Paragraph(f"Gerado em {datetime.now().strftime('%d/%m/%Y %H:%M')}", STYLE_SUBTITLE))
     elements.append(Spacer(1, 0.3 * cm))
 
     # =====================
@@ -96,56 +342,36 @@ def gerar_relatorio_pdf(cfg, df, total_estoque, total_a_vencer, total_vencido, t
         ["Vendidos", f"{total_vendido}"]
     ]
     kpi_table = Table(data_kpi, colWidths=[8 * cm, 6 * cm])
-    kpi_table.setStyle(TableStyle([
-        ("BACKGROUND", (0, 0), (-1, 0), colors.lightblue),
-        ("TEXTCOLOR", (0, 0), (-1, 0), colors.white),
-        ("ALIGN", (0, 0), (-1, -1), "CENTER"),
-        ("GRID", (0, 0), (-1, -1), 0.5, colors.grey),
-        ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
-    ]))
+    kpi_table.setStyle(KPI_TABLE_STYLE)
     elements.append(kpi_table)
     elements.append(Spacer(1, 0.4 * cm))
 
     # =====================
-    # 🥧 Gráfico profissional tipo donut
+    # 🥧 Gráfico tipo donut (vetorial)
     # =====================
     try:
-        categorias = {
-            "🛒 Vendidos": total_vendido,
-            "⚠️ A Vencer": total_a_vencer,
-            "❌ Vencidos": total_vencido,
-            "📦 Em Estoque": total_estoque
-        }
-        categorias = {k: v for k, v in categorias.items() if v > 0}
-
-        fig, ax = plt.subplots(figsize=(4.5, 4.5), facecolor="white")
-        wedges, texts, autotexts = ax.pie(
-            categorias.values(),
-            labels=categorias.keys(),
-            autopct="%1.1f%%",
-            startangle=90,
-            counterclock=False,
-            pctdistance=0.8,
-            textprops={"fontsize": 9, "color": "black", "weight": "bold"},
-            wedgeprops={"linewidth": 1.5, "edgecolor": "white"},
-            colors=["#4B9FE1", "#FFC857", "#E84855", "#3CB371"]
-        )
-        centre_circle = plt.Circle((0, 0), 0.55, fc="white", lw=0)
-        fig.gca().add_artist(centre_circle)
-        ax.set_title("Distribuição do Estoque", fontsize=12, fontweight="bold", color="#333333", pad=12)
-        plt.tight_layout()
-        img_buf = io.BytesIO()
-        plt.savefig(img_buf, format="png", dpi=150, bbox_inches="tight", facecolor="white")
-        plt.close(fig)
-        img_buf.seek(0)
-        elements.append(Image(img_buf, width=9 * cm, height=9 * cm))
+        elements.append(grafico_distribuicao({
+            "Vendidos": total_vendido,
+            "A Vencer": total_a_vencer,
+            "Vencidos": total_vencido,
+            "Em Estoque": total_estoque
+        }, engine=cfg.get("pdf_chart_engine", "reportlab")))
         elements.append(Spacer(1, 0.5 * cm))
     except Exception as e:
-        elements.append(Paragraph(f"Erro ao gerar gráfico: {e}", styles["Normal"]))
+        elements.append(Paragraph(f"Erro ao gerar gráfico: {e}", STYLE_NORMAL))
 
     # =====================
     # 🧾 Tabela de produtos (compacta)
     # =====================
+    if completo:
+        elements.append(Paragraph(
+            f"<i>Listagem completa: {len(df)} lote(s) nas páginas seguintes, por faixa de validade.</i>",
+            STYLE_SUBTITLE
+        ))
+        elements.append(Paragraph("<b>Relatório completo — Sistema Controle LRC</b>", STYLE_SUBTITLE))
+        doc.build(_FlowablesSobDemanda(chain(elements, _flowables_listagem(df))))
+        return pdf_path_str
+
     if not df.empty:
         resumo = df[["product_name", "lot", "expiry_date", "qty", "location"]].copy()
         resumo.rename(columns={
@@ -160,27 +386,20 @@ def gerar_relatorio_pdf(cfg, df, total_estoque, total_a_vencer, total_vencido, t
         max_rows = 20
         if len(resumo) > max_rows:
             resumo = resumo.head(max_rows)
-            elements.append(Paragraph("<i>Exibindo apenas as 20 primeiras linhas...</i>", style_subtitle))
+            elements.append(Paragraph("<i>Exibindo apenas as 20 primeiras linhas...</i>", STYLE_SUBTITLE))
 
         data_table = [resumo.columns.tolist()] + resumo.values.tolist()
         table = Table(data_table, colWidths=[5 * cm, 2 * cm, 2.5 * cm, 2 * cm, 3 * cm])
-        table.setStyle(TableStyle([
-            ("BACKGROUND", (0, 0), (-1, 0), colors.lightgrey),
-            ("TEXTCOLOR", (0, 0), (-1, 0), colors.black),
-            ("ALIGN", (0, 0), (-1, -1), "CENTER"),
-            ("GRID", (0, 0), (-1, -1), 0.25, colors.grey),
-            ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
-            ("FONTSIZE", (0, 0), (-1, -1), 8),
-        ]))
+        table.setStyle(PRODUCT_TABLE_STYLE)
         elements.append(table)
         elements.append(Spacer(1, 0.3 * cm))
     else:
-        elements.append(Paragraph("Nenhum produto encontrado para o relatório.", styles["Normal"]))
+        elements.append(Paragraph("Nenhum produto encontrado para o relatório.", STYLE_NORMAL))
 
     # =====================
     # 📄 Rodapé
     # =====================
-    elements.append(Paragraph("<b>Relatório resumido — Sistema Controle LRC</b>", style_subtitle))
+    elements.append(Paragraph("<b>Relatório resumido — Sistema Controle LRC</b>", STYLE_SUBTITLE))
 
     # =====================
     # 🖨️ Gera o PDF final
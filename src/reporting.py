@@ -1,32 +1,247 @@
+import threading
+import time
 from datetime import date, timedelta
 import pandas as pd
 from tabulate import tabulate
 
+from repository import get_repository
 
-def build_snapshots(conn):
+
+def build_snapshots(conn, store_id=None, expiry_from=None, expiry_to=None, ean=None):
     """
     Retorna o snapshot atual do estoque,
     incluindo o campo store_id para permitir filtro por loja.
+
+    Lê da tabela desnormalizada stock_snapshot (mantida por triggers),
+    sem o join entre stock, lots e products.
+
+    Os filtros opcionais são aplicados no próprio SQL (e não no pandas),
+    para que cada tela só traga as linhas que realmente vai exibir:
+      - store_id: apenas a loja informada (None = todas as lojas)
+      - expiry_from / expiry_to: janela de validade (inclusiva)
+      - ean: um EAN ou uma lista de EANs
+    O schema do DataFrame é o mesmo em todos os casos.
     """
-    q = """
-    SELECT 
-        s.ean,
-        p.product_name,
-        s.lot,
-        l.expiry_date,
-        s.qty,
-        IFNULL(s.location, '') AS location,
-        s.store_id
+    return get_repository(conn).snapshot(
+        store_id=store_id, expiry_from=expiry_from, expiry_to=expiry_to, ean=ean
+    )
+
+
+# Mesmo conteúdo que os triggers gravam em stock_snapshot, calculado do zero
+_SNAPSHOT_SOURCE = """
+    SELECT s.id AS stock_id, s.ean, p.product_name, s.lot, l.expiry_date,
+           s.qty, s.location, s.store_id
     FROM stock s
     JOIN lots l ON l.ean = s.ean AND l.lot = s.lot
     JOIN products p ON p.ean = s.ean
-    WHERE s.qty > 0
-    ORDER BY s.store_id, l.expiry_date ASC
+"""
+_SNAPSHOT_COLUMNS = "stock_id, ean, product_name, lot, expiry_date, qty, location, store_id"
+
+
+def verify_stock_snapshot(conn):
+    """
+    Compara stock_snapshot com o join stock/lots/products.
+    Retorna {"faltando": n, "sobrando": m, "ok": bool}:
+      - faltando: linhas que deveriam estar no snapshot (ou estão diferentes)
+      - sobrando: linhas do snapshot que não existem mais na origem
+    """
+    cur = conn.cursor()
+    cur.execute(f"""
+        SELECT COUNT(*) FROM (
+            {_SNAPSHOT_SOURCE}
+            EXCEPT
+            SELECT {_SNAPSHOT_COLUMNS} FROM stock_snapshot
+        ) d
+    """)
+    faltando = _first_value(cur.fetchone())
+    cur.execute(f"""
+        SELECT COUNT(*) FROM (
+            SELECT {_SNAPSHOT_COLUMNS} FROM stock_snapshot
+            EXCEPT
+            {_SNAPSHOT_SOURCE}
+        ) d
+    """)
+    sobrando = _first_value(cur.fetchone())
+    return {"faltando": faltando, "sobrando": sobrando, "ok": faltando == 0 and sobrando == 0}
+
+
+def rebuild_stock_snapshot(conn):
+    """Recria stock_snapshot do zero a partir de stock/lots/products. Retorna o nº de linhas."""
+    cur = conn.cursor()
+    try:
+        cur.execute("DELETE FROM stock_snapshot")
+        cur.execute(f"INSERT INTO stock_snapshot({_SNAPSHOT_COLUMNS}) {_SNAPSHOT_SOURCE}")
+        total = cur.rowcount
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return total
+
+
+def _read_sql(conn, sql, params=(), parse_dates=()):
+    """Executa a consulta (SQL com "?") pelo repositório da conexão e devolve um DataFrame."""
+    return get_repository(conn).query_df(sql, params, parse_dates=parse_dates)
+
+
+def _first_value(row):
+    """Primeiro valor de uma linha (tupla do sqlite3 ou RealDictRow do psycopg2)."""
+    if isinstance(row, dict):
+        return next(iter(row.values()))
+    return row[0]
+
+
+def near_expiry_window(days=15):
+    """Retorna (hoje, hoje + X dias) para usar como janela em build_snapshots."""
+    today = date.today()
+    return today, today + timedelta(days=days)
+
+
+EXPIRY_BUCKET_LIMITS = (7, 15, 30)
+
+
+def expiry_buckets(conn, store_id=None, limits=EXPIRY_BUCKET_LIMITS):
     """
-    df = pd.read_sql_query(q, conn, parse_dates=["expiry_date"])
+    Histograma de validade por loja, calculado em uma única consulta agrupada.
+    Para limits=(7, 15, 30) as faixas são:
+      vencido (< hoje), ate_7 (hoje..+7), ate_15 (+8..+15), ate_30 (+16..+30), saudavel (> +30)
+    Retorna DataFrame com colunas store_id, bucket, qty, itens
+    (uma linha por loja e faixa que tenha estoque).
+    """
+    limits = sorted({int(d) for d in limits})
+    today = date.today()
+
+    cases = [f"WHEN expiry_date < ? THEN 'vencido'"]
+    params = [today.isoformat()]
+    for d in limits:
+        cases.append(f"WHEN expiry_date <= ? THEN 'ate_{d}'")
+        params.append((today + timedelta(days=d)).isoformat())
+
+    where = ["qty > 0"]
+    if store_id is not None:
+        where.append(f"store_id = ?")
+        params.append(int(store_id))
+
+    q = f"""
+    SELECT
+        store_id,
+        CASE {" ".join(cases)} ELSE 'saudavel' END AS bucket,
+        SUM(qty) AS qty,
+        COUNT(*) AS itens
+    FROM stock_snapshot
+    WHERE {" AND ".join(where)}
+    GROUP BY store_id, bucket
+    ORDER BY store_id
+    """
+    df = _read_sql(conn, q, params)
+    df["qty"] = df["qty"].fillna(0).astype(int)
+    df["itens"] = df["itens"].astype(int)
     return df
 
 
+def bucket_totals(hist, store_id=None):
+    """
+    Soma o histograma de expiry_buckets (de uma loja ou de todas) em
+    {bucket: {"qty": n, "itens": m}}. Faixas sem estoque não aparecem.
+    """
+    if store_id is not None:
+        hist = hist[hist["store_id"] == store_id]
+    grouped = hist.groupby("bucket")[["qty", "itens"]].sum()
+    return {b: {"qty": int(r["qty"]), "itens": int(r["itens"])} for b, r in grouped.iterrows()}
+
+
+def kpis(conn, store_id=None, data_inicio=None, data_fim=None, dias_alerta=15, hist=None):
+    """
+    Indicadores de uma loja (None = todas), somados no banco:
+      recebido / vendido / ajustado: SUM(qty) ... GROUP BY type em movements,
+        opcionalmente entre data_inicio e data_fim (datas inclusivas);
+      vencido / a_vencer / em_estoque: estoque atual, pelo histograma de expiry_buckets
+        (a_vencer = até dias_alerta dias). hist permite reaproveitar um histograma já calculado.
+    """
+    ts_to = pd.Timestamp(data_fim) + pd.Timedelta(days=1) if data_fim is not None else None
+    mov = get_repository(conn).movement_totals(store_id, ts_from=data_inicio, ts_to=ts_to)
+
+    if hist is None:
+        hist = expiry_buckets(conn, store_id=store_id, limits=(dias_alerta,))
+    faixas = bucket_totals(hist, store_id)
+
+    return {
+        "recebido": mov.get("receipt", 0),
+        "vendido": mov.get("sale", 0),
+        "ajustado": mov.get("adjustment", 0),
+        "vencido": faixas.get("vencido", {}).get("qty", 0),
+        "a_vencer": sum(f["qty"] for b, f in faixas.items() if b.startswith("ate_")),
+        "em_estoque": sum(f["qty"] for f in faixas.values()),
+    }
+
+
+def refresh_movements_daily(conn, full=False):
+    """
+    Job do rollup movements_daily: agrega só os movimentos novos (desde o último
+    movements.id processado) ou, com full=True, reconstrói tudo. Faz commit.
+    Retorna o número de ids de movimento processados.
+    """
+    repo = get_repository(conn)
+    try:
+        inicio, fim = repo.refresh_movements_daily(full=full)
+        repo.commit()
+    except Exception:
+        repo.rollback()
+        raise
+    return fim - inicio
+
+
+ROLLUP_MAX_AGE = 60  # s entre atualizações automáticas do rollup no app
+_ROLLUP_ATUALIZADO_EM = None
+_ROLLUP_LOCK = threading.Lock()
+
+
+def refresh_movements_daily_if_stale(conn, max_age=ROLLUP_MAX_AGE):
+    """
+    Atualização incremental do rollup feita pelo próprio app antes de ler as
+    tendências: no máximo uma a cada max_age segundos por processo, e uma
+    sessão não espera a de outra (se já há uma rodando, devolve 0).
+    """
+    global _ROLLUP_ATUALIZADO_EM
+    if not _ROLLUP_LOCK.acquire(blocking=False):
+        return 0
+    try:
+        if _ROLLUP_ATUALIZADO_EM is not None and time.monotonic() - _ROLLUP_ATUALIZADO_EM < max_age:
+            return 0
+        n = refresh_movements_daily(conn)
+        _ROLLUP_ATUALIZADO_EM = time.monotonic()
+        return n
+    finally:
+        _ROLLUP_LOCK.release()
+
+
+TREND_COLUMNS = ["mes", "recebido", "vendido", "ajustado", "sell_through"]
+
+
+def monthly_trend(conn, store_id=None, ean=None, months=12):
+    """
+    Recebido, vendido e ajustado por mês (últimos `months` meses, incluindo o atual)
+    e sell-through = vendido / recebido (%). Lê apenas o rollup movements_daily,
+    então o custo não cresce com o histórico bruto de movements.
+    """
+    inicio = pd.Timestamp.today().normalize().replace(day=1) - pd.DateOffset(months=months - 1)
+    daily = get_repository(conn).movement_trend(store_id=store_id, ean=ean, day_from=inicio)
+
+    meses = pd.date_range(inicio, periods=months, freq="MS")
+    if daily.empty:
+        tabela = pd.DataFrame(0, index=meses, columns=["receipt", "sale", "adjustment"])
+    else:
+        daily["mes"] = daily["day"].dt.to_period("M").dt.to_timestamp()
+        tabela = (
+            daily.pivot_table(index="mes", columns="type", values="qty", aggfunc="sum", fill_value=0)
+            .reindex(index=meses, columns=["receipt", "sale", "adjustment"], fill_value=0)
+        )
+
+    out = tabela.rename(columns={"receipt": "recebido", "sale": "vendido", "adjustment": "ajustado"}).astype(int)
+    out["sell_through"] = (out["vendido"] / out["recebido"].where(out["recebido"] > 0) * 100).round(1)
+    return out.rename_axis(index="mes", columns=None).reset_index()[TREND_COLUMNS]
+
+
 def near_expiry(df, days=15):
     """Filtra itens que vencem nos próximos X dias."""
     today = pd.Timestamp.today().normalize()
@@ -54,3 +269,31 @@ def to_console(df, title):
         return f"\n=== {title} ===\nNenhum item encontrado.\n"
     tbl = tabulate(df, headers="keys", tablefmt="github", showindex=False)
     return f"\n=== {title} ===\n{tbl}\n"
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+    from pathlib import Path
+
+    parser = argparse.ArgumentParser(description="Verifica/reconstrói a tabela stock_snapshot.")
+    parser.add_argument("--rebuild", action="store_true", help="recria o snapshot do zero")
+    parser.add_argument("--postgres", action="store_true", help="usa o banco do Supabase (db_supabase)")
+    args = parser.parse_args()
+
+    if args.postgres:
+        from db_supabase import get_conn, init_db
+        conn = get_conn()
+    else:
+        from db import get_conn, init_db
+        cfg = json.loads((Path(__file__).resolve().parents[1] / "config.json").read_text(encoding="utf-8"))
+        conn = get_conn(cfg["database_path"])
+    init_db(conn)
+
+    status = verify_stock_snapshot(conn)
+    print(f"stock_snapshot: faltando={status['faltando']} sobrando={status['sobrando']}")
+    if args.rebuild:
+        print(f"Snapshot reconstruído: {rebuild_stock_snapshot(conn)} linha(s).")
+    elif not status["ok"]:
+        print("⚠️ Divergência detectada. Rode com --rebuild para corrigir.")
+        raise SystemExit(1)
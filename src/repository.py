@@ -0,0 +1,774 @@
+# src/repository.py
+"""
+Camada de acesso a dados compartilhada pelo SQLite (db.py) e pelo Postgres
+(db_supabase.py).
+
+Todo SQL daqui é escrito uma vez, com "?" como placeholder, e cada backend
+cuida do resto:
+  - SQLiteRepository reaproveita um cursor por comando (o sqlite3 mantém o
+    statement compilado em cache por conexão);
+  - PostgresRepository usa prepared statements no servidor (PREPARE uma vez
+    por conexão, EXECUTE nas chamadas seguintes).
+
+Uso:
+    repo = get_repository(conn)
+    repo.upsert_products([(ean, nome), ...])
+    repo.commit()
+"""
+import hashlib
+import os
+import sqlite3
+import weakref
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Iterable, Optional
+
+import pandas as pd
+
+SNAPSHOT_COLUMNS = ["ean", "product_name", "lot", "expiry_date", "qty", "location", "store_id"]
+
+# Prepared statements não funcionam atrás de pgbouncer/Supavisor em modo
+# transaction (porta 6543); nesse caso defina PG_PREPARED_STATEMENTS=0.
+PG_PREPARED_STATEMENTS = os.getenv("PG_PREPARED_STATEMENTS", "1") != "0"
+
+
+def _as_iso(value) -> Optional[str]:
+    """Normaliza date/datetime/Timestamp/str para 'YYYY-MM-DD'."""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return value.strip()[:10]
+    return pd.Timestamp(value).date().isoformat()
+
+
+def _as_store_id(value) -> Optional[int]:
+    """store_id como int do Python (numpy.int64 do pandas vira BLOB no SQLite e não adapta no psycopg2)."""
+    if value is None or pd.isna(value):
+        return None
+    return int(value)
+
+
+def _as_tuple(row) -> tuple:
+    """Linha como tupla, seja do sqlite3 (tupla) ou do psycopg2 (RealDictRow)."""
+    if isinstance(row, dict):
+        return tuple(row.values())
+    return tuple(row)
+
+
+class Repository:
+    """Métodos tipados comuns; os backends só implementam _execute/_execute_many."""
+
+    dialect = ""
+    # relação com o histórico completo de movimentos (tabela quente + arquivo/partições)
+    _MOVEMENTS_HISTORY = "movements"
+    # trava das linhas reivindicadas em claim_alerts (workers concorrentes)
+    _SKIP_LOCKED = ""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    # ---------- infraestrutura ----------
+
+    def _execute(self, sql: str, params: tuple = ()):
+        raise NotImplementedError
+
+    def _execute_many(self, sql: str, rows: Iterable[tuple]) -> None:
+        raise NotImplementedError
+
+    def _execute_ddl(self, sql: str) -> None:
+        """DDL sem parâmetros (fora dos prepared statements)."""
+        self.conn.cursor().execute(sql)
+
+    def commit(self) -> None:
+        self.conn.commit()
+
+    def rollback(self) -> None:
+        self.conn.rollback()
+
+    def savepoint(self, name: str) -> None:
+        self._execute_ddl(f"SAVEPOINT {name}")
+
+    def rollback_to_savepoint(self, name: str) -> None:
+        """Desfaz só o que veio depois do savepoint (o resto da transação continua valendo)."""
+        self._execute_ddl(f"ROLLBACK TO SAVEPOINT {name}")
+
+    def release_savepoint(self, name: str) -> None:
+        self._execute_ddl(f"RELEASE SAVEPOINT {name}")
+
+    def fetchall(self, sql: str, params: tuple = ()) -> list[tuple]:
+        return [_as_tuple(r) for r in self._execute(sql, tuple(params)).fetchall()]
+
+    def fetchone(self, sql: str, params: tuple = ()) -> Optional[tuple]:
+        row = self._execute(sql, tuple(params)).fetchone()
+        return _as_tuple(row) if row is not None else None
+
+    def query_df(self, sql: str, params: tuple = (), parse_dates: Iterable[str] = ()) -> pd.DataFrame:
+        """Executa a consulta e monta o DataFrame pelas colunas do cursor."""
+        cur = self._execute(sql, tuple(params))
+        cols = [d[0] for d in cur.description]
+        df = pd.DataFrame([_as_tuple(r) for r in cur.fetchall()], columns=cols)
+        for col in parse_dates:
+            df[col] = pd.to_datetime(df[col], errors="coerce")
+        return df
+
+    # ---------- lojas ----------
+
+    def list_stores(self) -> list[tuple[int, str]]:
+        return self.fetchall("SELECT id, name FROM stores ORDER BY id")
+
+    def store_name(self, store_id: Optional[int]) -> Optional[str]:
+        if store_id is None:
+            return None
+        row = self.fetchone("SELECT name FROM stores WHERE id = ?", (int(store_id),))
+        return row[0] if row else None
+
+    def get_or_create_store(self, name: str) -> int:
+        self._execute("INSERT INTO stores (name) VALUES (?) ON CONFLICT (name) DO NOTHING", (name,))
+        return self.fetchone("SELECT id FROM stores WHERE name = ?", (name,))[0]
+
+    # ---------- produtos, lotes e movimentos ----------
+
+    def upsert_products(self, rows: Iterable[tuple[str, str]]) -> None:
+        """(ean, product_name): cria o produto ou atualiza o nome quando o novo não é vazio."""
+        self._execute_many("""
+            INSERT INTO products (ean, product_name) VALUES (?, ?)
+            ON CONFLICT (ean) DO UPDATE
+            SET product_name = COALESCE(NULLIF(excluded.product_name, ''), products.product_name)
+        """, rows)
+
+    def upsert_lots(self, rows: Iterable[tuple[str, str, str]]) -> None:
+        """(ean, lot, expiry_date): cria o lote; a validade de um lote existente é mantida."""
+        self._execute_many("""
+            INSERT INTO lots (ean, lot, expiry_date) VALUES (?, ?, ?)
+            ON CONFLICT (ean, lot) DO NOTHING
+        """, ((ean, lot, _as_iso(expiry)) for ean, lot, expiry in rows))
+
+    def record_movements(self, rows: Iterable[tuple]) -> None:
+        """(type, ean, lot, qty, note, store_id[, ts]): grava movimentos; ts padrão = agora."""
+        agora = datetime.now().isoformat(timespec="seconds")
+        self._execute_many("""
+            INSERT INTO movements (type, ean, lot, qty, note, store_id, ts)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (tuple(r[:6]) + ((r[6] if len(r) > 6 else agora),) for r in rows))
+
+    # ---------- estoque ----------
+
+    _STOCK_KEY = "ean = ? AND lot = ? AND COALESCE(location, '') = COALESCE(?, '') AND COALESCE(store_id, 0) = ?"
+
+    def move_stock(self, tipo: str, ean: str, lot: str, qty: int, note: str,
+                   location: Optional[str], store_id: Optional[int]) -> tuple[bool, int]:
+        """
+        Aplica um movimento de forma atômica: o saldo só muda se continuar >= 0
+        (UPDATE ... SET qty = qty + delta WHERE ... AND qty + delta >= 0), o registro
+        de estoque é criado na primeira entrada e o movimento é gravado junto.
+        A chave é o índice único uq_stock_chave (local/loja NULL normalizados),
+        então o UPDATE acha no máximo um registro.
+        Retorna (True, novo saldo) ou (False, saldo atual) se faltar estoque.
+        Não faz commit.
+        """
+        delta = qty if tipo == "receipt" else -qty
+        chave = (ean, lot, location, store_id or 0)
+        rows = self.fetchall(f"UPDATE stock SET qty = qty + ? WHERE {self._STOCK_KEY} AND qty + ? >= 0 RETURNING qty",
+                             (delta,) + chave + (delta,))
+        if not rows and delta >= 0:
+            rows = self.fetchall(f"""
+                INSERT INTO stock (ean, lot, qty, location, store_id)
+                SELECT ?, ?, ?, ?, ?
+                WHERE NOT EXISTS (SELECT 1 FROM stock WHERE {self._STOCK_KEY})
+                ON CONFLICT (ean, lot, COALESCE(location, ''), COALESCE(store_id, 0))
+                DO UPDATE SET qty = stock.qty + excluded.qty
+                RETURNING qty
+            """, (ean, lot, delta, location, store_id) + chave)
+        if not rows:
+            atual = self.fetchone(f"SELECT qty FROM stock WHERE {self._STOCK_KEY}", chave)
+            return False, (atual[0] if atual else 0)
+        self.record_movements([(tipo, ean, lot, qty, note, store_id)])
+        return True, rows[0][0]
+
+    def update_stock_item(self, ean: str, lot: str, store_id: Optional[int], qty: int, location: Optional[str]) -> None:
+        self._execute("""
+            UPDATE stock SET qty = ?, location = ?
+            WHERE ean = ? AND lot = ? AND COALESCE(store_id, 0) = ?
+        """, (qty, location, ean, lot, _as_store_id(store_id) or 0))
+
+    def update_lot_expiry(self, ean: str, lot: str, expiry_date) -> None:
+        self._execute("UPDATE lots SET expiry_date = ? WHERE ean = ? AND lot = ?", (_as_iso(expiry_date), ean, lot))
+
+    def delete_stock_item(self, ean: str, lot: str, store_id: Optional[int]) -> None:
+        """Remove o item da loja; o lote só é apagado quando nenhuma loja o tem mais."""
+        self._execute("DELETE FROM stock WHERE ean = ? AND lot = ? AND COALESCE(store_id, 0) = ?",
+                      (ean, lot, _as_store_id(store_id) or 0))
+        self._execute("""
+            DELETE FROM lots WHERE ean = ? AND lot = ?
+            AND NOT EXISTS (SELECT 1 FROM stock s WHERE s.ean = lots.ean AND s.lot = lots.lot)
+        """, (ean, lot))
+
+    # ---------- movimentos em lote ----------
+
+    # mesma chave de estoque usada em get_stock: local/loja NULL casam com ''/0
+    _MATCH_STOCK = """{s}.ean = m.ean AND {s}.lot = m.lot
+        AND COALESCE({s}.location, '') = COALESCE(m.location, '')
+        AND COALESCE({s}.store_id, 0) = COALESCE(m.store_id, 0)"""
+    _TEMP_TABLE_SUFFIX = ""
+
+    def stage_stock_deltas(self, rows: Iterable[tuple]) -> None:
+        """(ean, lot, location, store_id, delta) por chave de estoque, na tabela temporária _mov_lote."""
+        self._execute_ddl(f"""
+            CREATE TEMP TABLE IF NOT EXISTS _mov_lote (
+                ean TEXT NOT NULL,
+                lot TEXT NOT NULL,
+                location TEXT,
+                store_id INTEGER,
+                delta INTEGER NOT NULL
+            ) {self._TEMP_TABLE_SUFFIX}
+        """)
+        self._execute("DELETE FROM _mov_lote")
+        self._execute_many("INSERT INTO _mov_lote (ean, lot, location, store_id, delta) VALUES (?, ?, ?, ?, ?)", rows)
+
+    def staged_stock_balances(self) -> list[tuple]:
+        """(ean, lot, location, store_id, saldo atual, lote existe) de cada chave em _mov_lote."""
+        return self.fetchall(f"""
+            SELECT m.ean, m.lot, m.location, m.store_id, COALESCE(s.qty, 0),
+                   CASE WHEN l.ean IS NULL THEN 0 ELSE 1 END
+            FROM _mov_lote m
+            LEFT JOIN stock s ON {self._MATCH_STOCK.format(s="s")}
+            LEFT JOIN lots l ON l.ean = m.ean AND l.lot = m.lot
+        """)
+
+    def unstage_stock_keys(self, rows: Iterable[tuple]) -> None:
+        """Remove de _mov_lote as chaves (ean, lot, location, store_id) rejeitadas."""
+        self._execute_many("""
+            DELETE FROM _mov_lote
+            WHERE ean = ? AND lot = ? AND COALESCE(location, '') = COALESCE(?, '') AND COALESCE(store_id, 0) = ?
+        """, ((ean, lot, loc, store_id or 0) for ean, lot, loc, store_id in rows))
+
+    def apply_staged_deltas(self) -> None:
+        """Soma os deltas de _mov_lote ao estoque, criando os registros que faltam."""
+        # UPDATE ... FROM: percorre _mov_lote e acha cada registro pela chave única de stock
+        self._execute(f"""
+            UPDATE stock
+            SET qty = stock.qty + m.delta
+            FROM _mov_lote m
+            WHERE {self._MATCH_STOCK.format(s="stock")}
+        """)
+        self._execute(f"""
+            INSERT INTO stock (ean, lot, qty, location, store_id)
+            SELECT m.ean, m.lot, m.delta, m.location, m.store_id
+            FROM _mov_lote m
+            WHERE NOT EXISTS (SELECT 1 FROM stock s WHERE {self._MATCH_STOCK.format(s="s")})
+        """)
+
+    # ---------- NF-e (importação idempotente) ----------
+
+    def nfe_imported(self, chaves: Iterable[str]) -> set[str]:
+        """Chaves que já têm nota 'importada' (busca pela PK, em blocos)."""
+        chaves = list(dict.fromkeys(chaves))
+        encontradas = set()
+        for i in range(0, len(chaves), 500):
+            bloco = chaves[i:i + 500]
+            params = (bloco,) if self.dialect == "postgres" else tuple(bloco)
+            encontradas.update(r[0] for r in self.fetchall(
+                f"SELECT chave FROM nfe_documents WHERE status = 'importada' AND {self._in_clause('chave', len(bloco))}",
+                params,
+            ))
+        return encontradas
+
+    def claim_nfe_document(self, chave: str, origem: str, store_id: Optional[int], itens: int) -> bool:
+        """
+        Registra a nota como 'importada' na transação corrente. Retorna False se
+        outra importação já a registrou (no Postgres, espera a transação concorrente).
+        """
+        agora = datetime.now().isoformat(timespec="seconds")
+        cur = self._execute("""
+            INSERT INTO nfe_documents (chave, origem, store_id, status, itens, erro, created_at, updated_at)
+            VALUES (?, ?, ?, 'importada', ?, NULL, ?, ?)
+            ON CONFLICT (chave) DO UPDATE
+            SET origem = excluded.origem, store_id = excluded.store_id, status = 'importada',
+                itens = excluded.itens, erro = NULL, updated_at = excluded.updated_at
+            WHERE nfe_documents.status <> 'importada'
+        """, (chave, origem, store_id, itens, agora, agora))
+        return cur.rowcount == 1
+
+    def record_nfe_error(self, chave: str, origem: str, store_id: Optional[int], erro: str) -> None:
+        """Marca a nota como 'erro' (pode ser reprocessada); nunca sobrescreve uma 'importada'."""
+        agora = datetime.now().isoformat(timespec="seconds")
+        self._execute("""
+            INSERT INTO nfe_documents (chave, origem, store_id, status, itens, erro, created_at, updated_at)
+            VALUES (?, ?, ?, 'erro', 0, ?, ?, ?)
+            ON CONFLICT (chave) DO UPDATE
+            SET origem = excluded.origem, erro = excluded.erro, updated_at = excluded.updated_at
+            WHERE nfe_documents.status <> 'importada'
+        """, (chave, origem, store_id, erro, agora, agora))
+
+    # ---------- fila de alertas (alert_outbox) ----------
+
+    def enqueue_alert(self, store_id: Optional[int], subject: str, body: str,
+                      attachment_name: Optional[str] = None, attachment: Optional[bytes] = None) -> int:
+        """Enfileira um e-mail de alerta para envio imediato. Não faz commit; devolve o id."""
+        agora = datetime.now().isoformat(timespec="seconds")
+        row = self.fetchone("""
+            INSERT INTO alert_outbox (store_id, subject, body, attachment_name, attachment, next_attempt_at, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            RETURNING id
+        """, (store_id, subject, body, attachment_name, attachment, agora, agora))
+        return int(row[0])
+
+    def claim_alerts(self, limit: int, lease_seconds: float) -> list[dict]:
+        """
+        Reivindica até `limit` alertas vencidos ('pendente', ou 'enviando' com a reserva
+        expirada): passa a 'enviando', soma uma tentativa e reserva a linha por
+        `lease_seconds`. Não faz commit.
+        """
+        agora = datetime.now()
+        rows = self.fetchall(f"""
+            UPDATE alert_outbox
+            SET status = 'enviando', attempts = attempts + 1, next_attempt_at = ?
+            WHERE id IN (
+                SELECT id FROM alert_outbox
+                WHERE status IN ('pendente', 'enviando') AND next_attempt_at <= ?
+                ORDER BY next_attempt_at, id
+                LIMIT ?{self._SKIP_LOCKED}
+            )
+            RETURNING id, store_id, subject, body, attachment_name, attachment, attempts
+        """, ((agora + timedelta(seconds=lease_seconds)).isoformat(timespec="seconds"),
+              agora.isoformat(timespec="seconds"), int(limit)))
+        cols = ("id", "store_id", "subject", "body", "attachment_name", "attachment", "attempts")
+        alertas = [dict(zip(cols, r)) for r in rows]
+        for alerta in alertas:
+            if alerta["attachment"] is not None:
+                alerta["attachment"] = bytes(alerta["attachment"])  # memoryview no psycopg2
+        return sorted(alertas, key=lambda a: a["id"])
+
+    def mark_alert_sent(self, alert_id: int) -> None:
+        """Marca como enviado e descarta o PDF (a tabela não cresce com os anexos já entregues)."""
+        agora = datetime.now().isoformat(timespec="seconds")
+        self._execute("""
+            UPDATE alert_outbox SET status = 'enviado', sent_at = ?, last_error = NULL, attachment = NULL
+            WHERE id = ?
+        """, (agora, int(alert_id)))
+
+    def mark_alert_failed(self, alert_id: int, error: str, retry_at: Optional[datetime] = None) -> None:
+        """Volta para 'pendente' a partir de retry_at, ou 'falhou' de vez quando retry_at é None."""
+        if retry_at is None:
+            self._execute("UPDATE alert_outbox SET status = 'falhou', last_error = ? WHERE id = ?",
+                          (error, int(alert_id)))
+        else:
+            self._execute("""
+                UPDATE alert_outbox SET status = 'pendente', next_attempt_at = ?, last_error = ? WHERE id = ?
+            """, (retry_at.isoformat(timespec="seconds"), error, int(alert_id)))
+
+    def next_alert_due(self) -> Optional[datetime]:
+        """Horário da próxima nova tentativa pendente na fila (None = nada pendente)."""
+        row = self.fetchone("SELECT MIN(next_attempt_at) FROM alert_outbox WHERE status = 'pendente'")
+        return None if row[0] is None else pd.Timestamp(row[0]).to_pydatetime()
+
+    def alert_outbox(self, store_id: Optional[int] = None, limit: int = 50) -> pd.DataFrame:
+        """Últimos alertas da fila (sem o anexo), do mais novo para o mais antigo."""
+        where, params = "", ()
+        if store_id is not None:
+            where, params = "WHERE store_id = ?", (int(store_id),)
+        return self.query_df(f"""
+            SELECT id, store_id, subject, status, attempts, next_attempt_at, last_error, created_at, sent_at
+            FROM alert_outbox {where}
+            ORDER BY id DESC
+            LIMIT ?
+        """, params + (int(limit),))
+
+    # ---------- migrações de dados (schema_migrations) ----------
+
+    def migration_applied(self, version: int) -> bool:
+        return self.fetchone("SELECT 1 FROM schema_migrations WHERE version = ?", (int(version),)) is not None
+
+    def record_migration(self, version: int, name: str) -> None:
+        self._execute("INSERT INTO schema_migrations (version, name) VALUES (?, ?) ON CONFLICT (version) DO NOTHING",
+                      (int(version), name))
+
+    # ---------- configurações por loja (store_settings) ----------
+
+    def store_settings_versions(self) -> dict[int, int]:
+        """{store_id: version} de todas as lojas com configuração própria."""
+        return {int(sid): int(v) for sid, v in self.fetchall("SELECT store_id, version FROM store_settings")}
+
+    def store_settings(self, store_ids: Iterable[int]) -> list[tuple]:
+        """(store_id, near_expiry_days, alert_email, last_alert_sent, version) das lojas pedidas."""
+        ids = [int(s) for s in store_ids]
+        if not ids:
+            return []
+        params = (ids,) if self.dialect == "postgres" else tuple(ids)
+        return self.fetchall(f"""
+            SELECT store_id, near_expiry_days, alert_email, last_alert_sent, version
+            FROM store_settings WHERE {self._in_clause("store_id", len(ids))}
+        """, params)
+
+    def save_store_settings(self, store_id: int, near_expiry_days: Optional[int], alert_email: Optional[str]) -> None:
+        """Grava dias "a vencer" e o bloco SMTP (JSON) da loja, subindo a versão. Não faz commit."""
+        agora = datetime.now().isoformat(timespec="seconds")
+        self._execute("""
+            INSERT INTO store_settings (store_id, near_expiry_days, alert_email, version, updated_at)
+            VALUES (?, ?, ?, 1, ?)
+            ON CONFLICT (store_id) DO UPDATE
+            SET near_expiry_days = excluded.near_expiry_days, alert_email = excluded.alert_email,
+                version = store_settings.version + 1, updated_at = excluded.updated_at
+        """, (int(store_id), near_expiry_days, alert_email, agora))
+
+    def set_last_alert_sent(self, store_id: int, day) -> None:
+        """Registra o dia do último alerta da loja, subindo a versão. Não faz commit."""
+        agora = datetime.now().isoformat(timespec="seconds")
+        self._execute("""
+            INSERT INTO store_settings (store_id, last_alert_sent, version, updated_at)
+            VALUES (?, ?, 1, ?)
+            ON CONFLICT (store_id) DO UPDATE
+            SET last_alert_sent = excluded.last_alert_sent,
+                version = store_settings.version + 1, updated_at = excluded.updated_at
+        """, (int(store_id), _as_iso(day), agora))
+
+    def import_store_settings(self, store_id: int, near_expiry_days: Optional[int], alert_email: Optional[str],
+                              last_alert_sent) -> bool:
+        """Insere a configuração migrada só se a loja ainda não tiver uma no banco. Não faz commit."""
+        agora = datetime.now().isoformat(timespec="seconds")
+        cur = self._execute("""
+            INSERT INTO store_settings (store_id, near_expiry_days, alert_email, last_alert_sent, version, updated_at)
+            VALUES (?, ?, ?, ?, 1, ?)
+            ON CONFLICT (store_id) DO NOTHING
+        """, (int(store_id), near_expiry_days, alert_email, _as_iso(last_alert_sent), agora))
+        return cur.rowcount == 1
+
+    # ---------- leitura ----------
+
+    def snapshot(self, store_id=None, expiry_from=None, expiry_to=None, ean=None) -> pd.DataFrame:
+        """Linhas com saldo de stock_snapshot, com os filtros aplicados no SQL."""
+        where = ["qty > 0"]
+        params = []
+        if store_id is not None:
+            where.append("store_id = ?")
+            params.append(int(store_id))
+        if expiry_from is not None:
+            where.append("expiry_date >= ?")
+            params.append(_as_iso(expiry_from))
+        if expiry_to is not None:
+            where.append("expiry_date <= ?")
+            params.append(_as_iso(expiry_to))
+        if ean is not None:
+            eans = [ean] if isinstance(ean, str) else [str(e).strip() for e in ean]
+            if not eans:
+                return pd.DataFrame(columns=SNAPSHOT_COLUMNS)
+            where.append(self._in_clause("ean", len(eans)))
+            if self.dialect == "postgres":
+                params.append(eans)
+            else:
+                params.extend(eans)
+
+        return self.query_df(f"""
+            SELECT ean, product_name, lot, expiry_date, qty,
+                   COALESCE(location, '') AS location, store_id
+            FROM stock_snapshot
+            WHERE {" AND ".join(where)}
+            ORDER BY store_id, expiry_date ASC
+        """, tuple(params), parse_dates=["expiry_date"])
+
+    def movement_totals(self, store_id: Optional[int] = None, ts_from=None, ts_to=None) -> dict[str, int]:
+        """
+        SUM(qty) por tipo de movimento ({"receipt": n, "sale": m, ...}), agregado no banco.
+        store_id None = todas as lojas; ts_from (inclusivo) / ts_to (exclusivo) limitam o período.
+        Lê o histórico completo (inclui o arquivo); coberto por idx_movements_store_type_ts.
+        """
+        where, params = [], []
+        if store_id is not None:
+            where.append("store_id = ?")
+            params.append(int(store_id))
+        if ts_from is not None:
+            where.append("ts >= ?")
+            params.append(_as_iso(ts_from))
+        if ts_to is not None:
+            where.append("ts < ?")
+            params.append(_as_iso(ts_to))
+        sql = f"SELECT type, SUM(qty) FROM {self._movements_history()}"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        rows = self.fetchall(sql + " GROUP BY type", params)
+        return {tipo: int(total or 0) for tipo, total in rows}
+
+    # ---------- rollup diário (movements_daily) ----------
+
+    def _claim_rollup(self, name: str) -> None:
+        """
+        Primeira escrita da atualização: trava a linha de rollup_state na transação
+        corrente, então duas execuções do job nunca agregam o mesmo intervalo de ids.
+        """
+        self._execute("""
+            INSERT INTO rollup_state (name, last_id, updated_at) VALUES (?, 0, ?)
+            ON CONFLICT (name) DO UPDATE SET updated_at = excluded.updated_at
+        """, (name, datetime.now().isoformat(timespec="seconds")))
+
+    def refresh_movements_daily(self, full: bool = False) -> tuple[int, int]:
+        """
+        Soma em movements_daily os movimentos com id > rollup_state.last_id
+        (full=True: apaga o rollup e agrega o histórico inteiro).
+        Não faz commit. Retorna (último id anterior, último id agregado).
+        """
+        # incremental: só a tabela quente (os ids novos nunca estão no arquivo)
+        origem = self._movements_history() if full else "movements"
+        self._claim_rollup("movements_daily")
+        if full:
+            self._execute("DELETE FROM movements_daily")
+            inicio, piso = 0, None
+        else:
+            inicio = int(self.fetchone("SELECT last_id FROM rollup_state WHERE name = ?", ("movements_daily",))[0])
+            piso = self._rollup_ts_floor(inicio)
+        filtro_ts, params_ts = ("AND ts >= ?", (piso,)) if piso is not None else ("", ())
+        fim = self._rollup_end(origem, inicio, filtro_ts, params_ts)
+        if fim > inicio:
+            self._execute(f"""
+                INSERT INTO movements_daily (store_id, ean, day, type, qty)
+                SELECT COALESCE(store_id, 0), ean, DATE(ts), type, SUM(qty)
+                FROM {origem}
+                WHERE id > ? AND id <= ? {filtro_ts}
+                GROUP BY COALESCE(store_id, 0), ean, DATE(ts), type
+                ON CONFLICT (store_id, ean, day, type) DO UPDATE SET qty = movements_daily.qty + excluded.qty
+            """, (inicio, fim) + params_ts)
+        self._execute("UPDATE rollup_state SET last_id = ? WHERE name = ?", (fim, "movements_daily"))
+        return inicio, fim
+
+    def _movements_history(self) -> str:
+        return self._MOVEMENTS_HISTORY
+
+    def _rollup_ts_floor(self, inicio: int):
+        """Limite inferior de ts para a atualização incremental (None = só o filtro por id)."""
+        return None
+
+    def _rollup_end(self, origem: str, inicio: int, filtro_ts: str, params_ts: tuple) -> int:
+        """Último id que a atualização pode agregar (no SQLite as escritas são serializadas)."""
+        fim = self.fetchone(f"SELECT MAX(id) FROM {origem} WHERE id > ? {filtro_ts}", (inicio,) + params_ts)[0]
+        return inicio if fim is None else int(fim)
+
+    def movement_trend(self, store_id: Optional[int] = None, ean: Optional[str] = None,
+                       day_from=None, day_to=None) -> pd.DataFrame:
+        """(day, type, qty) lidos só de movements_daily; store_id/ean None = todas as lojas/produtos."""
+        where, params = [], []
+        if store_id is not None:
+            where.append("store_id = ?")
+            params.append(int(store_id))
+        if ean:
+            where.append("ean = ?")
+            params.append(str(ean))
+        if day_from is not None:
+            where.append("day >= ?")
+            params.append(_as_iso(day_from))
+        if day_to is not None:
+            where.append("day <= ?")
+            params.append(_as_iso(day_to))
+        sql = "SELECT day, type, SUM(qty) AS qty FROM movements_daily"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        return self.query_df(sql + " GROUP BY day, type ORDER BY day", tuple(params), parse_dates=["day"])
+
+    def _in_clause(self, column: str, n: int) -> str:
+        return f"{column} IN ({', '.join(['?'] * n)})"
+
+
+class SQLiteRepository(Repository):
+    dialect = "sqlite"
+    # main.movements + arquivo.movements (view temporária criada por db.anexar_arquivo)
+    _MOVEMENTS_HISTORY = "movements_all"
+
+    def __init__(self, conn):
+        super().__init__(conn)
+        self._cursors: dict[str, sqlite3.Cursor] = {}
+        self._arquivo_anexado = False
+
+    def _cursor(self, sql: str) -> sqlite3.Cursor:
+        cur = self._cursors.get(sql)
+        if cur is None:
+            cur = self._cursors[sql] = self.conn.cursor()
+        return cur
+
+    def _execute(self, sql, params=()):
+        return self._cursor(sql).execute(sql, params)
+
+    def _execute_many(self, sql, rows):
+        self._cursor(sql).executemany(sql, rows)
+
+    def _movements_history(self):
+        # o arquivo só é anexado quando alguém lê o histórico (não em toda conexão)
+        if not self._arquivo_anexado:
+            from db import anexar_arquivo
+            anexar_arquivo(self.conn)
+            self._arquivo_anexado = True
+        return self._MOVEMENTS_HISTORY
+
+    _ARCHIVE_FILTER = "ts < ? AND id <= (SELECT last_id FROM rollup_state WHERE name = 'movements_daily')"
+
+    def copy_movements_to_archive(self, before) -> None:
+        """
+        Copia para arquivo.movements os movimentos com ts < before (só os já
+        agregados no rollup; o arquivo precisa estar anexado). Não faz commit.
+        """
+        self._execute(f"""
+            INSERT OR IGNORE INTO arquivo.movements (id, ts, type, ean, lot, qty, note, store_id)
+            SELECT id, ts, type, ean, lot, qty, note, store_id FROM main.movements WHERE {self._ARCHIVE_FILTER}
+        """, (_as_iso(before),))
+
+    def purge_archived_movements(self, before) -> int:
+        """
+        Apaga da tabela quente os movimentos com ts < before cujo id já está em
+        arquivo.movements. Não faz commit. Retorna quantos saíram.
+        """
+        return self._execute(f"""
+            DELETE FROM main.movements
+            WHERE {self._ARCHIVE_FILTER}
+              AND id IN (SELECT id FROM arquivo.movements)
+        """, (_as_iso(before),)).rowcount
+
+
+class PostgresRepository(Repository):
+    dialect = "postgres"
+    # a tabela temporária fica na sessão (os prepared statements continuam válidos)
+    _TEMP_TABLE_SUFFIX = "ON COMMIT DELETE ROWS"
+    # cada worker pula as linhas que outro já está reivindicando
+    _SKIP_LOCKED = " FOR UPDATE SKIP LOCKED"
+
+    # nomes dos statements já preparados em cada conexão (sessão) do Postgres
+    _prepared: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+    def __init__(self, conn, prepared: bool = PG_PREPARED_STATEMENTS):
+        super().__init__(conn)
+        self.prepared = prepared
+
+    @staticmethod
+    def _numbered(sql: str) -> tuple[str, int]:
+        """Troca cada '?' por $1, $2, ... (formato do PREPARE)."""
+        parts = sql.split("?")
+        out = parts[0]
+        for i, part in enumerate(parts[1:], start=1):
+            out += f"${i}" + part
+        return out, len(parts) - 1
+
+    def _statement(self, cur, sql: str) -> str:
+        """Prepara o comando na sessão (só na primeira vez) e devolve o EXECUTE correspondente."""
+        name = "rp_" + hashlib.sha1(sql.encode("utf-8")).hexdigest()[:16]
+        numbered, n = self._numbered(sql)
+        prepared = self._prepared.setdefault(self.conn, set())
+        if name not in prepared:
+            cur.execute(f"PREPARE {name} AS {numbered}")
+            prepared.add(name)
+        return f"EXECUTE {name}" + (f" ({', '.join(['%s'] * n)})" if n else "")
+
+    def _execute(self, sql, params=()):
+        cur = self.conn.cursor()
+        if self.prepared:
+            cur.execute(self._statement(cur, sql), params)
+        else:
+            cur.execute(sql.replace("%", "%%").replace("?", "%s"), params)
+        return cur
+
+    def _execute_many(self, sql, rows):
+        import psycopg2.extras
+        with self.conn.cursor() as cur:
+            stmt = self._statement(cur, sql) if self.prepared else sql.replace("%", "%%").replace("?", "%s")
+            psycopg2.extras.execute_batch(cur, stmt, list(rows), page_size=500)
+
+    def _in_clause(self, column, n):
+        return f"{column} = ANY(?)"
+
+    # ts vem do início de cada gravação: um id maior pode ter ts um pouco mais antigo
+    _ROLLUP_TS_MARGIN = timedelta(days=1)
+
+    def _rollup_ts_floor(self, inicio):
+        # com ts no filtro o planner descarta as partições antigas de movements
+        row = self.fetchone("SELECT ts FROM movements WHERE id = ?", (inicio,)) if inicio else None
+        return None if row is None else row[0] - self._ROLLUP_TS_MARGIN
+
+    def _rollup_end(self, origem, inicio, filtro_ts, params_ts):
+        """
+        Ids SERIAL podem ser confirmados fora de ordem, então MAX(id) só é seguro sem
+        inserções em andamento em movements (cada INSERT segura RowExclusiveLock até
+        o fim da transação). Havendo alguma, para antes da primeira lacuna de ids: a
+        lacuna pode ser uma transação ainda aberta, que a próxima atualização pega.
+        Nada aqui bloqueia quem grava movimentos.
+        """
+        fim = super()._rollup_end(origem, inicio, filtro_ts, params_ts)
+        if fim == inicio:
+            return inicio
+        gravando = self.fetchone("""
+            SELECT EXISTS (
+                SELECT 1 FROM pg_locks
+                WHERE locktype = 'relation' AND relation = CAST('movements' AS regclass)
+                  AND mode = 'RowExclusiveLock' AND pid <> pg_backend_pid()
+            )
+        """)[0]
+        if not gravando:
+            return fim
+        lacuna = self.fetchone(f"""
+            SELECT MIN(id) FROM (
+                SELECT id, LEAD(id) OVER (ORDER BY id) AS proximo
+                FROM (
+                    SELECT CAST(? AS BIGINT) AS id
+                    UNION ALL
+                    SELECT id FROM {origem} WHERE id > ? AND id <= ? {filtro_ts}
+                ) ids
+            ) pares
+            WHERE proximo > id + 1
+        """, (inicio, inicio, fim) + params_ts)[0]
+        return fim if lacuna is None else int(lacuna)
+
+    def move_stock(self, tipo, ean, lot, qty, note, location, store_id):
+        """Mesma semântica do Repository.move_stock, numa única ida ao banco (CTE)."""
+        delta = qty if tipo == "receipt" else -qty
+        chave = (ean, lot, location, store_id or 0)
+        agora = datetime.now().isoformat(timespec="seconds")
+        # UPDATE condicional, INSERT da primeira entrada e movimento no mesmo comando;
+        # sob concorrência o UPDATE espera o lock da linha e reavalia qty + delta >= 0,
+        # e duas primeiras entradas caem no índice único uq_stock_chave (loja NULL = 0)
+        row = self.fetchone(f"""
+            WITH upd AS (
+                UPDATE stock SET qty = qty + CAST(? AS INTEGER)
+                WHERE {self._STOCK_KEY} AND qty + CAST(? AS INTEGER) >= 0
+                RETURNING qty
+            ), ins AS (
+                INSERT INTO stock (ean, lot, qty, location, store_id)
+                SELECT CAST(? AS TEXT), CAST(? AS TEXT), CAST(? AS INTEGER), CAST(? AS TEXT), CAST(? AS INTEGER)
+                WHERE CAST(? AS INTEGER) >= 0
+                  AND NOT EXISTS (SELECT 1 FROM stock WHERE {self._STOCK_KEY})
+                ON CONFLICT (ean, lot, (COALESCE(location, '')), (COALESCE(store_id, 0)))
+                DO UPDATE SET qty = stock.qty + EXCLUDED.qty
+                RETURNING qty
+            ), saldo AS (
+                SELECT qty FROM upd UNION ALL SELECT qty FROM ins
+            ), mov AS (
+                INSERT INTO movements (type, ean, lot, qty, note, store_id, ts)
+                SELECT CAST(? AS TEXT), CAST(? AS TEXT), CAST(? AS TEXT), CAST(? AS INTEGER),
+                       CAST(? AS TEXT), CAST(? AS INTEGER), CAST(? AS TIMESTAMP)
+                WHERE EXISTS (SELECT 1 FROM saldo)
+            )
+            SELECT (SELECT qty FROM saldo LIMIT 1) AS saldo,
+                   (SELECT qty FROM stock WHERE {self._STOCK_KEY} LIMIT 1) AS atual
+        """, (delta,) + chave + (delta,)
+             + (ean, lot, delta, location, store_id, delta) + chave
+             + (tipo, ean, lot, qty, note, store_id, agora)
+             + chave)
+        saldo, atual = row
+        if saldo is None:
+            return False, (atual or 0)
+        return True, saldo
+
+
+_SQLITE_REPOS: "OrderedDict[int, SQLiteRepository]" = OrderedDict()
+_PG_REPOS: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+
+def get_repository(conn) -> Repository:
+    """Repositório da conexão (reaproveitado entre chamadas, junto com seus cursores)."""
+    if isinstance(conn, sqlite3.Connection):
+        # sqlite3.Connection não aceita weakref: cache LRU pequeno por id()
+        repo = _SQLITE_REPOS.get(id(conn))
+        if repo is None or repo.conn is not conn:
+            repo = _SQLITE_REPOS[id(conn)] = SQLiteRepository(conn)
+            while len(_SQLITE_REPOS) > 16:
+                _SQLITE_REPOS.popitem(last=False)
+        _SQLITE_REPOS.move_to_end(id(conn))
+        return repo
+
+    repo = _PG_REPOS.get(conn)
+    if repo is None:
+        repo = _PG_REPOS[conn] = PostgresRepository(conn)
+    return repo
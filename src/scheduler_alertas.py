@@ -1,35 +1,36 @@
 # scheduler_alertas.py
 import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 from datetime import datetime
-from db import get_conn
-import expiry_bot as bot
+import pandas as pd
+from db import get_conn, init_db, arquivar_movimentos
 import reporting
+from repository import get_repository
 from report_pdf import gerar_relatorio_pdf
+from outbox_alertas import drenar_outbox, enfileirar_alerta
+import config_lojas
 
 # === Carrega config global ===
 CFG_PATH = Path(__file__).resolve().parents[1] / "config.json"
 cfg = json.loads(Path(CFG_PATH).read_text(encoding="utf-8"))
 conn = get_conn(cfg["database_path"])
+init_db(conn)
 
-def enviar_alertas_automaticos():
-    """Envia e-mails automáticos de alerta 1x/dia para cada loja com produtos próximos da validade."""
-    try:
-        lojas = conn.execute("SELECT id, name FROM stores").fetchall()
-    except Exception as e:
-        print("⚠️ Banco de dados não inicializado corretamente:", e)
-        return
-
-    if not lojas:
-        print("ℹ️ Nenhuma loja cadastrada. Nenhum alerta a enviar.")
-        return
-
-    hoje = datetime.now().strftime("%Y-%m-%d")
+def _lojas_para_alertar(lojas, hoje):
+    """
+    Gera (loja_id, loja_nome, argumentos do PDF) para cada loja que precisa
+    receber alerta hoje.
+    """
+    # Um único snapshot de todas as lojas por execução, dividido por loja no pandas
+    # (lido só quando a primeira loja habilitada precisar dele)
+    por_loja = None
 
     for loja_id, loja_nome in lojas:
         try:
-            CFG_STORE_PATH = Path(__file__).resolve().parents[1] / f"config_loja_{loja_id}.json"
-            cfg_loja = json.loads(Path(CFG_STORE_PATH).read_text(encoding="utf-8")) if CFG_STORE_PATH.exists() else cfg
+            cfg_loja = config_lojas.config_loja(conn, cfg, loja_id)
 
             alert_cfg = cfg_loja.get("alert_email", {})
             if not alert_cfg.get("enabled", False):
@@ -41,21 +42,21 @@ def enviar_alertas_automaticos():
                 print(f"⏳ {loja_nome}: alerta já enviado hoje, pulando.")
                 continue
 
-            # Snapshot do estoque da loja
-            df = reporting.build_snapshots(conn)
-            if df is None or df.empty or "store_id" not in df.columns:
-                continue
+            if por_loja is None:
+                snapshot = reporting.build_snapshots(conn)
+                por_loja = {} if snapshot is None else dict(tuple(snapshot.groupby("store_id")))
 
-            df = df[df["store_id"] == loja_id]
-            if df.empty:
+            # Snapshot do estoque da loja
+            df = por_loja.get(loja_id)
+            if df is None or df.empty:
                 continue
 
-            near = reporting.near_expiry(df, cfg.get("near_expiry_days", 15))
+            near = reporting.near_expiry(df, cfg_loja.get("near_expiry_days", 15))
             if near.empty:
                 continue
 
-            pdf_path = gerar_relatorio_pdf(
-                cfg_loja,
+            yield loja_id, loja_nome, dict(
+                cfg=cfg_loja,
                 df=df,
                 total_estoque=int(df["qty"].sum()),
                 total_a_vencer=int(near["qty"].sum()),
@@ -64,19 +65,164 @@ def enviar_alertas_automaticos():
                 store_id=loja_id,
             )
 
-            subject = f"⚠️ {loja_nome}: Relatório de produtos próximos da validade"
-            body = f"Segue em anexo o relatório de validade da loja {loja_nome} ({hoje})."
+        except Exception as e:
+            print(f"❌ Erro ao processar {loja_nome}: {e}")
+
+def _enfileirar_alerta(loja_id, loja_nome, pdf_path, hoje):
+    subject = f"⚠️ {loja_nome}: Relatório de produtos próximos da validade"
+    body = f"Segue em anexo o relatório de validade da loja {loja_nome} ({hoje})."
+    return enfileirar_alerta(conn, loja_id, subject, body, anexos=[pdf_path])
+
+def _config_loja(conn_fila, store_id):
+    return config_lojas.config_loja(conn_fila, cfg, store_id)
 
-            ok, info = bot.enviar_email_alerta(cfg_loja, subject, body, anexos=[pdf_path])
-            if ok:
-                cfg_loja["last_alert_sent"] = hoje
-                CFG_STORE_PATH.write_text(json.dumps(cfg_loja, indent=2, ensure_ascii=False), encoding="utf-8")
-                print(f"[{datetime.now():%H:%M}] ✅ E-mail enviado para {loja_nome}")
-            else:
-                print(f"[{datetime.now():%H:%M}] ❌ Erro ao enviar e-mail: {info}")
+def _gerar_pdf_cronometrado(pdf_kwargs):
+    """Roda no processo do pool: devolve (caminho do PDF, segundos de renderização)."""
+    t0 = time.perf_counter()
+    return gerar_relatorio_pdf(**pdf_kwargs), time.perf_counter() - t0
+
+def entregar_fila(envios=1):
+    """
+    Envia os alertas vencidos da fila (desta rodada e as novas tentativas de rodadas
+    anteriores). Sem o worker do app, as novas tentativas que vencem em até
+    scheduler_retry_window segundos (padrão 300) são esperadas aqui mesmo; as mais
+    distantes ficam para a próxima rodada do agendador.
+    """
+    try:
+        resultados = drenar_outbox(conn, _config_loja, envios=envios,
+                                   espera_maxima=cfg.get("scheduler_retry_window", 300))
+    except Exception as e:
+        print("⚠️ Erro ao processar a fila de alertas:", e)
+        return []
+    for r in resultados:
+        if r["ok"]:
+            print(f"[{datetime.now():%H:%M}] ✅ Alerta #{r['id']} enviado (loja {r['store_id']})")
+        elif r["proxima"] is not None:
+            print(f"[{datetime.now():%H:%M}] ❌ Alerta #{r['id']}: {r['info']} — nova tentativa às {r['proxima']:%H:%M}")
+        else:
+            print(f"[{datetime.now():%H:%M}] ❌ Alerta #{r['id']}: {r['info']} — sem nova tentativa")
+    return resultados
+
+def enviar_alertas_automaticos(paralelo=False):
+    """
+    Enfileira 1x/dia o alerta de cada loja com produtos próximos da validade e
+    entrega a fila (alert_outbox) ao final; falhas ficam na fila para nova tentativa.
+    """
+    try:
+        lojas = get_repository(conn).list_stores()
+    except Exception as e:
+        print("⚠️ Banco de dados não inicializado corretamente:", e)
+        return
+
+    if not lojas:
+        print("ℹ️ Nenhuma loja cadastrada. Nenhum alerta a enviar.")
+        entregar_fila()
+        return
+
+    hoje = datetime.now().strftime("%Y-%m-%d")
+
+    if paralelo:
+        enviar_alertas_paralelo(
+            list(_lojas_para_alertar(lojas, hoje)),
+            hoje,
+            processos=cfg.get("scheduler_pdf_workers") or os.cpu_count(),
+            envios=cfg.get("scheduler_email_workers", 4),
+        )
+        return
+
+    for loja_id, loja_nome, pdf_kwargs in _lojas_para_alertar(lojas, hoje):
+        try:
+            pdf_path = gerar_relatorio_pdf(**pdf_kwargs)
+
+            # a partir daqui a entrega (e as novas tentativas) é da fila
+            alert_id = _enfileirar_alerta(loja_id, loja_nome, pdf_path, hoje)
+            config_lojas.registrar_alerta_enviado(conn, loja_id, hoje)
+            print(f"[{datetime.now():%H:%M}] 📥 Alerta #{alert_id} de {loja_nome} enfileirado")
 
         except Exception as e:
             print(f"❌ Erro ao processar {loja_nome}: {e}")
 
+    entregar_fila()
+
+def enviar_alertas_paralelo(envios_lojas, hoje, processos=2, envios=4):
+    """
+    Modo paralelo: os PDFs são renderizados num pool de `processos` processos e
+    enfileirados à medida que ficam prontos; depois a fila é entregue por no máximo
+    `envios` threads. A falha de uma loja (PDF ou SMTP) não interrompe as demais.
+    Ao final imprime o tempo de cada etapa por loja.
+    """
+    if not envios_lojas:
+        print("ℹ️ Nenhuma loja precisa de alerta hoje.")
+        entregar_fila(envios)
+        return []
+
+    t0 = time.perf_counter()
+    resumo = {
+        loja_id: {"loja": loja_nome, "pdf_s": None, "email_s": None, "status": "pendente"}
+        for loja_id, loja_nome, *_ in envios_lojas
+    }
+    nomes = {loja_id: loja_nome for loja_id, loja_nome, _ in envios_lojas}
+    fila = {}  # id do alerta -> loja
+
+    with ProcessPoolExecutor(max_workers=max(1, int(processos))) as pool_pdf:
+        pdfs = {
+            pool_pdf.submit(_gerar_pdf_cronometrado, pdf_kwargs): loja_id
+            for loja_id, _, pdf_kwargs in envios_lojas
+        }
+        for futuro in as_completed(pdfs):
+            loja_id = pdfs[futuro]
+            loja_nome = nomes[loja_id]
+            try:
+                pdf_path, dt = futuro.result()
+                resumo[loja_id]["pdf_s"] = round(dt, 2)
+                fila[_enfileirar_alerta(loja_id, loja_nome, pdf_path, hoje)] = loja_id
+                config_lojas.registrar_alerta_enviado(conn, loja_id, hoje)
+                resumo[loja_id]["status"] = "na fila"
+            except Exception as e:
+                resumo[loja_id]["status"] = f"erro no PDF: {e}"
+
+    for r in entregar_fila(envios):
+        loja_id = fila.get(r["id"])
+        if loja_id is None:
+            continue  # nova tentativa de uma rodada anterior
+        resumo[loja_id]["email_s"] = round(r["segundos"], 2)
+        resumo[loja_id]["status"] = "enviado" if r["ok"] else f"erro no e-mail: {r['info']}"
+
+    resumo = pd.DataFrame(list(resumo.values()))
+    enviados = int((resumo["status"] == "enviado").sum())
+    print(reporting.to_console(
+        resumo,
+        f"Alertas em paralelo: {enviados}/{len(resumo)} enviados em {time.perf_counter() - t0:.1f}s "
+        f"({processos} processos de PDF, {envios} envios simultâneos)"
+    ))
+    return resumo.to_dict("records")
+
+def atualizar_rollup(completo=False):
+    """Atualiza o rollup diário de movimentos (gráficos de tendência do painel)."""
+    try:
+        n = reporting.refresh_movements_daily(conn, full=completo)
+        print(f"📈 movements_daily: {n} movimento(s) agregado(s){' (reconstrução completa)' if completo else ''}.")
+    except Exception as e:
+        print("⚠️ Erro ao atualizar o rollup de movimentos:", e)
+
+def arquivar_historico():
+    """Move para o arquivo (<banco>_arquivo.db) os movimentos dos meses fechados."""
+    try:
+        n = arquivar_movimentos(conn, cfg.get("archive_open_months", 3))
+        if n:
+            print(f"🗄️ {n} movimento(s) de meses fechados arquivado(s).")
+    except Exception as e:
+        print("⚠️ Erro ao arquivar movimentos:", e)
+
 if __name__ == "__main__":
-    enviar_alertas_automaticos()
+    import sys
+
+    try:
+        n = config_lojas.migrar_configs_json(conn)
+        if n:
+            print(f"🗂️ Configuração de {n} loja(s) migrada(s) dos JSON para store_settings.")
+    except Exception as e:
+        print("⚠️ Erro ao migrar configurações das lojas:", e)
+    atualizar_rollup(completo="--rollup-completo" in sys.argv)
+    arquivar_historico()
+    enviar_alertas_automaticos(paralelo="--paralelo" in sys.argv or cfg.get("scheduler_parallel", False))
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# os módulos do app são importados como no Streamlit (src/ no sys.path)
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
@@ -0,0 +1,168 @@
+"""EnviadorEmail contra um servidor SMTP local (aiosmtpd)."""
+import logging
+import smtplib
+import socket
+import threading
+import time
+
+import pytest
+
+from aiosmtpd.controller import Controller
+from aiosmtpd.smtp import AuthResult
+
+import expiry_bot as bot
+
+logging.getLogger("mail.log").setLevel(logging.ERROR)  # avisos de depreciação do aiosmtpd
+
+
+class Caixa:
+    """Grava as mensagens recebidas; `respostas` define o código de cada DATA (padrão 250)."""
+
+    def __init__(self):
+        self.recebidas = []
+        self.sessoes = set()
+        self.respostas = []
+        self.derrubar_depois_do_data = False
+
+    async def handle_DATA(self, server, session, envelope):
+        self.sessoes.add(id(session))
+        resposta = self.respostas.pop(0) if self.respostas else "250 OK"
+        if resposta.startswith("250"):
+            self.recebidas.append(envelope.content)
+        if self.derrubar_depois_do_data:
+            server.transport.close()
+        return resposta
+
+
+@pytest.fixture
+def servidor():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        porta = sock.getsockname()[1]
+    caixa = Caixa()
+    controller = Controller(
+        caixa, hostname="127.0.0.1", port=porta, auth_require_tls=False,
+        authenticator=lambda *args: AuthResult(success=True),
+    )
+    controller.start()
+    try:
+        yield caixa, {
+            "enabled": True, "smtp_server": "127.0.0.1", "smtp_port": porta, "use_tls": False,
+            "username": "teste", "password": "teste", "from_addr": "teste@localhost",
+            "to_addrs": ["loja@localhost"],
+        }
+    finally:
+        controller.stop()
+
+
+def _mensagens(alert_cfg, n):
+    return [bot.montar_email_alerta(alert_cfg, f"Alerta {i}", "Itens a vencer") for i in range(n)]
+
+
+def _enviador(alert_cfg):
+    return bot.EnviadorEmail(alert_cfg, espera_inicial=0.01, espera_maxima=0.05, timeout=5)
+
+
+def test_lote_usa_uma_sessao(servidor):
+    caixa, alert_cfg = servidor
+    enviador = _enviador(alert_cfg)
+    try:
+        resultados = enviador.enviar_lote(_mensagens(alert_cfg, 5))
+    finally:
+        enviador.fechar()
+    assert all(ok for ok, _ in resultados)
+    assert len(caixa.recebidas) == 5
+    assert len(caixa.sessoes) == 1
+
+
+def test_4xx_tenta_de_novo(servidor):
+    caixa, alert_cfg = servidor
+    caixa.respostas = ["451 Tente mais tarde", "421 Limite de envio"]
+    enviador = _enviador(alert_cfg)
+    try:
+        [(ok, info)] = enviador.enviar_lote(_mensagens(alert_cfg, 1))
+    finally:
+        enviador.fechar()
+    assert ok, info
+    assert len(caixa.recebidas) == 1
+
+
+def test_5xx_falha_na_hora(servidor):
+    caixa, alert_cfg = servidor
+    caixa.respostas = ["554 Rejeitado"]
+    enviador = _enviador(alert_cfg)
+    try:
+        [(ok, info)] = enviador.enviar_lote(_mensagens(alert_cfg, 1))
+    finally:
+        enviador.fechar()
+    assert not ok
+    assert "554" in info
+    assert caixa.respostas == [] and caixa.recebidas == []
+
+
+def test_sessao_derrubada_reconecta(servidor):
+    caixa, alert_cfg = servidor
+    enviador = _enviador(alert_cfg)
+    try:
+        assert enviador.enviar_lote(_mensagens(alert_cfg, 1))[0][0]
+        enviador._smtp.close()  # o servidor derrubou a sessão ociosa
+        [(ok, info)] = enviador.enviar_lote(_mensagens(alert_cfg, 1))
+    finally:
+        enviador.fechar()
+    assert ok, info
+    assert len(caixa.recebidas) == 2
+    assert len(caixa.sessoes) == 2
+
+
+def test_queda_depois_do_data_nao_reenvia(servidor):
+    caixa, alert_cfg = servidor
+    caixa.derrubar_depois_do_data = True
+    enviador = _enviador(alert_cfg)
+    try:
+        [(ok, info)] = enviador.enviar_lote(_mensagens(alert_cfg, 1))
+    finally:
+        enviador.fechar()
+    assert not ok
+    assert "não reenviado" in info
+    assert len(caixa.recebidas) == 1
+
+
+def test_backoff_nao_segura_a_sessao(servidor):
+    caixa, alert_cfg = servidor
+    caixa.respostas = ["451 Tente mais tarde"]
+    enviador = bot.EnviadorEmail(alert_cfg, espera_inicial=1.0, timeout=5)
+    tempos = {}
+
+    def enviar(nome):
+        t0 = time.perf_counter()
+        tempos[nome] = (enviador.enviar_lote(_mensagens(alert_cfg, 1))[0], time.perf_counter() - t0)
+
+    try:
+        lenta = threading.Thread(target=enviar, args=("lenta",))
+        lenta.start()
+        while not caixa.sessoes:  # a primeira mensagem já levou o 451
+            time.sleep(0.01)
+        enviar("rapida")
+        lenta.join()
+    finally:
+        enviador.fechar()
+    assert tempos["lenta"][0][0] and tempos["rapida"][0][0]
+    assert tempos["rapida"][1] < 0.5 < tempos["lenta"][1]
+
+
+def test_erro_de_protocolo_nao_e_repetido(servidor, monkeypatch):
+    _, alert_cfg = servidor
+    enviador = _enviador(alert_cfg)
+    chamadas = []
+
+    def recusar(*args, **kwargs):
+        chamadas.append(1)
+        raise smtplib.SMTPRecipientsRefused({"loja@localhost": (550, b"nao existe")})
+
+    try:
+        enviador._conectar()
+        monkeypatch.setattr(enviador._smtp, "send_message", recusar)
+        [(ok, _)] = enviador.enviar_lote(_mensagens(alert_cfg, 1))
+    finally:
+        enviador.fechar()
+    assert not ok and len(chamadas) == 1